@@ -1,7 +1,10 @@
 # Scan Flare snippets created from PO files.
 from lxml import etree
 import os
+import bisect
 import polib
+import xml_writer
+import snippet_index
 
 
 # parser_html = lxml.html.HTMLParser(encoding="utf-8")
@@ -34,6 +37,10 @@ for elem in po_input:
     po_key_list.append(temp_str.lower())
     po_key_list_trunc.append(temp_str.lower()[0:120])
 
+# The PO keys in sorted order with their index in the PO file, so that the keys with a prefix are one slice
+po_keys_sorted = sorted((key, ind) for ind, key in enumerate(po_key_list))
+po_keys_sorted_keys = [key for key, ind in po_keys_sorted]
+
 # searching for duplicates
 seen = set()
 unique = []
@@ -44,127 +51,109 @@ for x in po_key_list_trunc:
     seen.add(x)
 
 
-def indent(elem, level=0, more_sibs=False):
-    i = "\n"
-    empty_spaces = "    "
-    if level:
-        i += (level - 1) * empty_spaces
-    num_children = len(elem)
-    if num_children:
-        if not elem.text or not elem.text.strip():
-            if elem.getchildren()[0].tag not in inline_tags:
-                elem.text = i + empty_spaces
-                if level:
-                    elem.text += empty_spaces
-        count = 0
-        for child in elem:
-            if child.tag not in inline_tags:
-                indent(child, level + 1, count < num_children - 1)
-            count += 1
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-            if more_sibs:
-                elem.tail += empty_spaces
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
-            if more_sibs:
-                elem.tail += empty_spaces
-
-
 def write_root(root, filename):
-    indent(root)
-    result_str = etree.tostring(root, encoding="UTF-8")
-    xml_declaration = b"<?xml version=\"1.0\" encoding=\"utf-8\"?>\n"
-    result_str = xml_declaration + result_str
-    output_file = open(filename, "wb")
-    output_file.write(result_str)
-    output_file.close()
+    xml_writer.write_root(root, filename, inline_tags)
+
+
+# Returns the PO keys that start with the prefix, in the order of the PO file (found with binary search)
+def find_po_keys_with_prefix(prefix):
+    ind_start = bisect.bisect_left(po_keys_sorted_keys, prefix)
+    ind_end = ind_start
+    while ind_end < len(po_keys_sorted_keys) and po_keys_sorted_keys[ind_end].startswith(prefix):
+        ind_end += 1
+    return [key for key, ind in sorted(po_keys_sorted[ind_start:ind_end], key=lambda item: item[1])]
+
+
+# Returns the src with the special chars replaced and with the ui snippet prefix (for the snippets from PO files)
+def fix_snippet_src(src):
+    searchStr = '&()=.'
+    src_split = src.split(dir_sep)
+    # [0:-6] is to exclude the dot and the extension from search/replacement
+    tmp_string = src_split[-1][0:-6]
+    # Checking if the snippet path contains a char to replace
+    if any((c in searchStr) for c in tmp_string):
+        for char in searchStr:
+            tmp_string = tmp_string.replace(char, "_")
+        src_split[-1] = tmp_string + ".flsnp"
+    # Checking if the snippet path starts with the ui snippet prefix
+    if po_snippets_dir in src_split and not tmp_string.startswith(ui_snippet_prefix):
+        src_split[-1] = ui_snippet_prefix + tmp_string + ".flsnp"
+    return dir_sep.join(src_split)
+
 
 # replacing extra special chars in src attributes of xrefs
+# Only the topics with a src to fix are parsed (the srcs of the others come from the snippet index).
 def scan_files(path):
+    index = snippet_index.load_snippet_index(path)
     global_snippet_list = []
     file_snippet_modified_list = []
-    for root_dir, dirs, files in os.walk(path):
-        root_dir = root_dir.replace(os.path.sep, dir_sep)
-        for filename in files:
-            if filename.endswith('.htm'):
-                current_filepath = root_dir + dir_sep + filename
-                root_tree = etree.parse(current_filepath, parser=parser_xml)
-                root = root_tree.getroot()
-                nsmap = root.nsmap
-                nsmap_value = nsmap["MadCap"]
-                snippetText_list = root.findall(".//{" + nsmap_value + "}snippetText")
-                snippetBlock_list = root.findall(".//{" + nsmap_value + "}snippetBlock")
-                file_snippet_list = snippetText_list + snippetBlock_list
-                global_snippet_list += file_snippet_list
-                searchStr = '&()=.'
-                has_special_char = False
-                has_no_ui_snippet_prefix = False
-                for elem in file_snippet_list:
-                    src_split = elem.attrib["src"].split(dir_sep)
-                    # [0:-6] is to exclude the dot and the extension from search/replacement
-                    tmp_string = src_split[-1][0:-6]
-                    # Checking if the snippet path contains a char to replace
-                    if any((c in searchStr) for c in tmp_string):
-                        has_special_char = True
-                        for char in searchStr:
-                            tmp_string = tmp_string.replace(char, "_")
-                        src_split[-1] = tmp_string + ".flsnp"
-                        # TODO: move this outside of this loop (no time to test now)
-                        elem.attrib["src"] = dir_sep.join(src_split)
-                    # Checking if the snippet path starts with the ui snippet prefix
-                    if po_snippets_dir in src_split and not tmp_string.startswith(ui_snippet_prefix):
-                        has_no_ui_snippet_prefix = True
-                        src_split[-1] = ui_snippet_prefix + tmp_string + ".flsnp"
-                        # TODO: move this outside of this loop (no time to test now)
-                        elem.attrib["src"] = dir_sep.join(src_split)
-                if has_special_char or has_no_ui_snippet_prefix is True:
-                    write_root(root, current_filepath)
-                    for elem in file_snippet_list:
-                        file_snippet_modified_list.append([current_filepath, elem])
-
+    for topic_path, topic_entry in index["topics"].items():
+        snippet_srcs = topic_entry["snippets"]
+        if any(fix_snippet_src(src) != src for src in snippet_srcs):
+            current_filepath = snippet_index.get_topic_filepath(path, topic_path)
+            root_tree = etree.parse(current_filepath, parser=parser_xml)
+            root = root_tree.getroot()
+            nsmap = root.nsmap
+            nsmap_value = nsmap["MadCap"]
+            snippetText_list = root.findall(".//{" + nsmap_value + "}snippetText")
+            snippetBlock_list = root.findall(".//{" + nsmap_value + "}snippetBlock")
+            file_snippet_list = snippetText_list + snippetBlock_list
+            for elem in file_snippet_list:
+                elem.attrib["src"] = fix_snippet_src(elem.attrib["src"])
+            write_root(root, current_filepath)
+            for elem in file_snippet_list:
+                file_snippet_modified_list.append([current_filepath, elem])
+            snippet_srcs = [elem.attrib["src"] for elem in file_snippet_list]
+            snippet_index.update_topic(index, path, topic_path, snippet_srcs)
+        global_snippet_list += snippet_srcs
+    snippet_index.save_snippet_index(index, path)
     return file_snippet_modified_list, global_snippet_list
 
 
 # This function replaces long legacy src links with shorter links
+# Only the topics with a long src are parsed (the srcs of the others come from the snippet index).
 def scan_long_names(path):
+    cut_char_num = 100
+    index = snippet_index.load_snippet_index(path)
     global_snippet_list = []
     file_snippet_modified_list = []
-    for root_dir, dirs, files in os.walk(path):
-        root_dir = root_dir.replace(os.path.sep, dir_sep)
-        for filename in files:
-            if filename.endswith('.htm'):
-                current_filepath = root_dir + dir_sep + filename
-                root_tree = etree.parse(current_filepath, parser=parser_xml)
-                root = root_tree.getroot()
-                nsmap = root.nsmap
-                nsmap_value = nsmap["MadCap"]
-                snippetText_list = root.findall(".//{" + nsmap_value + "}snippetText")
-                snippetBlock_list = root.findall(".//{" + nsmap_value + "}snippetBlock")
-                file_snippet_list = snippetText_list + snippetBlock_list
-                global_snippet_list += file_snippet_list
-                length_exceeded = False
-                for elem in file_snippet_list:
-                    src_filename = elem.attrib["src"].split("/")[-1]
-                    cut_char_num = 100
-                    filename_no_ext = src_filename.replace(".flsnp", "")
-                    if len(filename_no_ext) > cut_char_num:
-                        str_left = filename_no_ext[0:cut_char_num]
-                        # getting the number of chars to the right from original keys (with replaced special chars)
-                        for el01 in po_key_list:
-                            # In the next line, -3 is to remove the numbers and the underscore from orig script (they are not in the orig keys)
-                            if el01.startswith(filename_no_ext[:-3]):
-                                num_char_to_right = len(el01[cut_char_num:])
-                        # TODO: Make a list (in a separate function) of all po entries.
-                        # Use starts with to get the matching one, then calculate the chars to the right.
-                        filename_no_ext = str_left + str(num_char_to_right)
-                        elem.attrib["src"] = elem.attrib["src"].replace(src_filename, filename_no_ext + ".flsnp")
-                        length_exceeded = True
-                if length_exceeded is True:
-                    write_root(root, current_filepath)
-                    for elem in file_snippet_list:
-                        file_snippet_modified_list.append([current_filepath, elem])
+    for topic_path, topic_entry in index["topics"].items():
+        snippet_srcs = topic_entry["snippets"]
+        if any(len(src.split("/")[-1].replace(".flsnp", "")) > cut_char_num for src in snippet_srcs):
+            current_filepath = snippet_index.get_topic_filepath(path, topic_path)
+            root_tree = etree.parse(current_filepath, parser=parser_xml)
+            root = root_tree.getroot()
+            nsmap = root.nsmap
+            nsmap_value = nsmap["MadCap"]
+            snippetText_list = root.findall(".//{" + nsmap_value + "}snippetText")
+            snippetBlock_list = root.findall(".//{" + nsmap_value + "}snippetBlock")
+            file_snippet_list = snippetText_list + snippetBlock_list
+            for elem in file_snippet_list:
+                src_filename = elem.attrib["src"].split("/")[-1]
+                filename_no_ext = src_filename.replace(".flsnp", "")
+                if len(filename_no_ext) > cut_char_num:
+                    str_left = filename_no_ext[0:cut_char_num]
+                    # getting the number of chars to the right from original keys (with replaced special chars)
+                    # -3 is to remove the numbers and the underscore from orig script (they are not in the orig keys)
+                    matching_keys = find_po_keys_with_prefix(filename_no_ext[:-3])
+                    if not matching_keys:
+                        print("WARNING: No PO key for the snippet, leaving the src as it is: " + elem.attrib["src"]
+                              + " File: " + current_filepath)
+                        continue
+                    # The last matching key in the PO file, as before
+                    num_char_to_right = len(matching_keys[-1][cut_char_num:])
+                    if len(set(len(key[cut_char_num:]) for key in matching_keys)) > 1:
+                        print("WARNING: More than one PO key for the snippet, using the last one (" + matching_keys[-1]
+                              + "): " + elem.attrib["src"] + " File: " + current_filepath)
+                    filename_no_ext = str_left + str(num_char_to_right)
+                    elem.attrib["src"] = elem.attrib["src"].replace(src_filename, filename_no_ext + ".flsnp")
+            write_root(root, current_filepath)
+            for elem in file_snippet_list:
+                file_snippet_modified_list.append([current_filepath, elem])
+            snippet_srcs = [elem.attrib["src"] for elem in file_snippet_list]
+            snippet_index.update_topic(index, path, topic_path, snippet_srcs)
+        global_snippet_list += snippet_srcs
+    snippet_index.save_snippet_index(index, path)
     return file_snippet_modified_list, global_snippet_list
 
 
@@ -172,8 +161,8 @@ total_snippet_modified_list, total_snippet_list = scan_files(content_dir)
 
 # Creating the list of used snippets
 used_snippet_filepaths = set()
-for elem in total_snippet_list:
-    used_snippet_filepaths.add(snippet_dir + elem.attrib["src"].split("po_snippets")[-1])
+for src in total_snippet_list:
+    used_snippet_filepaths.add(snippet_dir + src.split("po_snippets")[-1])
 
 # length_modified_list, total_length_list = scan_long_names(content_dir)
 
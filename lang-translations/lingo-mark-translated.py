@@ -3,6 +3,9 @@ from lxml import etree
 import sys
 import os
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import xml_writer
+
 
 parser_xml = etree.XMLParser(strip_cdata=False)
 dir_to_process = sys.argv[1]
@@ -10,14 +13,10 @@ source_lang = sys.argv[2]
 target_lang = sys.argv[3]
 dir_sep = "/"
 exclude_from_translation_value = "translation.exclude_from_translation"
+xml_declaration = b"<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
 
 def write_root(root, filename):
-    result_str = etree.tostring(root, encoding="UTF-8")
-    xml_declaration = b"<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
-    result_str = xml_declaration + result_str
-    output_file = open(filename, "wb")
-    output_file.write(result_str)
-    output_file.close()
+    xml_writer.write_root(root, filename, xml_declaration=xml_declaration, indent=False)
 
 
 def replace_string_in_file(string1, string2, file_path):
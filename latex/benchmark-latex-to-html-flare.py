@@ -0,0 +1,484 @@
+'''
+Benchmark for latex-to-html-flare.py.
+Generates a synthetic LaTeX project (topics with nested \\ifx/\\else{}/\\fi, a preamble with \\newcommand
+definitions, \\ref/\\label, \\unit[], and figures), then times the string preprocessing functions, the pandoc stage,
+and the post-processing stage separately. The results are written as json, so that runs can be compared.
+With --compare-backends, the topics are also converted with both pandoc backends of the script (html and json),
+and the written files are compared (see compare_backends()). With --check, the regression checks of the script
+run too (see run_checks()), and the exit code is 1 if one of them fails.
+
+Usage: python benchmark-latex-to-html-flare.py [--topics 50] [--ifx-depth 3] [--macros 1500] ...
+The functions of latex-to-html-flare.py that need code from outside the script are reported as skipped.
+'''
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import statistics
+import difflib
+import importlib.util
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+script_path = script_dir + '/latex-to-html-flare.py'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark for latex-to-html-flare.py with a synthetic LaTeX project.')
+    parser.add_argument('--topics', type=int, default=50, help='number of topic tex files')
+    parser.add_argument('--paragraphs', type=int, default=40, help='paragraphs per topic')
+    parser.add_argument('--ifx-depth', type=int, default=3, help='nesting depth of \\ifx/\\else{}/\\fi')
+    parser.add_argument('--ifx-per-topic', type=int, default=10, help='top-level \\ifx blocks per topic')
+    parser.add_argument('--macros', type=int, default=1500, help='\\newcommand definitions in the preamble')
+    parser.add_argument('--macro-uses', type=int, default=60, help='macro uses per topic')
+    parser.add_argument('--refs-per-topic', type=int, default=20, help='\\ref and \\label pairs per topic')
+    parser.add_argument('--figures-per-topic', type=int, default=5, help='figures per topic')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per timed stage')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--work-dir', default='benchmark_work', help='directory for the generated project')
+    parser.add_argument('--output', default=None, help='json results file (default: benchmark_results/<time>.json)')
+    parser.add_argument('--no-pandoc', action='store_true', help='skip the pandoc stage')
+    parser.add_argument('--compare-backends', action='store_true',
+                        help='convert the topics with the html and the json pandoc backends and compare the files')
+    parser.add_argument('--check', action='store_true', help='run the regression checks of the script')
+    return parser.parse_args()
+
+
+def macro_name(i):
+    # Macro names can't have digits in LaTeX
+    name = ''
+    i += 1
+    while i:
+        i, rest = divmod(i - 1, 26)
+        name = chr(ord('a') + rest) + name
+    return 'bench' + name
+
+
+# latex_conditions: category -> values, as in latex-to-html-flare.py
+def make_ifx_block(rnd, depth, text_maker, latex_conditions):
+    category = rnd.choice(sorted(latex_conditions))
+    value = rnd.choice(latex_conditions[category])
+    inner = text_maker(in_ifx=True)
+    if depth > 1:
+        inner += '\n\n' + make_ifx_block(rnd, depth - 1, text_maker, latex_conditions) + '\n\n'
+    block = '\\ifx\\' + category + '\\' + value + ' ' + inner
+    if rnd.random() < 0.5:
+        block += ' \\else{} ' + text_maker(in_ifx=True)
+    return block + ' \\fi'
+
+
+def make_topic(rnd, args, topic_num, macro_names, latex_conditions):
+    labels = ['sec:t' + str(topic_num) + '_' + str(i) for i in range(args.refs_per_topic)]
+
+    # Inside \ifx, macros are used without {}
+    def text_maker(in_ifx=False):
+        words = []
+        for _ in range(rnd.randint(8, 30)):
+            if macro_names and rnd.random() < args.macro_uses / (args.paragraphs * 20.0):
+                words.append('\\' + rnd.choice(macro_names) + ('' if in_ifx else rnd.choice(['', '{}'])))
+            else:
+                word = rnd.choice(['the', 'device', 'signal', 'value', 'is', 'set', 'to', 'mm', 'unit'])
+                if word == 'unit':
+                    # For the unit_commands transform (\unit[value]{unit} -> \unit{value}{unit})
+                    word = '\\unit[' + str(rnd.randint(1, 500)) + ']{mm}'
+                words.append(word)
+        return ' '.join(words)
+
+    parts = ['\\section{Topic ' + str(topic_num) + '}\\label{sec:topic' + str(topic_num) + '}']
+    blocks_left = args.ifx_per_topic
+    labels_left = list(labels)
+    figures_left = args.figures_per_topic
+    for paragraph_num in range(args.paragraphs):
+        paragraph = text_maker()
+        if labels_left and rnd.random() < len(labels) / float(args.paragraphs):
+            paragraph = '\\subsection{Part ' + str(paragraph_num) + '}\\label{' + labels_left.pop() + '}\n\n' + paragraph
+        if labels and rnd.random() < len(labels) / float(args.paragraphs):
+            paragraph += ' See \\ref{' + rnd.choice(labels) + '}.'
+        if blocks_left and rnd.random() < args.ifx_per_topic / float(args.paragraphs):
+            paragraph += '\n\n' + make_ifx_block(rnd, args.ifx_depth, text_maker, latex_conditions)
+            blocks_left -= 1
+        if figures_left and rnd.random() < args.figures_per_topic / float(args.paragraphs):
+            figure_num = rnd.randint(0, max(args.figures_per_topic * 4, 1))
+            paragraph += ('\n\n\\begin{figure}\\includegraphics{figures/fig' + str(figure_num) + '}'
+                          '\\caption{Figure ' + str(figure_num) + '}\\label{fig:' + str(topic_num) + '_'
+                          + str(figures_left) + '}\\end{figure}')
+            figures_left -= 1
+        parts.append(paragraph)
+    return '\n\n'.join(parts) + '\n'
+
+
+# Writes the config files that latex-to-html-flare.py reads at import time
+def write_config(args):
+    if os.path.isdir(args.work_dir):
+        shutil.rmtree(args.work_dir)
+    os.makedirs(args.work_dir + '/source/latex-files/figures')
+    config = {
+        "config": {
+            "language": "en",
+            "source_root_dir": os.path.abspath(args.work_dir + '/source') + '/',
+            "flare_root_dir": os.path.abspath(args.work_dir + '/flare') + '/',
+            "unit_commands": ["unit"],
+            "post_process_workers": 1
+        },
+        "preamble": [{"path": "latex-files/preamble.tex", "type": "preamble"}],
+        "toc": [{"path": "latex-files/topic" + str(i) + ".tex"} for i in range(args.topics)]
+    }
+    with open(args.work_dir + '/config.json', 'w', encoding='utf-8') as file:
+        json.dump(config, file, indent=4)
+    graphics_size_map = {"graphic_size_map": {"null": {"flare_class": "img-default"}}}
+    with open(args.work_dir + '/config_file_graphics_size_map.json', 'w', encoding='utf-8') as file:
+        json.dump(graphics_size_map, file, indent=4)
+
+
+# Writes the synthetic tex files (the conditions come from the script, so that \else{} can be processed).
+# Returns the list of topic texts and the preamble text.
+def generate_corpus(args, latex_conditions):
+    rnd = random.Random(args.seed)
+    tex_dir = args.work_dir + '/source/latex-files/'
+    macro_names = [macro_name(i) for i in range(args.macros)]
+    preamble_lines = []
+    for i, name in enumerate(macro_names):
+        if i % 10 == 9:
+            # Commands with arguments are left as they are
+            preamble_lines.append('\\newcommand{\\' + name + '}[1]{Value #1 ' + str(i) + '}')
+        else:
+            preamble_lines.append('\\newcommand{\\' + name + '}{Value ' + str(i) + '}')
+    preamble = '\n'.join(preamble_lines) + '\n'
+    with open(tex_dir + 'preamble.tex', 'w', encoding='utf-8') as file:
+        file.write(preamble)
+    topics = []
+    for topic_num in range(args.topics):
+        topic = make_topic(rnd, args, topic_num, macro_names, latex_conditions)
+        topics.append(topic)
+        with open(tex_dir + 'topic' + str(topic_num) + '.tex', 'w', encoding='utf-8') as file:
+            file.write(topic)
+    return topics, preamble
+
+
+# Imports latex-to-html-flare.py as a module. The script reads its config at import time, and its execution
+# part is under if __name__ == '__main__', so importing runs nothing else.
+def import_script(work_dir):
+    sys.argv = [script_path, 'config.json', '--no-cache']
+    os.chdir(work_dir)
+    spec = importlib.util.spec_from_file_location('latex_to_html_flare', script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # The benchmark texts are balanced, but nothing should wait for input
+    module.prompt_on_warnings = False
+    return module
+
+
+# Runs func(item) for each item, repeat times. Returns the timing dict.
+# A function that needs code from outside latex-to-html-flare.py (NameError) is reported as skipped.
+def time_stage(func, items, repeat):
+    runs = []
+    for _ in range(repeat):
+        time_start = time.perf_counter()
+        try:
+            for item in items:
+                func(item)
+        except NameError as error:
+            return {"skipped": str(error)}
+        runs.append(time.perf_counter() - time_start)
+    stage = {
+        "calls_per_run": len(items),
+        "runs": runs,
+        "min": min(runs),
+        "median": statistics.median(runs)
+    }
+    return stage
+
+
+def time_string_stages(module, topics, preamble, repeat):
+    stages = {}
+    newcommand_data = module.process_newcommand(preamble)
+    comms_to_replace = {'all_comms_to_replace': sorted(newcommand_data['commands_to_replace'])}
+    stages['process_newcommand'] = time_stage(module.process_newcommand, [preamble], repeat)
+    stages['get_indices_start_end'] = time_stage(
+        lambda text: module.get_indices_start_end(text, '\\ifx', '\\fi'), topics, repeat)
+    stages['replace_conditionals'] = time_stage(module.replace_conditionals, topics, repeat)
+    stages['rewrite_commands'] = time_stage(
+        lambda text: module.rewrite_commands(text, module.preproc_command_transforms), topics, repeat)
+    stages['macros_to_plaintext'] = time_stage(
+        lambda text: module.macros_to_plaintext(text, comms_to_replace), topics, repeat)
+    return stages, comms_to_replace
+
+
+# The latex that the pandoc and post-processing stages get: the string stages of preproc_tex()
+# that don't need code from outside the script.
+def preprocess_topics(module, topics, comms_to_replace, command_transforms=None):
+    if command_transforms is None:
+        command_transforms = module.preproc_command_transforms
+    preprocessed = []
+    for topic in topics:
+        text = module.replace_conditionals(topic)
+        text = module.rewrite_commands(text, command_transforms)
+        text = module.macros_to_plaintext(text, comms_to_replace)
+        text = module.replace_newcommand(text, comms_to_replace)
+        preprocessed.append(text)
+    return preprocessed
+
+
+def time_pandoc_stages(module, preprocessed, repeat):
+    stages = {}
+    stages['pandoc_per_topic'] = time_stage(module.convert_from_string, preprocessed, repeat)
+    stages['pandoc_batched'] = time_stage(module.convert_from_string_batch, [preprocessed], repeat)
+    return stages
+
+
+# Pandoc-like html for the post-processing stage when pandoc is not available
+def synthetic_html(rnd, topic_num):
+    parts = ['<h1 id="TEXLABELsec:topic' + str(topic_num) + '">Topic</h1>']
+    for i in range(40):
+        paragraph = '<p>Some text TEXREFSTARTsec:t' + str(topic_num) + '_' + str(i % 7) + 'TEXREFEND and more'
+        if rnd.random() < 0.3:
+            paragraph += ' <span style="color: IFXCOND_product_SEP_prodA">conditional TEXCOMMSTARTbenchaTEXCOMMEND</span>'
+        parts.append(paragraph + '</p>')
+        if rnd.random() < 0.2:
+            parts.append('<div style="color: IFXCOND_productNumber_SEP_n100"><p>block</p><p>block</p></div>')
+        if rnd.random() < 0.1:
+            parts.append('<h2 class="unnumbered">Part<span id="TEXLABELsec:p' + str(i) + '" label="x"></span></h2>')
+    return '\n'.join(parts) + '\n'
+
+
+def post_process_steps(module, source_htm):
+    xml_root = module.xml_create_root(source_htm)
+    body_elem = xml_root.find('body')
+    module.post_process_text_markers(body_elem)
+    module.post_process_div_span_cond(body_elem)
+    module.post_mc_keyword(body_elem)
+    module.post_process_snippet_markers(xml_root, 'snippets-latex')
+    module.post_move_cond_to_parent(xml_root)
+    module.post_process_1(xml_root)
+    module.post_strip_empty_elems(xml_root)
+    module.collect_elems_by_tag(xml_root)
+    module.xml_writer.indent_xml(xml_root, module.inline_tags)
+    return module.etree.tostring(xml_root, encoding="UTF-8")
+
+
+# The elements of a written file with the whitespace normalized, one element per line. The pandoc html writer
+# and the tree from the AST put other whitespace between the elements, which Flare ignores.
+def normalized_lines(module, filepath):
+    root = module.etree.parse(filepath, parser=module.parser_xml).getroot()
+    for elem in root.iter():
+        if elem.text is not None:
+            elem.text = ' '.join(elem.text.split()) or None
+        if elem.tail is not None:
+            elem.tail = ' '.join(elem.tail.split()) or None
+    return module.etree.tostring(root, encoding='unicode', pretty_print=True).splitlines()
+
+
+# The tree of the pandoc output of the backend, post-processed with the steps of post_process_steps()
+# (the steps that don't need code from outside the script)
+def post_process_backend_steps(module, backend, source):
+    if backend == 'json':
+        xml_root = module.xml_create_root_from_ast(source)
+    else:
+        xml_root = module.xml_create_root(source)
+    body_elem = xml_root.find('body')
+    if backend == 'html':
+        module.post_process_text_markers(body_elem)
+    module.post_process_div_span_cond(body_elem)
+    module.post_mc_keyword(body_elem)
+    module.post_process_snippet_markers(xml_root, 'snippets-latex')
+    module.post_move_cond_to_parent(xml_root)
+    module.post_process_1(xml_root)
+    module.post_strip_empty_elems(xml_root)
+    return xml_root
+
+
+# The parity check of the pandoc backends (see pandoc_backend in the script). Each topic is preprocessed and
+# converted with the html backend and with the json backend, post-processed with post_process_backend_steps(),
+# and written to compare/html/ and compare/json/ in the work directory.
+# The files are compared with normalized_lines(). The differences go to compare/differences.txt.
+def compare_backends(module, topics, comms_to_replace, work_dir):
+    command_transforms = {
+        'html': module.preproc_command_transforms,
+        'json': module.preproc_command_transforms_json
+    }
+    compare_dir = work_dir + '/compare/'
+    for backend in ['html', 'json']:
+        # post_process_root() and preproc_tex() check the backend
+        module.pandoc_backend = backend
+        os.makedirs(compare_dir + backend, exist_ok=True)
+        preprocessed = preprocess_topics(module, topics, comms_to_replace, command_transforms[backend])
+        for topic_num, text in enumerate(preprocessed):
+            source = module.convert_from_string(text, output_format=module.pandoc_output_formats[backend])
+            xml_root = post_process_backend_steps(module, backend, source)
+            module.write_root(xml_root, compare_dir + backend + '/topic' + str(topic_num) + '.htm')
+    module.pandoc_backend = 'html'
+    differing_topics = []
+    with open(compare_dir + 'differences.txt', 'w', encoding='utf-8') as file:
+        for topic_num in range(len(topics)):
+            filename = 'topic' + str(topic_num) + '.htm'
+            diff_lines = list(difflib.unified_diff(normalized_lines(module, compare_dir + 'html/' + filename),
+                                                   normalized_lines(module, compare_dir + 'json/' + filename),
+                                                   'html/' + filename, 'json/' + filename, lineterm=''))
+            if diff_lines:
+                differing_topics.append(filename)
+                file.write('\n'.join(diff_lines) + '\n')
+    return differing_topics
+
+
+# The build cache: the first run converts the topic and saves it to the cache, the second run with the same source
+# and commands restores it. The conversion is only what the cache key depends on (see save_topic_to_cache()).
+def check_build_cache(module, topics, comms_to_replace, work_dir):
+    module.use_build_cache = True
+    module.build_cache_dir = work_dir + '/cache_latex-files'
+    module.comms_to_replace_all = comms_to_replace
+    restored = []
+    for _ in range(2):
+        module.build_cache_used.clear()
+        topic = module.get_topic_paths({"path": "latex-files/topic0.tex"})
+        # The source key needs the replacement config from outside the script
+        topic['source_key'] = 'check'
+        restored.append(module.restore_topic_from_cache(topic))
+        if not restored[-1]:
+            module.record_topic_macros(topic, topics[0])
+            module.check_create_folder(topic['target_topic_path'])
+            with open(topic['target_topic_filepath'], 'w', encoding='utf-8') as file:
+                file.write('<html><body><p>Topic</p></body></html>')
+            module.save_topic_to_cache(topic)
+    module.use_build_cache = False
+    if restored != [False, True]:
+        return 'restored from the cache: ' + str(restored) + ', expected: [False, True]'
+    return None
+
+
+# A paragraph with only a snippet reference in \textcolor: the condition goes to the paragraph, not to the snippetBlock
+# element (see post_process_snippet_markers() in the script)
+def check_conditional_snippet(module):
+    source_htm = '<p><span style="color: IFXCOND_product_SEP_prodA">TEXCOMMSTARTbenchaTEXCOMMEND</span></p>\n'
+    xml_root = module.etree.fromstring(post_process_steps(module, source_htm))
+    snippet_elems = list(xml_root.iter(module.mc_snippet_block_tag))
+    if len(snippet_elems) != 1:
+        return 'snippetBlock elements: ' + str(len(snippet_elems)) + ', expected: 1'
+    if module.mc_cond_attrib_name in snippet_elems[0].attrib:
+        return 'the condition is on the snippetBlock element'
+    if snippet_elems[0].getparent().tag != 'p' or module.mc_cond_attrib_name not in snippet_elems[0].getparent().attrib:
+        return 'the paragraph has no condition'
+    return None
+
+
+# The conditional snippet references with both pandoc backends, without pandoc: the html and the JSON AST that
+# pandoc writes for \textcolor around a command to replace, alone and after other text in the paragraph.
+# The files are compared as in compare_backends().
+def check_backends_conditional_snippet(module, work_dir):
+    cond_style = 'color: IFXCOND_product_SEP_prodA'
+    snippet_text = 'TEXCOMMSTARTbenchaTEXCOMMEND'
+    cond_span = {"t": "Span", "c": [["", [], [["style", cond_style]]], [{"t": "Str", "c": snippet_text}]]}
+    sources = {
+        'html': ('<p><span style="' + cond_style + '">' + snippet_text + '</span></p>\n'
+                 '<p>Text <span style="' + cond_style + '">' + snippet_text + '</span></p>\n'),
+        'json': json.dumps({"pandoc-api-version": [1, 23], "meta": {}, "blocks": [
+            {"t": "Para", "c": [cond_span]},
+            {"t": "Para", "c": [{"t": "Str", "c": "Text"}, {"t": "Space"}, cond_span]}
+        ]})
+    }
+    check_dir = work_dir + '/check/'
+    os.makedirs(check_dir, exist_ok=True)
+    for backend, source in sources.items():
+        module.write_root(post_process_backend_steps(module, backend, source), check_dir + backend + '.htm')
+    diff_lines = list(difflib.unified_diff(normalized_lines(module, check_dir + 'html.htm'),
+                                           normalized_lines(module, check_dir + 'json.htm'),
+                                           'html.htm', 'json.htm', lineterm=''))
+    if diff_lines:
+        return 'the backends differ: ' + ' '.join(diff_lines)
+    return None
+
+
+# The regression checks (--check): check name -> None, or what went wrong
+def run_checks(module, topics, comms_to_replace, work_dir):
+    checks = {}
+    checks['build_cache'] = check_build_cache(module, topics, comms_to_replace, work_dir)
+    checks['conditional_snippet'] = check_conditional_snippet(module)
+    checks['backends_conditional_snippet'] = check_backends_conditional_snippet(module, work_dir)
+    return checks
+
+
+def time_post_stages(module, sources_htm, repeat):
+    module.current_filepath = 'benchmark.htm'
+    stages = {}
+    stages['xml_create_root'] = time_stage(module.xml_create_root, sources_htm, repeat)
+    stages['post_processing'] = time_stage(lambda source_htm: post_process_steps(module, source_htm), sources_htm, repeat)
+    return stages
+
+
+def main():
+    args = parse_args()
+    args.work_dir = os.path.abspath(args.work_dir)
+    if args.output is None:
+        args.output = 'benchmark_results/' + time.strftime('%Y%m%d-%H%M%S') + '.json'
+    args.output = os.path.abspath(args.output)
+    write_config(args)
+    module = import_script(args.work_dir)
+    topics, preamble = generate_corpus(args, module.latex_conditions)
+    results = {
+        "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "corpus": {
+            "topics": args.topics,
+            "paragraphs": args.paragraphs,
+            "ifx_depth": args.ifx_depth,
+            "ifx_per_topic": args.ifx_per_topic,
+            "macros": args.macros,
+            "macro_uses": args.macro_uses,
+            "refs_per_topic": args.refs_per_topic,
+            "figures_per_topic": args.figures_per_topic,
+            "seed": args.seed,
+            "tex_chars": sum(len(topic) for topic in topics)
+        },
+        "stages": {}
+    }
+    string_stages, comms_to_replace = time_string_stages(module, topics, preamble, args.repeat)
+    results['stages'].update(string_stages)
+    preprocessed = preprocess_topics(module, topics, comms_to_replace)
+    sources_htm = None
+    if args.no_pandoc or shutil.which(module.pandoc_path) is None:
+        results['stages']['pandoc_per_topic'] = {"skipped": "pandoc is not available"}
+        results['stages']['pandoc_batched'] = {"skipped": "pandoc is not available"}
+    else:
+        results['pandoc_version'] = module.get_pandoc_version()
+        results['stages'].update(time_pandoc_stages(module, preprocessed, args.repeat))
+        sources_htm = [module.convert_from_string(text) for text in preprocessed]
+    if sources_htm is None:
+        rnd = random.Random(args.seed)
+        sources_htm = [synthetic_html(rnd, topic_num) for topic_num in range(args.topics)]
+        results['post_processing_input'] = 'synthetic html'
+    else:
+        results['post_processing_input'] = 'pandoc output'
+    results['stages'].update(time_post_stages(module, sources_htm, args.repeat))
+    if args.compare_backends:
+        if results['post_processing_input'] == 'pandoc output':
+            differing_topics = compare_backends(module, topics, comms_to_replace, args.work_dir)
+            results['backend_comparison'] = {"topics": args.topics, "differing_topics": differing_topics}
+        else:
+            results['backend_comparison'] = {"skipped": "pandoc is not available"}
+    if args.check:
+        results['checks'] = run_checks(module, topics, comms_to_replace, args.work_dir)
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=4)
+    for stage_name, stage in results['stages'].items():
+        if 'skipped' in stage:
+            print(stage_name + ': skipped (' + stage['skipped'] + ')')
+        else:
+            print(stage_name + ': ' + '%.4f' % stage['median'] + ' s (median of ' + str(len(stage['runs'])) + ')')
+    if 'skipped' in results.get('backend_comparison', {}):
+        print('backend comparison: skipped (' + results['backend_comparison']['skipped'] + ')')
+    elif 'backend_comparison' in results:
+        print('backend comparison: ' + str(len(results['backend_comparison']['differing_topics'])) + ' of '
+              + str(args.topics) + ' topics differ (see ' + args.work_dir + '/compare/differences.txt)')
+    for check_name, check_error in results.get('checks', {}).items():
+        print('check ' + check_name + ': ' + ('ok' if check_error is None else 'failed (' + check_error + ')'))
+    print('Results: ' + args.output)
+    if any(check_error is not None for check_error in results.get('checks', {}).values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
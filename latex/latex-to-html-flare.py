@@ -12,14 +12,32 @@ from collections import Counter
 import pyperclip
 import copy
 import logging
+import logging.handlers
+import multiprocessing
+import concurrent.futures
 import string
+import re
+import uuid
+import hashlib
+import bisect
+import functools
+import time
+import csv
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import xml_writer
+import snippet_index
 
-logging.basicConfig(level=logging.INFO, filename='latex_to_flare.log', filemode='w')
 parser_xml = etree.XMLParser(strip_cdata=False)
 dir_sep = "/"
 config_file = sys.argv[1]
 config_file_graphics_items = 'config_file_graphics_items.json'
+config_file_graphics_index = 'config_file_graphics_index.json'
 config_file_graphics_size_map = 'config_file_graphics_size_map.json'
+run_report_json = 'latex_to_flare_report.json'
+run_report_csv = 'latex_to_flare_report.csv'
+xref_report = 'latex_to_flare_xrefs.json'
 with open(config_file_graphics_size_map, encoding="utf-8") as data_file:
     graphics_size_map = json.load(data_file)
 tmp_prefix = 'temp1_'
@@ -32,12 +50,78 @@ language = json_data['config']['language']
 language_en = 'en'
 source_root_dir = json_data['config']['source_root_dir'].replace('\\', dir_sep)
 flare_root_dir = json_data['config']['flare_root_dir'].replace('\\', dir_sep)
-flare_dir_content = flare_root_dir + 'Content/from-latex/'
+flare_dir_content_root = flare_root_dir + 'Content/'
+flare_dir_content = flare_dir_content_root + 'from-latex/'
 flare_dir_project = flare_root_dir + 'Project/'
 flare_dir_snippets_tex = flare_dir_content + 'snippets-latex/'
+# The TOC of the topics from the 'toc' entries of the config (see convert_toc_entries())
+flare_toc_filepath = flare_dir_project + 'TOCs/' + json_data['config'].get('toc_filename', 'from-latex.fltoc')
 
 pandoc_path = 'pandoc'
 pandoc_logs_dir = 'pandoc_logs'
+# 'html' (default): pandoc writes html5, and the markers in the text are turned into elements after parsing it.
+# 'json': pandoc writes its JSON AST, and the tree is built from it (see xml_create_root_from_ast()). Only \ref
+# is mapped from the AST, the labels, the conditions, and the TEXCOMM strings still go through the markers.
+# To compare the backends, run benchmark-latex-to-html-flare.py with --compare-backends.
+pandoc_backend = json_data['config'].get('pandoc_backend', 'html')
+pandoc_output_formats = {'html': 'html5', 'json': 'json'}
+pandoc_output_format = pandoc_output_formats[pandoc_backend]
+# If set in the config, convert_topics_batched() converts this many topics with one pandoc process
+pandoc_batch_size = json_data['config'].get('pandoc_batch_size', 0)
+# The number of pandoc processes that run at the same time (see convert_topics()). A pandoc process that takes
+# longer than pandoc_timeout seconds is killed. A failed conversion is tried pandoc_retries more times.
+pandoc_workers = json_data['config'].get('pandoc_workers', os.cpu_count() or 1)
+pandoc_timeout = json_data['config'].get('pandoc_timeout', 300)
+pandoc_retries = json_data['config'].get('pandoc_retries', 1)
+batch_split_marker = 'FLAREBATCHSPLIT'
+# Commands that change the state of pandoc for the rest of the input (macro definitions, footnote numbering).
+# Topics with these commands are not batched and are converted one by one.
+batch_unsafe_commands = ['\\newcommand', '\\renewcommand', '\\providecommand', '\\def', '\\let', '\\footnote',
+                         '\\newenvironment', '\\DeclareMathOperator']
+# The incremental build cache: post-processed topics by the hash of everything they depend on
+# (see get_topic_cache_key()). Run with --no-cache to convert all topics.
+build_cache_dir = 'cache_latex-files'
+use_build_cache = '--no-cache' not in sys.argv[2:]
+# The cache entry of each topic in this run by report key. The other entries are removed (see prune_build_cache()).
+build_cache_used = {}
+# The macro dependency graph, kept across runs (see record_topic_macros() and update_macro_definitions()):
+# * topics: report key -> {"source_key": ..., "commands": the \commands in the text before the macro replacement,
+#   "macros": the commands to replace that the topic uses}
+# * definitions: command to replace -> hash of its \newcommand definitions
+# * snippets: command to replace -> the .flsnp file generated from it
+macro_deps_file = 'macro_deps.json'
+macro_deps = {"topics": {}, "definitions": {}, "snippets": {}}
+command_name_pattern = re.compile('\\\\[A-Za-z@]+')
+# The preprocessed tex files, pandoc html output, and the newcommand json files are kept in memory.
+# With --keep-intermediates they are also written to tmp_root_dir for debugging.
+keep_intermediates = '--keep-intermediates' in sys.argv[2:]
+# With --reuse-graphics-index, the graphics index from the previous run is loaded instead of scanning source_root_dir
+reuse_graphics_index = '--reuse-graphics-index' in sys.argv[2:]
+# With --watch, the script keeps running after the full conversion and polls the source files of the preamble
+# and toc entries every watch_poll_interval seconds. Only the changed entries are converted again
+# (see watch_source_files()). The config is read once, so a change of the config needs a new run.
+watch_mode = '--watch' in sys.argv[2:]
+watch_poll_interval = json_data['config'].get('watch_poll_interval', 1.0)
+# The number of processes for the final post-processing of the Content directory (see post_process_content())
+post_process_content_workers = json_data['config'].get('post_process_workers', os.cpu_count() or 1)
+# Threads for copying the images (see copy_graphics()). With graphics_copy_compare_hash, a target with the same size
+# but another mtime is compared by content before copying.
+graphics_copy_threads = json_data['config'].get('graphics_copy_threads', 8)
+graphics_copy_compare_hash = json_data['config'].get('graphics_copy_compare_hash', False)
+# The number of distinct condition strings to keep translated (see translate_tex_conditions())
+condition_cache_size = json_data['config'].get('condition_cache_size', 4096)
+# Waiting for Enter after a warning, so that it can be checked before going on. Off in the worker processes.
+# With --non-interactive, the warnings are only collected (see add_diagnostic()) and the run never waits.
+prompt_on_warnings = '--non-interactive' not in sys.argv[2:]
+diagnostics_report = 'latex_to_flare_diagnostics.json'
+diagnostics_snippet_length = 500
+# The warnings that needed a check, with the file, the function, and the snippet (see add_diagnostic())
+diagnostics = []
+# The file that is being processed (the tex file in preprocessing, the htm file in post-processing)
+current_filepath = ''
+pandoc_version = None
+with open(__file__, 'rb') as script_file:
+    script_hash = hashlib.sha256(script_file.read()).hexdigest()
 madcap_namespace = "http://www.madcapsoftware.com/Schemas/MadCap.xsd"
 madcap_nsmap = {"MadCap": madcap_namespace}
 labels_from_tex = {}
@@ -74,9 +158,9 @@ inline_tags = ["a", "abbr", "acronym", "b", "bdo", "big", "br", "button", "cite"
 
 # Converting the string latex input into string output.
 # Runs pandoc as subprocess and reads the console output of pandoc.
-def convert_from_string(source_latex):
+def convert_from_string(source_latex, extra_args=[], output_format='html5', timeout=None):
     source_latex_encoded = source_latex.encode('utf-8')
-    args = ['pandoc', '--from=latex', '--to=html5']
+    args = [pandoc_path, '--from=latex', '--to=' + output_format] + extra_args
     p = subprocess.Popen(
         args,
         stdin=subprocess.PIPE,
@@ -89,7 +173,11 @@ def convert_from_string(source_latex):
         )
 
     try:
-        stdout, stderr = p.communicate(source_latex_encoded)
+        stdout, stderr = p.communicate(source_latex_encoded, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        p.kill()
+        p.communicate()
+        raise RuntimeError('Pandoc did not finish in %s seconds.' % timeout)
     except OSError:
         raise RuntimeError('Pandoc terminated with exitcode "%s" during conversion.' % (p.returncode))
 
@@ -106,39 +194,170 @@ def convert_from_string(source_latex):
     return stdout.replace('\r\n', '\n')
 
 
-# Just beautifies xml.
-def indent_xml(elem, level=0, more_sibs=False):
-    i = "\n"
-    empty_spaces = "    "
-    if level:
-        i += (level - 1) * empty_spaces
-    num_children = len(elem)
-    if num_children:
-        if not elem.text or not elem.text.strip():
-            if elem.getchildren()[0].tag not in inline_tags:
-                elem.text = i + empty_spaces
-                if level:
-                    elem.text += empty_spaces
-        count = 0
-        for child in elem:
-            if child.tag not in inline_tags:
-                indent_xml(child, level + 1, count < num_children - 1)
-            count += 1
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-            if more_sibs:
-                elem.tail += empty_spaces
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
-            if more_sibs:
-                elem.tail += empty_spaces
+# Converting many latex strings with one pandoc process.
+# Each source gets a unique sentinel paragraph in front of it, pandoc outputs it as <p>sentinel</p>,
+# and the output is split back on these paragraphs. Returns the list of html strings. The list has None
+# for the sources that could not be split back reliably (a mangled sentinel, for example, after an unclosed
+# environment, or a heading id that pandoc changed because of a heading in another source).
+# Convert these sources one by one. With output_format 'json', see split_batch_json().
+def convert_from_string_batch(sources_latex, extra_args=[], output_format='html5', timeout=None):
+    batch_id = uuid.uuid4().hex
+    sentinels = [batch_split_marker + batch_id + 'N' + str(i) + 'E' for i in range(len(sources_latex))]
+    batch_parts = []
+    for i, source_latex in enumerate(sources_latex):
+        batch_parts.append('\n\n' + sentinels[i] + '\n\n' + source_latex)
+    batch_html = convert_from_string(''.join(batch_parts), extra_args, output_format, timeout)
+    if output_format == 'json':
+        return split_batch_json(batch_html, sentinels)
+    # Finding the sentinel paragraphs. A sentinel is valid only if it's found exactly once as a paragraph.
+    sentinel_positions = []
+    for sentinel in sentinels:
+        sentinel_paragraph = '<p>' + sentinel + '</p>\n'
+        ind = batch_html.find(sentinel_paragraph)
+        if ind == -1 or batch_html.count(sentinel) != 1:
+            sentinel_positions.append(None)
+        else:
+            sentinel_positions.append([ind, ind + len(sentinel_paragraph)])
+    sentinel_positions.append([len(batch_html), len(batch_html)])
+    results = []
+    ids_in_batch = set()
+    for i in range(len(sources_latex)):
+        part_start = sentinel_positions[i]
+        part_end = sentinel_positions[i + 1]
+        if part_start is None or part_end is None or part_start[1] > part_end[0]:
+            results.append(None)
+            continue
+        part_html = batch_html[part_start[1]:part_end[0]]
+        # pandoc makes heading ids unique in the whole document by adding -1, -2, and so on.
+        # If an id could have been changed because of an id in a previous source, the part is not reliable.
+        part_ids = re.findall(' id="([^"]*)"', part_html)
+        for part_id in part_ids:
+            id_base = re.sub('-[0-9]+$', '', part_id)
+            if id_base != part_id and id_base in ids_in_batch:
+                part_html = None
+                break
+        ids_in_batch.update(part_ids)
+        results.append(part_html)
+    return results
+
+
+# The JSON version of the split in convert_from_string_batch(). The sentinels are the Para blocks
+# with only the sentinel Str. Returns a JSON document (as a string) for each source, or None.
+def split_batch_json(batch_json, sentinels):
+    batch_ast = json.loads(batch_json)
+    blocks = batch_ast['blocks']
+    sentinel_blocks = {}
+    for ind, block in enumerate(blocks):
+        if block['t'] == 'Para' and len(block['c']) == 1 and block['c'][0]['t'] == 'Str':
+            sentinel_blocks.setdefault(block['c'][0]['c'], []).append(ind)
+    sentinel_positions = []
+    for sentinel in sentinels:
+        if len(sentinel_blocks.get(sentinel, [])) != 1 or batch_json.count(sentinel) != 1:
+            sentinel_positions.append(None)
+        else:
+            ind = sentinel_blocks[sentinel][0]
+            sentinel_positions.append([ind, ind + 1])
+    sentinel_positions.append([len(blocks), len(blocks)])
+    results = []
+    ids_in_batch = set()
+    for i in range(len(sentinels)):
+        part_start = sentinel_positions[i]
+        part_end = sentinel_positions[i + 1]
+        if part_start is None or part_end is None or part_start[1] > part_end[0]:
+            results.append(None)
+            continue
+        part_ast = {key: value for key, value in batch_ast.items() if key != 'blocks'}
+        part_ast['blocks'] = blocks[part_start[1]:part_end[0]]
+        part_json = json.dumps(part_ast, ensure_ascii=False)
+        # The same check of the heading ids as for html
+        part_ids = re.findall('"t": "Header", "c": \\[[0-9]+, \\["((?:[^"\\\\]|\\\\.)*)"', part_json)
+        for part_id in part_ids:
+            id_base = re.sub('-[0-9]+$', '', part_id)
+            if id_base != part_id and id_base in ids_in_batch:
+                part_json = None
+                break
+        ids_in_batch.update(part_ids)
+        results.append(part_json)
+    return results
 
 
 def check_create_folder(directory):
     pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
 
 
+# Run statistics: wall time, calls, and bytes in/out for each stage, and the same per topic
+# (see start_timer(), record_lap(), and write_run_report()).
+run_stats = {"stages": {}, "topics": {}, "counters": {}}
+# The pandoc threads record their stages too (see convert_topics())
+run_stats_lock = threading.Lock()
+
+
+# The topics are identified by their .htm path in the Content directory (the same for all stages)
+def get_report_key(filepath):
+    return os.path.relpath(filepath, flare_dir_content).replace('\\', dir_sep)
+
+
+def start_timer(report_key=None):
+    return {"report_key": report_key, "time": time.perf_counter()}
+
+
+# Records the time since the previous lap (or since start_timer()) for the stage
+def record_lap(timer, stage_name, bytes_in=0, bytes_out=0):
+    time_now = time.perf_counter()
+    record_stage(stage_name, time_now - timer['time'], timer['report_key'], bytes_in, bytes_out)
+    timer['time'] = time_now
+
+
+def record_stage(stage_name, seconds, report_key=None, bytes_in=0, bytes_out=0):
+    with run_stats_lock:
+        if stage_name not in run_stats['stages']:
+            run_stats['stages'][stage_name] = {"calls": 0, "seconds": 0.0, "bytes_in": 0, "bytes_out": 0}
+        stage_stats = run_stats['stages'][stage_name]
+        stage_stats['calls'] += 1
+        stage_stats['seconds'] += seconds
+        stage_stats['bytes_in'] += bytes_in
+        stage_stats['bytes_out'] += bytes_out
+        if report_key is not None:
+            if report_key not in run_stats['topics']:
+                run_stats['topics'][report_key] = {"seconds": 0.0, "bytes_in": 0, "bytes_out": 0, "stages": {}}
+            topic_stats = run_stats['topics'][report_key]
+            topic_stats['seconds'] += seconds
+            topic_stats['stages'][stage_name] = topic_stats['stages'].get(stage_name, 0.0) + seconds
+            # Bytes per topic: what goes into the first stage and what comes out of the last one
+            topic_stats['bytes_in'] = max(topic_stats['bytes_in'], bytes_in)
+            if bytes_out:
+                topic_stats['bytes_out'] = bytes_out
+
+
+def count(counter_name, number=1):
+    with run_stats_lock:
+        run_stats['counters'][counter_name] = run_stats['counters'].get(counter_name, 0) + number
+
+
+# Writes the stages and the topics sorted by time (the slowest first) as json and csv,
+# and prints the slowest topics.
+def write_run_report(slowest_to_print=10):
+    stages_sorted = sorted(run_stats['stages'].items(), key=lambda item: item[1]['seconds'], reverse=True)
+    topics_sorted = sorted(run_stats['topics'].items(), key=lambda item: item[1]['seconds'], reverse=True)
+    run_report = {
+        "stages": [dict(stage=stage_name, **stage_stats) for stage_name, stage_stats in stages_sorted],
+        "topics": [dict(topic=report_key, **topic_stats) for report_key, topic_stats in topics_sorted],
+        "counters": run_stats['counters']
+    }
+    with open(run_report_json, 'w', encoding='utf-8') as file:
+        json.dump(run_report, file, indent=4)
+    stage_names = [stage_name for stage_name, stage_stats in stages_sorted]
+    with open(run_report_csv, 'w', encoding='utf-8', newline='') as file:
+        csv_writer = csv.writer(file)
+        csv_writer.writerow(['topic', 'seconds', 'bytes_in', 'bytes_out'] + stage_names)
+        for report_key, topic_stats in topics_sorted:
+            csv_writer.writerow([report_key, '%.4f' % topic_stats['seconds'], topic_stats['bytes_in'], topic_stats['bytes_out']]
+                                + ['%.4f' % topic_stats['stages'].get(stage_name, 0.0) for stage_name in stage_names])
+    print('Slowest topics (see ' + run_report_json + ' and ' + run_report_csv + '):')
+    for report_key, topic_stats in topics_sorted[:slowest_to_print]:
+        print('%8.2f s  ' % topic_stats['seconds'] + report_key)
+
+
 # This function returns the value between given markers. If there are no markers in input, returns None.
 # Assumptions: There are no nested or unbalanced markers.
 def get_value_between_markers(input_string, marker_start, marker_end):
@@ -190,18 +409,40 @@ def get_next_comm_string(source_text, position, include_start_substring=False, i
     return next_string, ind_next_delimiter, current_token
 
 
+# Records a warning that needs a check. Waits for Enter only if prompt_on_warnings is set.
+def add_diagnostic(function_name, message, snippet):
+    print('WARNING: ' + message + ' ' + snippet)
+    logging.warning(message + ' ' + snippet)
+    diagnostics.append({
+        "file": current_filepath,
+        "function": function_name,
+        "message": message,
+        "snippet": snippet[:diagnostics_snippet_length]
+    })
+    if prompt_on_warnings:
+        input()
+
+
+def write_diagnostics_report():
+    with open(diagnostics_report, 'w', encoding='utf-8') as file:
+        json.dump(diagnostics, file, indent=4)
+    if diagnostics:
+        print('Warnings to check: ' + str(len(diagnostics)) + ' (see ' + diagnostics_report + ')')
+
+
+def warn_unbalanced_markers(full_string, function_name):
+    add_diagnostic(function_name, 'Possibly unbalanced start/end markers:', full_string)
+
+
 def find_nth(full_string, substring, n):
     start = full_string.find(substring)
-    if full_string.count(substring) < n:
-        print('WARNING: Possibly unbalanced start/end markers: ' + full_string)
-        logging.warning('Possibly unbalanced start/end markers: ' + full_string)
-        input()
+    while start >= 0 and n > 1:
+        start = full_string.find(substring, start + len(substring))
+        n -= 1
+    if start == -1:
+        warn_unbalanced_markers(full_string, 'find_nth')
         return len(full_string) - 1
-    else:
-        while start >= 0 and n > 1:
-            start = full_string.find(substring, start + len(substring))
-            n -= 1
-        return start
+    return start
 
 
 # This function replaces a substring in a string searching from a certain index
@@ -220,16 +461,92 @@ def bracket_extra_space(full_text, end_marker):
     return bracket_space
 
 
+# Returns True if the end of the string is also its beginning (for example, '%%').
+# Occurrences of such strings can overlap, so they can't be counted from a marker index.
+def string_has_border(marker_string):
+    for i in range(1, len(marker_string)):
+        if marker_string[:i] == marker_string[-i:]:
+            return True
+    return False
+
+
+# Returns the positions of all start and end substrings in the text. The text is scanned once per substring,
+# after that get_indices_start_end() finds pairs and counts markers with binary search instead of
+# reslicing and recounting the text.
+def build_marker_index(text, start_string, end_string):
+    marker_index = {
+        "start_string": start_string,
+        "end_string": end_string,
+        "starts": findall(text, start_string),
+        "ends": findall(text, end_string)
+    }
+    return marker_index
+
+
+# Returns the number of markers (positions from the marker index) that are completely inside text[ind_from:ind_to]
+def count_markers_between(positions, marker_len, ind_from, ind_to):
+    return max(0, bisect.bisect_right(positions, ind_to - marker_len) - bisect.bisect_left(positions, ind_from))
+
+
 # Returns the list of start and end indices for the given start and end substrings
 # in the given text string. If there are nested start-end pairs, the function returns
 # the indices for the parent pairs.
 # NOTE: the end index is the end of the substring, not the index of the beginning of the end string
-def get_indices_start_end(text, start_string, end_string):
+# how_many: stop after this number of pairs (-1 means all pairs).
+# position: start searching from this index (the returned indices are still indices in text).
+# marker_index: the result of build_marker_index() for the same text and substrings, if you already have it.
+def get_indices_start_end(text, start_string, end_string, how_many=-1, position=0, marker_index=None):
+    if marker_index is None:
+        if string_has_border(start_string) or string_has_border(end_string):
+            indices = get_indices_start_end_by_slicing(text[position:], start_string, end_string, how_many)
+            return [[ind[0] + position, ind[1] + position] for ind in indices]
+        marker_index = build_marker_index(text, start_string, end_string)
+    starts = marker_index['starts']
+    ends = marker_index['ends']
+    len_start = len(start_string)
+    len_end = len(end_string)
+    marker_text_cut = position
+    indices = []
+    while len(indices) != how_many:
+        ind_next_start = bisect.bisect_left(starts, marker_text_cut)
+        if ind_next_start == len(starts):
+            break
+        marker_start = starts[ind_next_start]
+        ind_next_end = bisect.bisect_left(ends, marker_text_cut)
+        if ind_next_end == len(ends):
+            marker_end = marker_text_cut - 1 + len_end
+        else:
+            marker_end = ends[ind_next_end] + len_end
+        marker_end = marker_end + bracket_extra_space(text, marker_end)
+        # Searching for the closing command
+        start_string_count = count_markers_between(starts, len_start, marker_start, marker_end)
+        end_string_count = count_markers_between(ends, len_end, marker_start, marker_end)
+        while start_string_count - end_string_count > 0:
+            ind_nth_end = bisect.bisect_left(ends, marker_end) + start_string_count - end_string_count - 1
+            if ind_nth_end >= len(ends):
+                warn_unbalanced_markers(text[marker_end:], 'get_indices_start_end')
+                marker_end = max(marker_end, len(text)) - 1 + len_end
+                break
+            marker_end = ends[ind_nth_end] + len_end
+            marker_end = marker_end + bracket_extra_space(text, marker_end)
+            start_string_count = count_markers_between(starts, len_start, marker_start, marker_end)
+            end_string_count = count_markers_between(ends, len_end, marker_start, marker_end)
+        if marker_end <= marker_text_cut:
+            # There is no end marker after the start marker, the same pair would be found again
+            break
+        indices.append([marker_start, marker_end])
+        marker_text_cut = marker_end
+    return indices
+
+
+# The same as get_indices_start_end(), but reslices and recounts the text for each pair.
+# Used only for markers that can overlap themselves (see string_has_border()).
+def get_indices_start_end_by_slicing(text, start_string, end_string, how_many=-1):
     copy_file_text = text
     marker_end = 0
     marker_text_cut = 0
     indices = []
-    while copy_file_text.find(start_string) >= 0:
+    while copy_file_text.find(start_string) >= 0 and len(indices) != how_many:
         marker_start = copy_file_text.find(start_string)
         marker_end = copy_file_text.find(end_string) + len(end_string)
         bracket_space = bracket_extra_space(copy_file_text, marker_end)
@@ -245,7 +562,7 @@ def get_indices_start_end(text, start_string, end_string):
             marker_end = marker_end + bracket_space
             string_part = copy_file_text[marker_start:marker_end]
             start_string_count = string_part.count(start_string)
-            end_string_count = string_part.count(end_string)        
+            end_string_count = string_part.count(end_string)
         indices.append([marker_start + marker_text_cut, marker_end + marker_text_cut])
         marker_text_cut += marker_end
         # Reevaluating the string part after finding the new end
@@ -253,141 +570,269 @@ def get_indices_start_end(text, start_string, end_string):
     return indices
 
 
-# This function returns a list of strings containing \ifx ... \fi{} substrings
+# This function returns a list of strings between com_start and com_end (for example, \ifx ... \fi{})
 # It returns the original strings (to find them in the source text), and the new strings,
 # So that you can replace the original ones.
-# Note: it also runs process_else on the new strings
-def extract_content(file_text, com_start, com_end, how_many_to_return=-1, do_process_else=False):
+def extract_content(file_text, com_start, com_end, how_many_to_return=-1):
     copy_file_text = file_text
     string_parts_original = []
     string_parts_new = []
-    indices = get_indices_start_end(copy_file_text, com_start, com_end)
+    indices = get_indices_start_end(copy_file_text, com_start, com_end, how_many_to_return)
     if how_many_to_return:
         for i, ind in enumerate(indices):
             string_part = copy_file_text[ind[0]:ind[1]]
             string_parts_original.append(string_part)
-            if do_process_else:
-                string_parts_new.append(process_else(string_part))
-            else:
-                string_parts_new.append(string_part)
+            string_parts_new.append(string_part)
             if i == how_many_to_return - 1:
                 break
     return string_parts_original, string_parts_new
 
 
-def process_else_ifx(text):
-    new_text = text
-    else_tag = '\\else'
-    while else_tag in new_text:
-        ind_else = new_text.find(else_tag)
-        new_text = str_replace_from_index(new_text, else_tag, '\\fi', ind_else)
-        ind_fi = get_indices_start_end(new_text[ind_else:], '\\ifx', '\\fi')[0][1]
-        # Removing '\\fi' that goes further after the '\\fi' that we've just added
-        # TODO: strip the space to the right (or left?) from the removed \\fi
-        ind_next_fi = ind_else + ind_fi + new_text[ind_else + ind_fi:].find('\\fi')
-        part_1 = new_text[:ind_next_fi].rstrip()
-        part_2 = new_text[ind_next_fi:]
-        part_2 = part_2.replace('\\fi', '', 1)
-        new_text = part_1 + part_2
-    return new_text
-
-
-# This function replaces the \else{} clause with \else\ifx with the exact set of conditions
-def process_else(text):
-    else_tag = '\\else{}'
-    text_new = text
-    while else_tag in text_new:
-        ind_else = text_new.find(else_tag)
-        ind_ifx = text_new.rfind('\\ifx', 0, ind_else)
-        current_cat = get_next_comm_string(text_new, get_next_comm_string(text_new, ind_ifx)[1])
-        conditions_in_prev_ifx = {}
-        conditions_in_prev_ifx[current_cat[0]] = []
-        current_cond = get_next_comm_string(text_new, current_cat[1])
-        conditions_in_prev_ifx[current_cat[0]].append(current_cond[0])
-        while get_prev_comm_string(text_new, ind_ifx)[0] == 'else':
-            ind_ifx = text_new.rfind('\\ifx', 0, ind_ifx)
-            tex_cat = get_next_comm_string(text_new, get_next_comm_string(text_new, ind_ifx)[1])
-            tex_cond = get_next_comm_string(text_new, tex_cat[1])
-            if tex_cat[0] in conditions_in_prev_ifx:
-                conditions_in_prev_ifx[tex_cat[0]].append(tex_cond[0])
+# The \ifx, \else, and \fi commands (not \fill, \elsewhere, and so on)
+ifx_token_pattern = re.compile(r'\\(ifx|else|fi)(?![A-Za-z@])')
+# The condition after \ifx: \category\value (and {} that can follow it)
+ifx_condition_pattern = re.compile(r'\s*\\([^\\{}\[\s]+)\s*\\([^\\{}\[\s]*)(\{\})?')
+
+
+# Parses the \ifx\category\value ... \else ... \fi blocks of the text in one scan. Returns the list of the text
+# parts and the condition nodes of the top level. A node is a dict with the branches of the block:
+# {"start": index of \ifx, "branches": [{"condition": [category, value] (None for \else), "body": [parts and nodes]}],
+#  "text": the block with \textcolor{IFXCOND_...} instead of the conditions (see emit_conditional())}
+# Each node is emitted when its \fi is found, so the nested blocks are ready before the parent block.
+def parse_conditionals(text):
+    top_level = {"start": 0, "branches": [{"condition": None, "body": []}]}
+    open_nodes = [top_level]
+    position = 0
+    for token_match in ifx_token_pattern.finditer(text):
+        if token_match.start() < position:
+            # Inside the condition or the {} that has just been read
+            continue
+        current_body = open_nodes[-1]['branches'][-1]['body']
+        current_body.append(text[position:token_match.start()])
+        position = token_match.end()
+        token = token_match.group(1)
+        if token == 'ifx':
+            condition_match = ifx_condition_pattern.match(text, position)
+            if condition_match is None:
+                add_diagnostic('parse_conditionals', 'Could not read the condition of \\ifx:',
+                               text[token_match.start():token_match.start() + 100])
+                current_body.append(token_match.group(0))
+                continue
+            open_nodes.append({
+                "start": token_match.start(),
+                "branches": [{"condition": [condition_match.group(1), condition_match.group(2)], "body": []}]
+            })
+            position = condition_match.end()
+        elif len(open_nodes) == 1:
+            add_diagnostic('parse_conditionals', 'Possibly unbalanced \\ifx/\\' + token + ':',
+                           text[max(0, token_match.start() - 100):token_match.end()])
+            current_body.append(token_match.group(0))
+        else:
+            if text.startswith('{}', position):
+                position += 2
+            if token == 'else':
+                open_nodes[-1]['branches'].append({"condition": None, "body": []})
             else:
-                conditions_in_prev_ifx[tex_cat[0]] = []
-                conditions_in_prev_ifx[tex_cat[0]].append(tex_cond[0])
-        # Now when I have the list of conditions for else{}, I replace it with ifx
-        # the my_or string is for putting multiple conditions in one string
-        my_or = '_MYOR_'
-        # Creating a string with conditions to exclude separated by my_or
-        conditions_to_join = []
-        # SIMPLIFICATION: Only handling one category
-        for elem in conditions_in_prev_ifx:
-            for condition in latex_conditions[elem]:
-                if condition not in conditions_in_prev_ifx[elem]:
-                    conditions_to_join.append(condition)
-        conditions_joined = my_or.join(conditions_to_join)
-        # SIMPLIFICATION: Only handling one category
-        text_new = str_replace_from_index(text_new, else_tag, '\\else\\ifx\\' + list(conditions_in_prev_ifx.keys())[0]
-                                          + '\\' + conditions_joined, ind_else)
-        # Adding an extra '\fi'
-        text_new = str_replace_from_index(text_new, '\\fi', '\\fi\\fi', ind_else)
-    return text_new
-
-
-def replace_ifx_with_textcolor(text, start_tag, end_tag, replacement_tag):
-    new_text = text
-    indices = get_indices_start_end(new_text, start_tag, end_tag)
-    # TODO: handle nested conditions
-    for ind_pair in reversed(indices):
-        # Replacing from the end of string (to avoid index shift)
-        new_text = str_replace_from_index(new_text, end_tag, '}', ind_pair[1] - len(end_tag))
-        # Getting the index of the end of the ifx expression
-        next_ind = ind_pair[0]
-        for i in range(3):
-            next_ind = get_next_comm_string(text, next_ind)[1]
-        bracket_offset = bracket_extra_space(new_text, next_ind)
-        substring_to_replace = new_text[ind_pair[0]: next_ind + bracket_offset]
-        replacement_tag_option = substring_to_replace[:len(substring_to_replace) - bracket_offset].replace('\\ifx\\',
-                                                                                                           '')
-        replacement_tag_option = replacement_tag + '{IFXCOND_' + replacement_tag_option.replace('\\', '_SEP_') + '}{'
-        # Stripping the whitespace from what's inside ifx commands
-        part_left = new_text[:ind_pair[0] + len(substring_to_replace)]
-        part_right = new_text[ind_pair[0] + len(substring_to_replace):]
-        ind_nonwhitespace = next(i2 for i2, char in enumerate(part_right) if char not in string.whitespace)
-        if '\n' in part_right[:ind_nonwhitespace]:
-            part_right = part_right.lstrip()
-        ind_closing_br = part_right.find('}')
-        if '{' in part_right[:ind_closing_br]:
-            ind_closing_br = find_nth(part_right, '}', 2)
-        part_before_br = part_right[:ind_closing_br]
-        part_after_br = part_right[ind_closing_br:]
-        if '\n' in part_before_br[len(part_before_br.rstrip()) - len(part_before_br):]:
-            part_before_br = part_before_br.rstrip()
-        part_right = part_before_br + part_after_br
-        new_text = part_left + part_right
-        # End of striping whitespace
-        new_text = str_replace_from_index(new_text, substring_to_replace, replacement_tag_option, ind_pair[0])
-        # Handling the case where only \item element is inside \ifx
-        # NOTE: this workaround will not work if there is more than 1 \item inside,
-        # but in our project it's not more than 1
-        if '\\item' in new_text:
-            inside_condition = new_text[len(replacement_tag_option):].lstrip()
-            if inside_condition.startswith('\\item'):
-                if new_text.count('\\item') > 1:
-                    print('WARNING: More than 1 \\item commands inside \\ifx. Check the list element in ' + text + '\n')
-                    logging.warning('WARNING: More than 1 \\item commands inside \\ifx. Check the list element in ' + text)
-                else:
-                    # NOTE: It's a hack for one occurrence of ifx around \item[] in preface_en. The difference is [.
-                    # This might not work for other occurrences (that's why I'm printing a warning just in case)
-                    if inside_condition.startswith('\\item['):
-                        hack_text = replacement_tag_option[len('\\textcolor{'):-len('}{')].replace('_', '\\_')
-                        new_text = inside_condition[:-1].rstrip() + hack_text + 'IFXCONDEND'
-                        print('CAUTION: \\item[] hack. Check output: ' + new_text)
-                        logging.info('CAUTION: \\item[] hack. Check output: ' + new_text)
-                    else:
-                        item_split = new_text.split('\\item')
-                        new_text = '\\item' + item_split[0].rstrip() + item_split[1].lstrip()
-    if start_tag in new_text:
-        new_text = replace_ifx_with_textcolor(new_text, start_tag, end_tag, replacement_tag)
-    return new_text
+                node = open_nodes.pop()
+                node['text'] = emit_conditional(node)
+                open_nodes[-1]['branches'][-1]['body'].append(node)
+    open_nodes[-1]['branches'][-1]['body'].append(text[position:])
+    while len(open_nodes) > 1:
+        node = open_nodes.pop()
+        add_diagnostic('parse_conditionals', 'Possibly unbalanced \\ifx/\\fi (no \\fi):',
+                       text[node['start']:node['start'] + 100])
+        node['text'] = emit_conditional(node)
+        open_nodes[-1]['branches'][-1]['body'].append(node)
+    return top_level['branches'][0]['body']
+
+
+# Returns the branches of the block, with \else\ifx ... chains as more branches of the same block.
+# An \else that contains only another block is the same as the branches of that block.
+# Also returns the whitespace before the \fi of the block (after the last block of the chain).
+def get_chain_branches(node):
+    branches = node['branches']
+    closing_whitespace = None
+    while branches[-1]['condition'] is None:
+        else_items = [item for item in branches[-1]['body'] if not (isinstance(item, str) and item.strip() == '')]
+        if len(else_items) != 1 or isinstance(else_items[0], str):
+            break
+        if closing_whitespace is None:
+            else_body = branches[-1]['body']
+            closing_whitespace = ''.join(else_body[else_body.index(else_items[0]) + 1:])
+        branches = branches[:-1] + else_items[0]['branches']
+    return branches, closing_whitespace or ''
+
+
+# Returns the list of [category, values] for each branch. A branch applies if its own condition is true
+# and the conditions of all branches before it are false. Within a category, the values exclude each other,
+# so the false conditions of other categories are added as the rest of their values from latex_conditions.
+# \else gets the rest of the values for each category before it.
+def get_branch_conditions(branches):
+    excluded_values = {}
+    branch_conditions = []
+    for branch in branches:
+        conditions = []
+        own_category = None
+        if branch['condition'] is not None:
+            own_category = branch['condition'][0]
+            conditions.append([own_category, [branch['condition'][1]]])
+        for category in excluded_values:
+            if category == own_category:
+                continue
+            if category not in latex_conditions:
+                add_diagnostic('get_branch_conditions', 'The condition category is not in latex_conditions:', category)
+                continue
+            conditions.append([category, [value for value in latex_conditions[category]
+                                          if value not in excluded_values[category]]])
+        branch_conditions.append(conditions)
+        if own_category is not None:
+            if own_category not in excluded_values:
+                excluded_values[own_category] = []
+            excluded_values[own_category].append(branch['condition'][1])
+    return branch_conditions
+
+
+def emit_conditional(node):
+    branches, closing_whitespace = get_chain_branches(node)
+    emitted_branches = []
+    for i, (branch, conditions) in enumerate(zip(branches, get_branch_conditions(branches))):
+        body = ''.join(item if isinstance(item, str) else item['text'] for item in branch['body'])
+        # The last branch after \else keeps only the whitespace before the outer \fi
+        if i == len(branches) - 1 and i > 0:
+            body = body.rstrip() + closing_whitespace
+        emitted_branches.append(emit_conditional_branch(body, conditions))
+    return ''.join(emitted_branches)
+
+
+# Wraps the body of a branch in \textcolor{IFXCOND_category_SEP_value1_MYOR_value2}{...} for each condition
+def emit_conditional_branch(body, conditions):
+    # Stripping the whitespace from what's inside ifx commands
+    if '\n' in body[:len(body) - len(body.lstrip())]:
+        body = body.lstrip()
+    if '\n' in body[len(body.rstrip()):]:
+        body = body.rstrip()
+    # the my_or string is for putting multiple conditions in one string
+    my_or = '_MYOR_'
+    cond_strings = []
+    for category, values in conditions:
+        if not values:
+            # All values of the category are in the branches before it, so the branch never applies
+            logging.info('INFO: The \\else branch never applies, removing it: ' + body)
+            return ''
+        cond_strings.append('IFXCOND_' + category + '_SEP_' + my_or.join(values))
+    text_start = ''.join('\\textcolor{' + cond_string + '}{' for cond_string in cond_strings)
+    text_end = '}' * len(cond_strings)
+    # Handling the case where only \item element is inside \ifx
+    inside_condition = body.lstrip()
+    if cond_strings and inside_condition.startswith('\\item'):
+        if body.count('\\item') > 1:
+            print('WARNING: More than 1 \\item commands inside \\ifx. Check the list element in ' + body + '\n')
+            logging.warning('WARNING: More than 1 \\item commands inside \\ifx. Check the list element in ' + body)
+        elif inside_condition.startswith('\\item['):
+            # NOTE: It's a hack for one occurrence of ifx around \item[] in preface_en. The difference is [.
+            # This might not work for other occurrences (that's why I'm printing a warning just in case)
+            hack_text = ''.join(cond_string.replace('_', '\\_') for cond_string in cond_strings)
+            new_text = inside_condition.rstrip() + hack_text + 'IFXCONDEND'
+            print('CAUTION: \\item[] hack. Check output: ' + new_text)
+            logging.info('CAUTION: \\item[] hack. Check output: ' + new_text)
+            return new_text
+        else:
+            return '\\item' + text_start + inside_condition[len('\\item'):].lstrip() + text_end
+    return text_start + body + text_end
+
+
+# Replaces the \ifx ... \else ... \fi blocks with \textcolor{IFXCOND_...}{...} (see parse_conditionals())
+def replace_conditionals(text):
+    return ''.join(item if isinstance(item, str) else item['text'] for item in parse_conditionals(text))
+
+
+# Returns the options of change_command_value() as a dict (a command transform for rewrite_commands())
+def command_transform(command, string_start, string_end, keep_brackets=False, escape_underscore=False,
+                      bracket_left='{', bracket_right='}', ind_part_in_brackets=0, replace_comm_def_with_value=False):
+    transform = {
+        "command": command,
+        "string_start": string_start,
+        "string_end": string_end,
+        "keep_brackets": keep_brackets,
+        "escape_underscore": escape_underscore,
+        "bracket_left": bracket_left,
+        "bracket_right": bracket_right,
+        "ind_part_in_brackets": ind_part_in_brackets,
+        "replace_comm_def_with_value": replace_comm_def_with_value
+    }
+    return transform
+
+
+# Returns the edit that the command transform makes for the command at index ind:
+# the string to replace, the index where it is (-1 if it's not found), and the replacement.
+# Also returns the original parts in brackets and the end of the text that was read to create the edit.
+# marker_indices: a dict for the marker indices (see build_marker_index()) of the text by bracket pair.
+def get_command_edit(text, ind, transform, marker_indices):
+    bracket_left = transform['bracket_left']
+    bracket_right = transform['bracket_right']
+    if (bracket_left, bracket_right) not in marker_indices:
+        if string_has_border(bracket_left) or string_has_border(bracket_right):
+            marker_indices[(bracket_left, bracket_right)] = None
+        else:
+            marker_indices[(bracket_left, bracket_right)] = build_marker_index(text, bracket_left, bracket_right)
+    ind_part_in_brackets = transform['ind_part_in_brackets']
+    indices = get_indices_start_end(text, bracket_left, bracket_right, ind_part_in_brackets + 1, ind,
+                                    marker_indices[(bracket_left, bracket_right)])
+    parts_original = []
+    for ind_pair in indices:
+        parts_original.append(text[ind_pair[0]:ind_pair[1]])
+    part_ind_from = 1 * int(not transform['keep_brackets'])
+    current_part_new = parts_original[ind_part_in_brackets]
+    if transform['escape_underscore']:
+        current_part_new = current_part_new.replace('_', '\\_')
+    part_ind_to = len(current_part_new) - 1 * int(not transform['keep_brackets'])
+    current_part_new = transform['string_start'] + current_part_new[part_ind_from:part_ind_to] + transform['string_end']
+    if transform['replace_comm_def_with_value']:
+        string_to_repl = transform['command'] + ''.join(parts_original)
+    else:
+        string_to_repl = parts_original[ind_part_in_brackets]
+    ind_edit = text.find(string_to_repl, ind)
+    # bracket_extra_space() reads 2 more chars after the last part.
+    # If the string to replace isn't found, the whole text after the command was read.
+    if ind_edit == -1:
+        ind_read_end = len(text)
+    else:
+        ind_read_end = ind_edit + len(string_to_repl)
+        for ind_pair in indices:
+            ind_read_end = max(ind_read_end, ind_pair[0] + len(bracket_left), ind_pair[1] + 2)
+    command_edit = {
+        "ind": ind,
+        "ind_read_end": ind_read_end,
+        "ind_edit": ind_edit,
+        "string_to_repl": string_to_repl,
+        "string_repl_with": current_part_new,
+        "parts_original": parts_original
+    }
+    return command_edit
+
+
+# Applies the command edits to the text with one join.
+# Returns None if an edit changes the text that another edit was created from (nested commands).
+# Such edits must be applied one by one.
+def apply_command_edits(text, command_edits):
+    command_edits = sorted(command_edits, key=lambda edit: edit['ind'])
+    ind_read_end_max = 0
+    for i, edit in enumerate(command_edits):
+        if edit['ind_edit'] != -1:
+            if edit['ind_edit'] < ind_read_end_max:
+                return None
+            if i + 1 < len(command_edits) and edit['ind_edit'] + len(edit['string_to_repl']) > command_edits[i + 1]['ind']:
+                return None
+        ind_read_end_max = max(ind_read_end_max, edit['ind_read_end'])
+    new_text_parts = []
+    ind_prev = 0
+    for edit in command_edits:
+        if edit['ind_edit'] != -1:
+            new_text_parts.append(text[ind_prev:edit['ind_edit']])
+            new_text_parts.append(edit['string_repl_with'])
+            ind_prev = edit['ind_edit'] + len(edit['string_to_repl'])
+    new_text_parts.append(text[ind_prev:])
+    return ''.join(new_text_parts)
 
 
 # textcolor requires the second argument, I'm adding it here
@@ -397,35 +842,74 @@ def replace_ifx_with_textcolor(text, start_tag, end_tag, replacement_tag):
 # partIndex1.
 def change_command_value(text, command, string_start, string_end, keep_brackets=False, escape_underscore=False,
                          bracket_left='{', bracket_right='}', ind_part_in_brackets=0, replace_comm_def_with_value=False):
-    new_text = text
-    ref_indices = findall(new_text, command)
+    transform = command_transform(command, string_start, string_end, keep_brackets, escape_underscore,
+                                  bracket_left, bracket_right, ind_part_in_brackets, replace_comm_def_with_value)
+    marker_indices = {}
+    command_edits = []
+    for ind in findall(text, command):
+        command_edits.append(get_command_edit(text, ind, transform, marker_indices))
     ref_ind_and_string_parts = []
-    for ind in ref_indices:
-        current_parts = extract_content(new_text[ind:], bracket_left, bracket_right, ind_part_in_brackets + 1, do_process_else=True)
-        part_ind_from = 1 * int(not keep_brackets)
-        current_part_new = current_parts[0][ind_part_in_brackets]
-        if escape_underscore:
-            current_part_new = current_part_new.replace('_', '\\_')
-        part_ind_to = len(current_part_new) - 1 * int(not keep_brackets)
-        current_parts[1][ind_part_in_brackets] = string_start + current_part_new[part_ind_from:part_ind_to] + string_end
-        ref_ind_and_string_parts.append([ind, current_parts])
-    if replace_comm_def_with_value:
-        for elem in reversed(ref_ind_and_string_parts):
-            new_text = str_replace_from_index(new_text, command + ''.join(elem[1][0]), elem[1][1][ind_part_in_brackets], elem[0])
-    else:
-        for elem in reversed(ref_ind_and_string_parts):
-            new_text = str_replace_from_index(new_text, elem[1][0][ind_part_in_brackets], elem[1][1][ind_part_in_brackets], elem[0])
+    for edit in command_edits:
+        parts_new = list(edit['parts_original'])
+        parts_new[ind_part_in_brackets] = edit['string_repl_with']
+        ref_ind_and_string_parts.append([edit['ind'], [edit['parts_original'], parts_new]])
+    new_text = apply_command_edits(text, command_edits)
+    if new_text is None:
+        # Nested commands: replacing from the end, because each replacement changes the text after it
+        new_text = text
+        for edit in reversed(command_edits):
+            new_text = str_replace_from_index(new_text, edit['string_to_repl'], edit['string_repl_with'], edit['ind'])
     return new_text, ref_ind_and_string_parts
 
 
-def process_unit_comm(text):
-    new_text = text
-    for command in json_data['config']['unit_commands']:
-        new_text = change_command_value(new_text, '\\' + command + '[', '{', '}', escape_underscore=False,
-                                        bracket_left='[', bracket_right=']')[0]
+# Does the same as running change_command_value() for each command transform in the given order,
+# but finds all commands in one scan and builds the new text with one join.
+# If the commands are nested, falls back to running change_command_value() for each transform.
+def rewrite_commands(text, command_transforms):
+    command_regex = '(?=' + '|'.join(re.escape(transform['command']) for transform in command_transforms) + ')'
+    marker_indices = {}
+    command_edits = []
+    try:
+        for match in re.finditer(command_regex, text):
+            for transform in command_transforms:
+                if text.startswith(transform['command'], match.start()):
+                    command_edits.append(get_command_edit(text, match.start(), transform, marker_indices))
+        new_text = apply_command_edits(text, command_edits)
+    except IndexError:
+        # A command without the part in brackets. The previous transforms may still add it, so only
+        # change_command_value() calls can tell if this is an error.
+        new_text = None
+    if new_text is None:
+        new_text = text
+        for transform in command_transforms:
+            new_text = change_command_value(new_text, **transform)[0]
     return new_text
 
 
+# Transforms \unit[] (and other commands from the config) to \unit{}
+unit_command_transforms = []
+for unit_command in json_data['config']['unit_commands']:
+    unit_command_transforms.append(command_transform('\\' + unit_command + '[', '{', '}', escape_underscore=False,
+                                                     bracket_left='[', bracket_right=']'))
+# The command rewrites that preproc_tex() does, in this order
+preproc_command_transforms = [
+    # Processing references (ref)
+    command_transform('\\ref', 'TEXREFSTART', 'TEXREFEND', escape_underscore=True),
+    # Adding a prefix to label values to simplify post-processing
+    command_transform('\\label', '{TEXLABEL', '}', escape_underscore=False),
+    # Removing \raisebox
+    command_transform('\\raisebox', '', '', escape_underscore=False, ind_part_in_brackets=1,
+                      replace_comm_def_with_value=True)
+] + unit_command_transforms
+# The JSON backend keeps \ref: pandoc outputs it as a link with the label (see ast_append_inline())
+preproc_command_transforms_json = [transform for transform in preproc_command_transforms
+                                   if transform['command'] != '\\ref']
+
+
+def process_unit_comm(text):
+    return rewrite_commands(text, unit_command_transforms)
+
+
 def add_brackets_to_else_without_ifx(text):
     new_text = text
     indices = findall(new_text, '\\else')
@@ -458,7 +942,7 @@ def process_newcommand(text):
     return newcommand_data
 
 
-# This function extracts and saves the \newcommand definitions. The beginning is mostly a copy of preproc().
+# This function extracts and returns the \newcommand definitions. The beginning is mostly a copy of preproc_tex().
 def extract_newcomm_defs(toc_entry):
     source_file_path = source_root_dir + toc_entry["path"]
     # Just to ensure that path has / as the dir separator
@@ -468,8 +952,6 @@ def extract_newcomm_defs(toc_entry):
     # Creating the temporary directory for storing the preprocessed tex files.
     dirpath_part_after_tex_files = source_file_path.split(tex_files_dirname)[-1].replace(source_filename, '')
     tmp_current_dir = tmp_root_dir + dirpath_part_after_tex_files
-    check_create_folder(tmp_current_dir)
-    # Just copying the file to a tmp directory.
     tmp_tex_filepath = tmp_current_dir + source_filename_noext + '.tex'
     # Start preprocessing
     with open(source_file_path, 'r', encoding='utf-8') as file:
@@ -478,43 +960,181 @@ def extract_newcomm_defs(toc_entry):
     # Remove commented lines and empty commands (for example, else{}\fi{})
     cleaned_lines = clean_up_lines(file_lines)
     new_file_content = ''.join(cleaned_lines)
-    with open(tmp_tex_filepath, 'w', encoding='utf-8') as file:
-        file.write(new_file_content)
+    if keep_intermediates:
+        check_create_folder(tmp_current_dir)
+        with open(tmp_tex_filepath, 'w', encoding='utf-8') as file:
+            file.write(new_file_content)
     # Adding {} to \else where \else does not end with either {} or \ifx
     new_file_content = add_brackets_to_else_without_ifx(new_file_content)
     # PREAMBLE START
     if ('type' in toc_entry) and (toc_entry['type'] == 'preamble'):
         # \newcommand: Preprocessing the values (second {}) of \newcommand
         newcommand_data = process_newcommand(new_file_content)
-        with open(tmp_tex_filepath.replace('.tex', '.json'), 'w', encoding='utf-8') as file:
-            json.dump(newcommand_data, file, indent=4)
+        if keep_intermediates:
+            with open(tmp_tex_filepath.replace('.tex', '.json'), 'w', encoding='utf-8') as file:
+                json.dump(newcommand_data, file, indent=4)
+        return newcommand_data
+    return None
+
+
+# Builds a matcher that looks up many strings at once. The text is scanned only at positions
+# where one of the strings can start, and at each such position the candidates are
+# looked up in sets grouped by string length (see find_all_strings() and replace_strings()).
+def build_string_matcher(strings):
+    strings_by_length = {}
+    for string in strings:
+        strings_by_length.setdefault(len(string), set()).add(string)
+    first_chars = sorted(set(string[0] for string in strings))
+    matcher = {
+        "lengths": sorted(strings_by_length, reverse=True),
+        "strings_by_length": strings_by_length,
+        "first_chars": re.compile('[' + ''.join(re.escape(char) for char in first_chars) + ']')
+    }
+    return matcher
+
+
+# Returns a dict: string -> list of all its positions in the text (overlapping occurrences included),
+# found in one pass for all strings of the matcher.
+def find_all_strings(text, matcher):
+    positions = {}
+    lengths = matcher['lengths']
+    strings_by_length = matcher['strings_by_length']
+    for match in matcher['first_chars'].finditer(text):
+        pos = match.start()
+        for length in lengths:
+            candidate = text[pos:pos + length]
+            if candidate in strings_by_length[length]:
+                positions.setdefault(candidate, []).append(pos)
+    return positions
+
+
+# Replaces the strings of the matcher in one left-to-right pass (replacements: string -> new string).
+# If several strings match at the same position, the longest one is replaced.
+def replace_strings(text, matcher, replacements):
+    parts = []
+    ind_last = 0
+    lengths = matcher['lengths']
+    strings_by_length = matcher['strings_by_length']
+    for match in matcher['first_chars'].finditer(text):
+        pos = match.start()
+        if pos < ind_last:
+            continue
+        for length in lengths:
+            candidate = text[pos:pos + length]
+            if candidate in strings_by_length[length]:
+                parts.append(text[ind_last:pos])
+                parts.append(replacements[candidate])
+                ind_last = pos + length
+                break
+    if not parts:
+        return text
+    parts.append(text[ind_last:])
+    return ''.join(parts)
+
+
+# Matchers and replacements for macros_to_plaintext(), built once per list of commands
+macro_matchers = {}
+
+
+def get_macro_matcher(comms_list):
+    key = tuple(comms_list)
+    if key not in macro_matchers:
+        replacements = {}
+        for comm in comms_list:
+            # Commands are used with or without '{}' at the end
+            replacements[comm[1:-1] + '{}'] = repl_string_start + comm[2:-1] + repl_string_end
+            replacements[comm[1:-1]] = repl_string_start + comm[2:-1] + repl_string_end
+        # The newcommand definitions themselves must stay as they are.
+        # They are longer than the command names, so they win the longest match.
+        for comm in comms_list:
+            replacements[newcommand + comm] = newcommand + comm
+        macro_matchers[key] = [build_string_matcher(replacements), replacements]
+    return macro_matchers[key]
 
 
 # commands must be a dict
 def macros_to_plaintext(text, commands):
-    text_new = text
     comms_list = commands['all_comms_to_replace']
-    placeholder_start = 'PLACEHOLDSTART'
-    placeholder_end = 'PLACEHOLDEND'
-    # This replacement is to ensure that newcommand definitions are not replaced
-    ph_repl = {}
-    for i, comm in enumerate(comms_list):
-        ph_repl[placeholder_start + str(i) + placeholder_end] = newcommand + comm
-        text_new = text_new.replace(newcommand + comm, placeholder_start + str(i) + placeholder_end)
-    for comm in comms_list:
-        # Doing two replacements because commands end/end not with '{}'
-        text_new = text_new.replace(comm[1:-1] + '{}', repl_string_start + comm[2:-1] + repl_string_end)
-        text_new = text_new.replace(comm[1:-1], repl_string_start + comm[2:-1] + repl_string_end)
-    # Putting newcommand definitions back
-    for x in ph_repl:
-        text_new = text_new.replace(x, ph_repl[x])
-    return text_new
+    if not comms_list:
+        return text
+    matcher, replacements = get_macro_matcher(comms_list)
+    return replace_strings(text, matcher, replacements)
+
+
+# Returns True if every start marker from the marker index has its own end marker after it
+# (unbalanced markers are left to the step-by-step replacement, which warns about them)
+def markers_balanced(marker_index, start_len):
+    if len(marker_index['starts']) != len(marker_index['ends']):
+        return False
+    depth = 0
+    ind_start = 0
+    for ind_end in marker_index['ends']:
+        while ind_start < len(marker_index['starts']) and marker_index['starts'][ind_start] + start_len <= ind_end:
+            ind_start += 1
+            depth += 1
+        depth -= 1
+        if depth < 0:
+            return False
+    return True
+
+
+# Does the replacements of file_string_repl() in one pass over the text. Returns None if the
+# result could differ from replacing the pairs one after another (markers inside other
+# replaced parts, markers in the targets, neighbouring replaced parts, overlapping markers).
+def file_string_repl_one_pass(text, repl_from_to, repl_targets):
+    if not repl_from_to:
+        return text
+    markers = set()
+    for from_to in repl_from_to:
+        if not from_to[0] or not from_to[1] or string_has_border(from_to[0]) or string_has_border(from_to[1]):
+            return None
+        markers.update(from_to[:2])
+    for target in repl_targets[:len(repl_from_to)]:
+        if any(marker in target for marker in markers):
+            return None
+    positions = find_all_strings(text, build_string_matcher(markers))
+    spans = []
+    for i, from_to in enumerate(repl_from_to):
+        if from_to[0] not in positions:
+            continue
+        marker_index = {"starts": positions[from_to[0]], "ends": positions.get(from_to[1], [])}
+        if not markers_balanced(marker_index, len(from_to[0])):
+            return None
+        for ind_pair in get_indices_start_end(text, from_to[0], from_to[1], marker_index=marker_index):
+            if ind_pair[1] <= ind_pair[0] or ind_pair[1] > len(text):
+                return None
+            spans.append([ind_pair[0], ind_pair[1], i])
+    spans.sort()
+    for span_prev, span in zip(spans, spans[1:]):
+        # 2 extra characters because the end of a pair can include '{}'
+        if span_prev[1] + 2 > span[0]:
+            return None
+    for span in spans:
+        from_to = repl_from_to[span[2]]
+        for marker in markers:
+            markers_expected = 1 if marker in from_to[:2] else 0
+            if from_to[0] == from_to[1] and marker == from_to[0]:
+                markers_expected = 2
+            marker_count = count_markers_between(positions.get(marker, []), len(marker), span[0], span[1])
+            if marker_count != markers_expected:
+                return None
+    parts = []
+    ind_last = 0
+    for span in spans:
+        parts.append(text[ind_last:span[0]])
+        parts.append(repl_targets[span[2]])
+        ind_last = span[1]
+    parts.append(text[ind_last:])
+    return ''.join(parts)
 
 
 def file_string_repl(text, toc_entry):
-    text_new = text
     repl_from_to = toc_entry['repl_source_from_to']
     repl_targets = toc_entry['repl_targets']
+    text_new = file_string_repl_one_pass(text, repl_from_to, repl_targets)
+    if text_new is not None:
+        return text_new
+    text_new = text
     for i, from_to in enumerate(repl_from_to):
         if from_to[0] in text_new:
             extract = extract_content(text_new, from_to[0], from_to[1])[0]
@@ -533,21 +1153,45 @@ def replace_newcommand(text, commands):
     return text_new
 
 
-def preproc(toc_entry):
+# Returns a topic dict with the paths that the preprocessing, pandoc, and post-processing stages use.
+def get_topic_paths(toc_entry):
     source_file_path = source_root_dir + toc_entry["path"]
     # Just to ensure that path has / as the dir separator
     source_file_path = source_file_path.replace('\\', dir_sep)
     source_filename = source_file_path.split('/')[-1]
     source_filename_noext = source_filename[0:-4]
-    # Creating the temporary directory for storing the preprocessed tex files.
+    # The temporary directory for storing the preprocessed tex files.
     dirpath_part_after_tex_files = source_file_path.split(tex_files_dirname)[-1].replace(source_filename, '')
     tmp_current_dir = tmp_root_dir + dirpath_part_after_tex_files
-    check_create_folder(tmp_current_dir)
-    # Just copying the file to a tmp directory.
     tmp_tex_filepath = tmp_current_dir + source_filename_noext + '.tex'
-    shutil.copy(source_file_path, tmp_tex_filepath)
+    target_topic_path = flare_dir_content + dirpath_part_after_tex_files
+    target_topic_path = target_topic_path.replace('//', '/')
+    topic = {
+        "toc_entry": toc_entry,
+        "source_file_path": source_file_path,
+        "tmp_current_dir": tmp_current_dir,
+        "tmp_tex_filepath": tmp_tex_filepath,
+        "tmp_htm_filepath": tmp_tex_filepath[:-4] + '.htm',
+        # Not .json: that is the newcommand data of a preamble entry (see extract_newcomm_defs())
+        "tmp_pandoc_json_filepath": tmp_tex_filepath[:-4] + '.pandoc.json',
+        "pandoc_log_filename": pandoc_logs_dir + dir_sep + dirpath_part_after_tex_files.replace('/', '_')
+                               + source_filename_noext + '.log',
+        "target_topic_path": target_topic_path,
+        "target_topic_filepath": target_topic_path + source_filename_noext + '.htm',
+        "report_key": get_report_key(target_topic_path + source_filename_noext + '.htm')
+    }
+    return topic
+
+
+# Runs the string preprocessing on a topic and adds the preprocessed latex to the topic dict (topic['tex']).
+# With --keep-intermediates, the result is also saved to the temporary directory.
+def preproc_tex(topic):
+    global current_filepath
+    current_filepath = topic['source_file_path']
+    toc_entry = topic['toc_entry']
+    timer = start_timer(topic['report_key'])
     # Start preprocessing
-    with open(tmp_tex_filepath, 'r', encoding='utf-8') as file:
+    with open(topic['source_file_path'], 'r', encoding='utf-8') as file:
         file_lines = file.readlines()
     # command_list_in_cur_file = helper_get_list_of_commands(file_lines).most_common()
     # Remove commented lines and empty commands (for example, else{}\fi{})
@@ -558,6 +1202,7 @@ def preproc(toc_entry):
             file_lines[i] = file_lines[i].replace(replacement_hack[0], replacement_hack[1])
     cleaned_lines = clean_up_lines(file_lines)
     new_file_content = ''.join(cleaned_lines)
+    record_lap(timer, 'preproc_tex.read_and_clean', bytes_in=sum(len(line) for line in file_lines))
     # Add intro_text, if it exists in the current toc_entry
     if 'intro_text' in toc_entry:
         new_file_content = toc_entry['intro_text'] + '\n\n' + new_file_content
@@ -566,65 +1211,397 @@ def preproc(toc_entry):
     # Do file-specific string replacement (repl_source_start, repl_source_end)
     if 'repl_source_from_to' in toc_entry:
         new_file_content = file_string_repl(new_file_content, toc_entry)
-    # Adding {} to \else where \else does not end with either {} or \ifx
-    new_file_content = add_brackets_to_else_without_ifx(new_file_content)
-    # Getting the original '\\ifx', '\\fi' parts, and creating the replacement strings for them
-    parts_original, parts_new = extract_content(new_file_content, '\\ifx', '\\fi', do_process_else=True)
-    for i, part in enumerate(parts_new):
-        current_part = process_else_ifx(part)
-        current_part = replace_ifx_with_textcolor(current_part, '\\ifx', '\\fi', '\\textcolor')
-        parts_new[i] = current_part
-        new_file_content = new_file_content.replace(parts_original[i], parts_new[i])
-    # Processing references (ref)
-    new_file_content = change_command_value(new_file_content, '\\ref', 'TEXREFSTART', 'TEXREFEND',
-                                            escape_underscore=True)[0]
-    # Adding a prefix to label values to simplify post-processing
-    new_file_content = change_command_value(new_file_content, '\\label', '{TEXLABEL', '}', escape_underscore=False)[0]
-    # Removing \raisebox
-    new_file_content = change_command_value(new_file_content, '\\raisebox', '', '', escape_underscore=False, ind_part_in_brackets=1, replace_comm_def_with_value=True)[0]
-    # Preprocessing \unit ([] -> {})
-    new_file_content = process_unit_comm(new_file_content)
+    record_lap(timer, 'preproc_tex.file_string_repl')
+    # Replacing the \ifx ... \else ... \fi blocks with the condition markers
+    new_file_content = replace_conditionals(new_file_content)
+    record_lap(timer, 'preproc_tex.ifx')
+    # Processing references (ref), labels, \raisebox, and \unit ([] -> {})
+    if pandoc_backend == 'json':
+        new_file_content = rewrite_commands(new_file_content, preproc_command_transforms_json)
+    else:
+        new_file_content = rewrite_commands(new_file_content, preproc_command_transforms)
+    record_lap(timer, 'preproc_tex.rewrite_commands')
     # REPLACEMENTS go here
     new_file_content = pre_replacements(new_file_content)
+    record_lap(timer, 'preproc_tex.pre_replacements')
     # Replacing newcommand definitions with text placeholders
+    record_topic_macros(topic, new_file_content)
     new_file_content = macros_to_plaintext(new_file_content, comms_to_replace_all)
     # TODO replace newcommand with textcolor only if the command is in to replace
     new_file_content = replace_newcommand(new_file_content, comms_to_replace_all)
+    record_lap(timer, 'preproc_tex.macros', bytes_out=len(new_file_content))
     # The string manipulation ends here.
+    if keep_intermediates:
+        check_create_folder(topic['tmp_current_dir'])
+        with open(topic['tmp_tex_filepath'], 'w', encoding='utf-8') as file:
+            file.write(new_file_content)
+    topic['tex'] = new_file_content
+
+
+def get_pandoc_version():
+    global pandoc_version
+    if pandoc_version is None:
+        pandoc_process = subprocess.run([pandoc_path, '--version'], stdout=subprocess.PIPE)
+        pandoc_version = pandoc_process.stdout.decode('utf-8').split('\n')[0].strip()
+    return pandoc_version
+
+
+# The source key of a topic is the hash of the source tex file and of everything else the converted topic
+# depends on, except the commands to replace: the replacement config, the pandoc version, and this script.
+def get_topic_source_key(topic):
+    if 'source_key' in topic:
+        return topic['source_key']
+    toc_entry_data = {}
+    for key, value in topic['toc_entry'].items():
+        if key != 'children':
+            toc_entry_data[key] = value
+    key_data = {
+        "toc_entry": toc_entry_data,
+        "global_repl_from_to": global_repl_from_to,
+        "unit_commands": json_data['config']['unit_commands'],
+        "latex_conditions": latex_conditions,
+        "pandoc_version": get_pandoc_version(),
+        "pandoc_backend": pandoc_backend,
+        "script_hash": script_hash
+    }
+    key_hash = hashlib.sha256()
+    with open(topic['source_file_path'], 'rb') as file:
+        key_hash.update(file.read())
+    key_hash.update(json.dumps(key_data, sort_keys=True).encode('utf-8'))
+    topic['source_key'] = key_hash.hexdigest()
+    return topic['source_key']
+
+
+# The commands to replace that match one of the commands (sorted) of a topic. macros_to_plaintext() replaces
+# a command wherever its name starts a command in the text, so \foo also matches \foobar.
+def get_matching_macros(commands, comms_list):
+    matching_macros = []
+    for comm in comms_list:
+        comm_name = comm[1:-1]
+        ind = bisect.bisect_left(commands, comm_name)
+        if ind < len(commands) and commands[ind].startswith(comm_name):
+            matching_macros.append(comm)
+    return matching_macros
+
+
+# Saves the commands of the topic text before the macro replacement to the dependency graph (see macro_deps)
+def record_topic_macros(topic, text):
+    commands = sorted(set(command_name_pattern.findall(text)))
+    macro_deps['topics'][topic['report_key']] = {
+        "source_key": get_topic_source_key(topic),
+        "commands": commands,
+        "macros": get_matching_macros(commands, comms_to_replace_all['all_comms_to_replace'])
+    }
 
-    # The pandoc process
-    run_path_as_list = []
-    pandoc_log_filename = pandoc_logs_dir + dir_sep + dirpath_part_after_tex_files.replace('/',
-                                                                                           '_') + source_filename_noext + '.log'
-    tmp_htm_filepath = tmp_tex_filepath[:-4] + '.htm'
-    run_path_as_list.extend([pandoc_path, tmp_tex_filepath, '-o', tmp_htm_filepath, '--log=' + pandoc_log_filename])
-    pandoc_process = subprocess.run(run_path_as_list)
-    # The beginning of the post-processing part
-    with open(tmp_htm_filepath, 'r', encoding='utf-8') as file_htm:
-        source_htm = file_htm.read()
-    xml_root = xml_create_root(source_htm)
+
+# The cache key of a topic is the source key and the commands to replace that the topic can use.
+# If the topic has been converted with the same source key before, these are the commands to replace that match
+# the recorded commands of the topic, so a change of other commands doesn't convert the topic again.
+# Otherwise, it's the whole list of commands to replace.
+def get_topic_cache_key(topic):
+    comms_list = comms_to_replace_all['all_comms_to_replace']
+    topic_deps = macro_deps['topics'].get(topic['report_key'])
+    if topic_deps is not None and topic_deps['source_key'] == get_topic_source_key(topic):
+        comms_list = get_matching_macros(topic_deps['commands'], comms_list)
+    key_hash = hashlib.sha256(get_topic_source_key(topic).encode('utf-8'))
+    key_hash.update(json.dumps(comms_list).encode('utf-8'))
+    return key_hash.hexdigest()
+
+
+# The report keys of the topics that use (or can use) the commands, from the dependency graph.
+# The topics without a record are returned too.
+def get_topics_using_macros(report_keys, comms_list):
+    topics_using_macros = []
+    for report_key in report_keys:
+        topic_deps = macro_deps['topics'].get(report_key)
+        if topic_deps is None or get_matching_macros(topic_deps['commands'], comms_list):
+            topics_using_macros.append(report_key)
+    return topics_using_macros
+
+
+# The \newcommand definitions of each command to replace from the extract_newcomm_defs() results, hashed
+def get_macro_definition_hashes(newcommand_data_list):
+    definitions = {}
+    for comm_data in newcommand_data_list:
+        if comm_data is None:
+            continue
+        for newcommand_extract in comm_data['newcommands_extract']:
+            if newcommand_extract[1] in comm_data['commands_to_replace']:
+                definitions.setdefault(newcommand_extract[1], []).append(newcommand_extract[2])
+    definition_hashes = {}
+    for comm, comm_definitions in definitions.items():
+        definition_hashes[comm] = hashlib.sha256(json.dumps(comm_definitions).encode('utf-8')).hexdigest()
+    return definition_hashes
+
+
+# Compares the definitions with the previous run. Returns the commands to replace that are new, removed, or defined
+# differently, and prints the snippet files and the topics that reference them.
+# In the watch mode, only these snippet files are written, and only the topics that use the new and removed commands
+# are converted (see update_source_entries()). The full run writes every snippet file, because the post-processing
+# walks the whole Content directory, and the topics that don't use the changed commands come from the build cache
+# (see get_topic_cache_key()).
+def update_macro_definitions(newcommand_data_list):
+    definition_hashes = get_macro_definition_hashes(newcommand_data_list)
+    previous_hashes = macro_deps['definitions']
+    changed_macros = sorted(comm for comm in set(definition_hashes) | set(previous_hashes)
+                            if definition_hashes.get(comm) != previous_hashes.get(comm))
+    macro_deps['definitions'] = definition_hashes
+    if changed_macros and previous_hashes:
+        changed_snippets = sorted(set(macro_deps['snippets'][comm] for comm in changed_macros
+                                      if comm in macro_deps['snippets']))
+        # The recorded commands, so that the topics that use a new command are counted too
+        changed_topics = [report_key for report_key, topic_deps in macro_deps['topics'].items()
+                          if get_matching_macros(topic_deps['commands'], changed_macros)]
+        print('Changed commands: ' + str(len(changed_macros)) + ', snippet files: ' + str(len(changed_snippets))
+              + ', topics that use them: ' + str(len(changed_topics)) + ' (see ' + macro_deps_file + ')')
+        logging.info('Changed commands: ' + ', '.join(changed_macros))
+        logging.info('Topics that use the changed commands: ' + ', '.join(changed_topics))
+    return changed_macros
+
+
+# The names of the snippet files generated from the commands (see generate_snip_and_var())
+def get_macro_snippet_names(comms):
+    snippet_names = set()
+    for comm in comms:
+        if comm in macro_deps['snippets']:
+            snippet_names.add(os.path.basename(macro_deps['snippets'][comm])[:-len('.flsnp')])
+    return snippet_names
+
+
+def load_macro_deps():
+    global macro_deps
+    if os.path.isfile(macro_deps_file):
+        with open(macro_deps_file, encoding='utf-8') as file:
+            macro_deps = json.load(file)
+
+
+def save_macro_deps():
+    with open(macro_deps_file + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(macro_deps, file, indent=4)
+    os.replace(macro_deps_file + '.tmp', macro_deps_file)
+
+
+# The cache file of the topic, used by this run (see prune_build_cache())
+def set_topic_cache_filepath(topic):
+    topic['cache_filepath'] = build_cache_dir + dir_sep + get_topic_cache_key(topic) + '.htm'
+    build_cache_used[topic['report_key']] = topic['cache_filepath']
+
+
+# Writes the cached topic to the target path. Returns False if the topic is not in the cache.
+def restore_topic_from_cache(topic):
+    if not use_build_cache:
+        return False
+    set_topic_cache_filepath(topic)
+    if not os.path.isfile(topic['cache_filepath']):
+        return False
+    check_create_folder(topic['target_topic_path'])
+    shutil.copyfile(topic['cache_filepath'], topic['target_topic_filepath'])
+    logging.info('Restored from cache: ' + topic['target_topic_filepath'])
+    return True
+
+
+# The cache key again: the conversion has recorded the commands of the topic (see record_topic_macros()),
+# so that the next run finds the entry with the key of the recorded commands.
+def save_topic_to_cache(topic):
+    if use_build_cache:
+        set_topic_cache_filepath(topic)
+        check_create_folder(build_cache_dir)
+        # Copying to a temporary file first, so that an interrupted run doesn't leave a broken cache entry
+        shutil.copyfile(topic['target_topic_filepath'], topic['cache_filepath'] + '.tmp')
+        os.replace(topic['cache_filepath'] + '.tmp', topic['cache_filepath'])
+
+
+# Removes the cache entries that no topic of this run has used: the entries of the topics before an edit,
+# and of the topics that are not in the config anymore. Without this, the cache grows with every edit.
+def prune_build_cache():
+    if not use_build_cache or not os.path.isdir(build_cache_dir):
+        return
+    cache_filepaths_used = set(build_cache_used.values())
+    entries_removed = 0
+    for filename in os.listdir(build_cache_dir):
+        cache_filepath = build_cache_dir + dir_sep + filename
+        if cache_filepath not in cache_filepaths_used:
+            os.remove(cache_filepath)
+            entries_removed += 1
+    logging.info('Build cache entries removed: ' + str(entries_removed))
+    count('cache_entries_removed', entries_removed)
+
+
+# Saves the pandoc output of a topic to the temporary directory (with --keep-intermediates)
+def write_pandoc_output(topic, source_htm):
+    if pandoc_backend == 'json':
+        tmp_output_filepath = topic['tmp_pandoc_json_filepath']
+    else:
+        tmp_output_filepath = topic['tmp_htm_filepath']
+    with open(tmp_output_filepath, 'w', encoding='utf-8') as file_htm:
+        file_htm.write(source_htm)
+
+
+# The pandoc process for one topic. The preprocessed latex goes to pandoc through stdin (see convert_from_string()).
+# Runs in the pandoc threads of convert_topics(). A failed or timed out pandoc process is tried again
+# pandoc_retries times, then the RuntimeError goes to convert_topics().
+def convert_topic(topic):
+    timer = start_timer(topic['report_key'])
+    for attempt in range(pandoc_retries + 1):
+        try:
+            source_htm = convert_from_string(topic['tex'], ['--log=' + topic['pandoc_log_filename']],
+                                             pandoc_output_format, pandoc_timeout)
+            break
+        except RuntimeError as e:
+            if attempt == pandoc_retries:
+                raise
+            logging.warning('Pandoc failed, trying again: ' + topic['source_file_path'] + ': ' + str(e))
+            count('pandoc_retries')
+    record_lap(timer, 'pandoc', bytes_in=len(topic['tex']), bytes_out=len(source_htm))
+    if keep_intermediates:
+        write_pandoc_output(topic, source_htm)
+    return source_htm
+
+
+# The pandoc process for one batch of topics (see convert_topics_batched()). Runs in the pandoc threads.
+def convert_batch(batch_topics, batch_num):
+    pandoc_log_filename = pandoc_logs_dir + dir_sep + 'batch_' + str(batch_num) + '.log'
+    timer = start_timer()
+    batch_htm = convert_from_string_batch([topic['tex'] for topic in batch_topics], ['--log=' + pandoc_log_filename],
+                                          pandoc_output_format, pandoc_timeout and pandoc_timeout * len(batch_topics))
+    record_lap(timer, 'pandoc_batch', bytes_in=sum(len(topic['tex']) for topic in batch_topics))
+    count('pandoc_batch_topics', len(batch_topics))
+    return batch_htm
+
+
+def completed_future(result):
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+
+# The pandoc processes for many topics. Topics are converted in batches of pandoc_batch_size with
+# convert_from_string_batch(). If a topic can't be split back from the batch output (or the batch fails),
+# it's converted on its own with convert_topic(). Returns a future for each topic.
+def convert_topics_batched(topics, executor):
+    topic_futures = [None] * len(topics)
+    topics_to_batch = []
+    for i, topic in enumerate(topics):
+        if topic['tex'].strip() != '' and not any(command in topic['tex'] for command in batch_unsafe_commands):
+            topics_to_batch.append(i)
+    batch_futures = []
+    for batch_num, batch_start in enumerate(range(0, len(topics_to_batch), pandoc_batch_size)):
+        batch = topics_to_batch[batch_start:batch_start + pandoc_batch_size]
+        batch_futures.append([batch, executor.submit(convert_batch, [topics[i] for i in batch], batch_num)])
+    # The topics that are not batched don't wait for the batches
+    topics_batched = set(topics_to_batch)
+    for i, topic in enumerate(topics):
+        if i not in topics_batched:
+            topic_futures[i] = executor.submit(convert_topic, topic)
+    for batch, batch_future in batch_futures:
+        try:
+            batch_htm = batch_future.result()
+        except RuntimeError as e:
+            logging.warning('The batch failed, converting the files separately: ' + str(e))
+            batch_htm = [None] * len(batch)
+        for i, source_htm in zip(batch, batch_htm):
+            if source_htm is not None and keep_intermediates:
+                write_pandoc_output(topics[i], source_htm)
+            if source_htm is None:
+                print('WARNING: Could not split the batch output, converting the file separately: ' + topics[i]['source_file_path'])
+                logging.warning('Could not split the batch output, converting the file separately: ' + topics[i]['source_file_path'])
+                topic_futures[i] = executor.submit(convert_topic, topics[i])
+            else:
+                topic_futures[i] = completed_future(source_htm)
+    return topic_futures
+
+
+# Converts the topics with pandoc_workers pandoc processes at a time. The main thread preprocesses the topics
+# in order and submits each one to the pandoc threads right away (or in batches), then post-processes
+# the results in the same order, so the output and the log don't depend on the number of workers.
+# If pandoc fails on a topic after the retries, the topic is skipped and reported with add_diagnostic().
+# Returns the topics that have been converted.
+def convert_topics(topics):
+    global current_filepath
+    converted_topics = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=pandoc_workers) as executor:
+        if pandoc_batch_size:
+            for topic in topics:
+                preproc_tex(topic)
+            topic_futures = convert_topics_batched(topics, executor)
+        else:
+            topic_futures = []
+            for topic in topics:
+                preproc_tex(topic)
+                topic_futures.append(executor.submit(convert_topic, topic))
+        for topic, topic_future in zip(topics, topic_futures):
+            try:
+                source_htm = topic_future.result()
+            except RuntimeError as e:
+                current_filepath = topic['source_file_path']
+                add_diagnostic('convert_topic', 'Pandoc failed ' + str(pandoc_retries + 1)
+                               + ' times, the topic is not converted:', str(e))
+                count('topics_failed')
+                continue
+            post_process_topic(topic, source_htm)
+            converted_topics.append(topic)
+            logging.info('Preprocessing done on: ' + topic['source_file_path'])
+    return converted_topics
+
+
+# The beginning of the post-processing part. source_htm is the pandoc output (html5 or JSON, see pandoc_backend).
+def post_process_topic(topic, source_htm):
+    global current_filepath
+    current_filepath = topic['target_topic_filepath']
+    timer = start_timer(topic['report_key'])
+    if pandoc_backend == 'json':
+        xml_root = xml_create_root_from_ast(source_htm)
+    else:
+        xml_root = xml_create_root(source_htm)
     xml_root = post_process_root(xml_root)
-    target_topic_path = flare_dir_content + dirpath_part_after_tex_files
-    target_topic_path = target_topic_path.replace('//', '/')
-    check_create_folder(target_topic_path)
-    target_topic_filepath = target_topic_path + source_filename_noext + '.htm'
-    write_root(xml_root, target_topic_filepath)
-    # Creating a Flare TOC entry
-    if not ('type' in toc_entry and toc_entry['type'] == 'preamble'):
-        global current_toc_parent_elem
-        toc_entry_link_path = '/' + target_topic_filepath.replace(flare_root_dir, '')
-        if 'toc_attribs' in toc_entry:
-            extra_attribs = toc_entry['toc_attribs']
+    record_lap(timer, 'post_process_root', bytes_in=len(source_htm))
+    check_create_folder(topic['target_topic_path'])
+    write_root(xml_root, topic['target_topic_filepath'])
+    record_lap(timer, 'write_root', bytes_out=os.path.getsize(topic['target_topic_filepath']))
+    save_topic_to_cache(topic)
+
+
+# Creates the topic dicts for the entries and their children in config order. The entries that are not
+# preambles get a TocEntry under toc_parent_elem (topic['toc_elem']), and their children go under it.
+def build_toc_skeleton(toc_entries, toc_parent_elem, topics):
+    for toc_entry in toc_entries:
+        topic = get_topic_paths(toc_entry)
+        topics.append(topic)
+        if not ('type' in toc_entry and toc_entry['type'] == 'preamble'):
+            toc_entry_link_path = '/' + topic['target_topic_filepath'].replace(flare_root_dir, '')
+            if 'toc_attribs' in toc_entry:
+                extra_attribs = toc_entry['toc_attribs']
+            else:
+                extra_attribs = {}
+            topic['toc_elem'] = add_topic_to_toc(toc_parent_elem, toc_entry_link_path, extra_attribs)
+            if 'children' in toc_entry and toc_entry['children'] is not None:
+                build_toc_skeleton(toc_entry['children'], topic['toc_elem'], topics)
+    return topics
+
+
+# Converts the entries and their children. The TOC is built first (see build_toc_skeleton()), then the topics
+# are converted with restore_or_convert_topics(). Returns the topic dicts in config order.
+def convert_toc_entries(toc_entries, toc_parent_elem=None):
+    topics = build_toc_skeleton(toc_entries, toc_parent_elem, [])
+    restore_or_convert_topics(topics)
+    return topics
+
+
+# Restores the topics from the build cache, and converts the others with convert_topics().
+# Returns the topics that have been written to the target path.
+def restore_or_convert_topics(topics):
+    topics_written = []
+    topics_to_convert = []
+    for topic in topics:
+        timer = start_timer(topic['report_key'])
+        topic_from_cache = restore_topic_from_cache(topic)
+        record_lap(timer, 'build_cache')
+        if topic_from_cache:
+            count('topics_from_cache')
+            topics_written.append(topic)
         else:
-            extra_attribs = {}
-        new_toc_entry = add_topic_to_toc(current_toc_parent_elem, toc_entry_link_path, extra_attribs)
-        if 'children' in toc_entry and toc_entry['children'] is not None:
-            previous_toc_parent_elem = current_toc_parent_elem
-            current_toc_parent_elem = new_toc_entry
-            for item in toc_entry['children']:
-                preproc(item)
-            current_toc_parent_elem = previous_toc_parent_elem
-    logging.info('Preprocessing done on: ' + tmp_tex_filepath)
+            topics_to_convert.append(topic)
+    return topics_written + convert_topics(topics_to_convert)
 
 
 def create_toc_root(root_toc_attributes={'Version': '1'}):
@@ -639,6 +1616,12 @@ def add_topic_to_toc(parent, topic_link, extra_attrib={}):
     return new_toc_entry
 
 
+# Returns False if the file already had the same content
+def write_toc(flare_toc_root):
+    check_create_folder(os.path.dirname(flare_toc_filepath))
+    return write_root(flare_toc_root, flare_toc_filepath)
+
+
 def xml_create_root(xml_without_root):
     xml_from_string = etree.fromstring('<body>\n' + xml_without_root + '</body>', parser=parser_xml)
     root = etree.Element("html", nsmap=madcap_nsmap)
@@ -648,45 +1631,454 @@ def xml_create_root(xml_without_root):
     return root
 
 
-def post_convert_text_to_elem(element, string_start, string_end, new_elem_tag, new_attribute_name):
+# The JSON backend: building the same html/head/body tree as xml_create_root() from the pandoc JSON AST.
+# Mapped here instead of in post-processing:
+# * \ref (a link with the 'reference' attribute) -> empty MadCap:xref with the label as href (see post_process_text_markers())
+# The TEXCOMM strings stay in the text, as in the html output (see post_process_snippet_markers()).
+# The \label ids and the \textcolor spans and divs (conditions, keywords, captions) keep their attributes,
+# so the rest of the post-processing is the same for both backends.
+def xml_create_root_from_ast(source_json):
+    ast = json.loads(source_json)
+    # Before pandoc 1.18, the document was [meta, blocks]
+    blocks = ast['blocks'] if isinstance(ast, dict) else ast[1]
+    root = etree.Element("html", nsmap=madcap_nsmap)
+    root.text = '\n'
+    etree.SubElement(root, "head").tail = '\n'
+    body = etree.SubElement(root, "body")
+    body.text = '\n'
+    notes = []
+    ast_append_blocks(body, blocks, notes)
+    if notes:
+        ast_append_notes(body, notes)
+    return root
+
+
+# id, classes, and key-value pairs of a pandoc Attr as an attribute dict
+def ast_attrib(attr, extra_attrib={}):
+    attr_id, classes, key_values = attr
+    attrib = {}
+    if attr_id:
+        attrib['id'] = attr_id
+    if classes:
+        attrib['class'] = ' '.join(classes)
+    for key, value in key_values:
+        attrib[key] = value
+    attrib.update(extra_attrib)
+    return attrib
+
+
+# Adds the text after the last child of parent (or to the text of parent)
+def ast_append_text(parent, text):
+    if not text:
+        return
+    if len(parent):
+        parent[-1].tail = (parent[-1].tail or '') + text
+    else:
+        parent.text = (parent.text or '') + text
+
+
+# RawBlock and RawInline. As in the html writer, only html is kept.
+def ast_append_raw(parent, raw_format, text):
+    if raw_format != 'html':
+        return
+    try:
+        fragment = etree.fromstring('<body>' + text + '</body>', parser=parser_xml)
+    except etree.XMLSyntaxError:
+        logging.warning('Skipping raw html that is not well-formed: ' + text + ' File path: ' + current_filepath)
+        return
+    ast_append_text(parent, fragment.text)
+    for child in fragment:
+        parent.append(child)
+
+
+# The plain text of inlines (for the alt attribute)
+def ast_stringify(inlines):
+    text_parts = []
+    for inline in inlines:
+        inline_type = inline['t']
+        if inline_type == 'Str':
+            text_parts.append(inline['c'])
+        elif inline_type in ('Code', 'Math'):
+            text_parts.append(inline['c'][1])
+        elif inline_type in ('Space', 'SoftBreak', 'LineBreak'):
+            text_parts.append(' ')
+        elif inline_type in ('Link', 'Image', 'Span', 'Cite', 'Quoted'):
+            text_parts.append(ast_stringify(inline['c'][1]))
+        elif inline_type not in ('Note', 'RawInline'):
+            text_parts.append(ast_stringify(inline['c']))
+    return ''.join(text_parts)
+
+
+def ast_append_blocks(parent, blocks, notes):
+    for ind, block in enumerate(blocks):
+        if block['t'] == 'Plain':
+            ast_append_inlines(parent, block['c'], notes)
+            if ind < len(blocks) - 1:
+                ast_append_text(parent, '\n')
+        else:
+            ast_append_block(parent, block, notes)
+
+
+ast_inline_tags = {'Emph': 'em', 'Strong': 'strong', 'Underline': 'u', 'Strikeout': 'del',
+                   'Superscript': 'sup', 'Subscript': 'sub'}
+ast_list_number_styles = {'LowerAlpha': 'a', 'UpperAlpha': 'A', 'LowerRoman': 'i', 'UpperRoman': 'I'}
+ast_alignments = {'AlignLeft': 'left', 'AlignRight': 'right', 'AlignCenter': 'center'}
+
+
+def ast_append_block(parent, block, notes):
+    block_type = block['t']
+    content = block.get('c')
+    new_elem = None
+    if block_type == 'Para':
+        # pandoc before 3.0: an image alone in a paragraph with the 'fig:' title is a figure
+        if len(content) == 1 and content[0]['t'] == 'Image' and content[0]['c'][2][1].startswith('fig:'):
+            new_elem = etree.SubElement(parent, 'figure')
+            new_elem.text = '\n'
+            ast_append_inline(new_elem, content[0], notes)
+            new_elem[-1].tail = '\n'
+            figcaption = etree.SubElement(new_elem, 'figcaption', attrib={'aria-hidden': 'true'})
+            ast_append_inlines(figcaption, content[0]['c'][1], notes)
+            figcaption.tail = '\n'
+        else:
+            new_elem = etree.SubElement(parent, 'p')
+            ast_append_inlines(new_elem, content, notes)
+    elif block_type == 'Header':
+        new_elem = etree.SubElement(parent, 'h' + str(content[0]), attrib=ast_attrib(content[1]))
+        ast_append_inlines(new_elem, content[2], notes)
+    elif block_type == 'Div':
+        new_elem = etree.SubElement(parent, 'div', attrib=ast_attrib(content[0]))
+        new_elem.text = '\n'
+        ast_append_blocks(new_elem, content[1], notes)
+    elif block_type == 'BlockQuote':
+        new_elem = etree.SubElement(parent, 'blockquote')
+        new_elem.text = '\n'
+        ast_append_blocks(new_elem, content, notes)
+    elif block_type in ('BulletList', 'OrderedList'):
+        if block_type == 'BulletList':
+            new_elem = etree.SubElement(parent, 'ul')
+            items = content
+        else:
+            list_start, list_style = content[0][0], content[0][1]['t']
+            new_elem = etree.SubElement(parent, 'ol')
+            if list_start != 1:
+                new_elem.attrib['start'] = str(list_start)
+            if list_style in ast_list_number_styles:
+                new_elem.attrib['type'] = ast_list_number_styles[list_style]
+            items = content[1]
+        new_elem.text = '\n'
+        for item in items:
+            li_elem = etree.SubElement(new_elem, 'li')
+            ast_append_blocks(li_elem, item, notes)
+            li_elem.tail = '\n'
+    elif block_type == 'DefinitionList':
+        new_elem = etree.SubElement(parent, 'dl')
+        new_elem.text = '\n'
+        for term, definitions in content:
+            dt_elem = etree.SubElement(new_elem, 'dt')
+            ast_append_inlines(dt_elem, term, notes)
+            dt_elem.tail = '\n'
+            for definition in definitions:
+                dd_elem = etree.SubElement(new_elem, 'dd')
+                ast_append_blocks(dd_elem, definition, notes)
+                dd_elem.tail = '\n'
+    elif block_type == 'LineBlock':
+        new_elem = etree.SubElement(parent, 'div', attrib={'class': 'line-block'})
+        for ind, line in enumerate(content):
+            if ind > 0:
+                etree.SubElement(new_elem, 'br').tail = '\n'
+            ast_append_inlines(new_elem, line, notes)
+    elif block_type == 'CodeBlock':
+        new_elem = etree.SubElement(parent, 'pre', attrib=ast_attrib(content[0]))
+        ast_append_text(etree.SubElement(new_elem, 'code'), content[1])
+    elif block_type == 'RawBlock':
+        ast_append_raw(parent, content[0], content[1])
+    elif block_type == 'HorizontalRule':
+        new_elem = etree.SubElement(parent, 'hr')
+    elif block_type == 'Table':
+        new_elem = ast_append_table(parent, content, notes)
+    elif block_type == 'Figure':
+        new_elem = etree.SubElement(parent, 'figure', attrib=ast_attrib(content[0]))
+        new_elem.text = '\n'
+        ast_append_blocks(new_elem, content[2], notes)
+        if content[1][1]:
+            figcaption = etree.SubElement(new_elem, 'figcaption')
+            ast_append_blocks(figcaption, content[1][1], notes)
+            figcaption.tail = '\n'
+    elif block_type != 'Null':
+        logging.warning('Unknown pandoc block type: ' + block_type + ' File path: ' + current_filepath)
+    if new_elem is not None:
+        new_elem.tail = '\n'
+
+
+def ast_append_table_cell(row_elem, cell_tag, blocks, notes, alignment='AlignDefault', extra_attrib={}):
+    cell_elem = etree.SubElement(row_elem, cell_tag, attrib=extra_attrib)
+    if alignment in ast_alignments:
+        cell_elem.attrib['style'] = 'text-align: ' + ast_alignments[alignment] + ';'
+    ast_append_blocks(cell_elem, blocks, notes)
+    cell_elem.tail = '\n'
+
+
+# Table rows of pandoc 2.10 and later: [Attr, [Cell]], Cell: [Attr, Alignment, RowSpan, ColSpan, [Block]]
+def ast_append_table_rows(section_elem, rows, notes, cell_tag, row_classes):
+    for ind, row in enumerate(rows):
+        row_elem = etree.SubElement(section_elem, 'tr', attrib=ast_attrib(row[0]))
+        if row_classes:
+            row_elem.attrib['class'] = row_classes[ind % len(row_classes)]
+        row_elem.text = '\n'
+        for cell in row[1]:
+            extra_attrib = ast_attrib(cell[0])
+            if cell[2] > 1:
+                extra_attrib['rowspan'] = str(cell[2])
+            if cell[3] > 1:
+                extra_attrib['colspan'] = str(cell[3])
+            ast_append_table_cell(row_elem, cell_tag, cell[4], notes, cell[1]['t'], extra_attrib)
+        row_elem.tail = '\n'
+
+
+# The tr classes are the same as in the html writer ("header", "odd", "even"), post_process_tags() relies on them
+def ast_append_table(parent, content, notes):
+    table_elem = etree.SubElement(parent, 'table')
+    table_elem.text = '\n'
+    if len(content) == 5:
+        # Before pandoc 2.10: [Inline] caption, [Alignment], [Double] widths, header cells, rows of cells
+        caption, alignments, widths, header_cells, rows = content
+        if caption:
+            ast_append_inlines(etree.SubElement(table_elem, 'caption'), caption, notes)
+            table_elem[-1].tail = '\n'
+        ast_append_table_colgroup(table_elem, [width for width in widths if width])
+        if any(header_cells):
+            row_elem = etree.SubElement(etree.SubElement(table_elem, 'thead'), 'tr', attrib={'class': 'header'})
+            for cell_ind, cell in enumerate(header_cells):
+                ast_append_table_cell(row_elem, 'th', cell, notes, alignments[cell_ind]['t'])
+            row_elem.getparent().tail = '\n'
+        tbody_elem = etree.SubElement(table_elem, 'tbody')
+        for row_ind, row in enumerate(rows):
+            row_elem = etree.SubElement(tbody_elem, 'tr', attrib={'class': ('odd', 'even')[row_ind % 2]})
+            for cell_ind, cell in enumerate(row):
+                ast_append_table_cell(row_elem, 'td', cell, notes, alignments[cell_ind]['t'])
+            row_elem.tail = '\n'
+        tbody_elem.tail = '\n'
+        return table_elem
+    table_elem.attrib.update(ast_attrib(content[0]))
+    caption, col_specs, table_head, table_bodies, table_foot = content[1:]
+    if caption[1]:
+        ast_append_blocks(etree.SubElement(table_elem, 'caption'), caption[1], notes)
+        table_elem[-1].tail = '\n'
+    ast_append_table_colgroup(table_elem, [col_spec[1]['c'] for col_spec in col_specs
+                                           if col_spec[1]['t'] == 'ColWidth'])
+    if table_head[1]:
+        thead_elem = etree.SubElement(table_elem, 'thead', attrib=ast_attrib(table_head[0]))
+        ast_append_table_rows(thead_elem, table_head[1], notes, 'th', ['header'])
+        thead_elem.tail = '\n'
+    for table_body in table_bodies:
+        tbody_elem = etree.SubElement(table_elem, 'tbody', attrib=ast_attrib(table_body[0]))
+        ast_append_table_rows(tbody_elem, table_body[2], notes, 'th', ['header'])
+        ast_append_table_rows(tbody_elem, table_body[3], notes, 'td', ['odd', 'even'])
+        tbody_elem.tail = '\n'
+    if table_foot[1]:
+        tfoot_elem = etree.SubElement(table_elem, 'tfoot', attrib=ast_attrib(table_foot[0]))
+        ast_append_table_rows(tfoot_elem, table_foot[1], notes, 'td', ['odd', 'even'])
+        tfoot_elem.tail = '\n'
+    return table_elem
+
+
+# Relative column widths (0.3) as in the html writer: <col style="width: 30%" />
+def ast_append_table_colgroup(table_elem, widths):
+    if not widths:
+        return
+    colgroup_elem = etree.SubElement(table_elem, 'colgroup')
+    for width in widths:
+        etree.SubElement(colgroup_elem, 'col', attrib={'style': 'width: ' + str(round(width * 100)) + '%'})
+    colgroup_elem.tail = '\n'
+
+
+def ast_append_inlines(parent, inlines, notes):
+    for inline in inlines:
+        ast_append_inline(parent, inline, notes)
+
+
+def ast_append_inline(parent, inline, notes):
+    inline_type = inline['t']
+    content = inline.get('c')
+    if inline_type == 'Str':
+        ast_append_text(parent, content)
+    elif inline_type == 'Space':
+        ast_append_text(parent, ' ')
+    elif inline_type == 'SoftBreak':
+        ast_append_text(parent, '\n')
+    elif inline_type == 'LineBreak':
+        etree.SubElement(parent, 'br').tail = '\n'
+    elif inline_type in ast_inline_tags:
+        ast_append_inlines(etree.SubElement(parent, ast_inline_tags[inline_type]), content, notes)
+    elif inline_type == 'SmallCaps':
+        ast_append_inlines(etree.SubElement(parent, 'span', attrib={'class': 'smallcaps'}), content, notes)
+    elif inline_type == 'Span':
+        ast_append_inlines(etree.SubElement(parent, 'span', attrib=ast_attrib(content[0])), content[1], notes)
+    elif inline_type == 'Link':
+        link_attrib = ast_attrib(content[0])
+        if 'reference' in link_attrib:
+            # \ref: the label goes to href as TEXREFSTART/TEXREFEND did
+            etree.SubElement(parent, mc_xref_tag, attrib={'href': link_attrib['reference']})
+        else:
+            link_attrib['href'] = content[2][0]
+            if content[2][1]:
+                link_attrib['title'] = content[2][1]
+            ast_append_inlines(etree.SubElement(parent, 'a', attrib=link_attrib), content[1], notes)
+    elif inline_type == 'Image':
+        image_attrib = {}
+        image_style = ''
+        for key, value in ast_attrib(content[0]).items():
+            # The html writer turns the dimensions into style
+            if key in ('width', 'height'):
+                image_style += key + ':' + value + ';'
+            else:
+                image_attrib[key] = value
+        image_attrib['src'] = content[2][0]
+        if image_style:
+            image_attrib['style'] = image_style
+        image_title = content[2][1]
+        if image_title.startswith('fig:'):
+            image_title = image_title[len('fig:'):]
+        if image_title:
+            image_attrib['title'] = image_title
+        image_attrib['alt'] = ast_stringify(content[1])
+        image_tag = 'embed' if content[2][0].lower().endswith('.pdf') else 'img'
+        etree.SubElement(parent, image_tag, attrib=image_attrib)
+    elif inline_type == 'Code':
+        ast_append_text(etree.SubElement(parent, 'code', attrib=ast_attrib(content[0])), content[1])
+    elif inline_type == 'Math':
+        if content[0]['t'] == 'DisplayMath':
+            math_elem = etree.SubElement(parent, 'span', attrib={'class': 'math display'})
+            math_elem.text = '\\[' + content[1] + '\\]'
+        else:
+            math_elem = etree.SubElement(parent, 'span', attrib={'class': 'math inline'})
+            math_elem.text = '\\(' + content[1] + '\\)'
+    elif inline_type == 'Quoted':
+        if content[0]['t'] == 'SingleQuote':
+            quote_left, quote_right = '‘', '’'
+        else:
+            quote_left, quote_right = '“', '”'
+        ast_append_text(parent, quote_left)
+        ast_append_inlines(parent, content[1], notes)
+        ast_append_text(parent, quote_right)
+    elif inline_type == 'Cite':
+        cite_ids = ' '.join(citation['citationId'] for citation in content[0])
+        ast_append_inlines(etree.SubElement(parent, 'span', attrib={'class': 'citation', 'data-cites': cite_ids}),
+                           content[1], notes)
+    elif inline_type == 'Note':
+        notes.append(content)
+        note_num = str(len(notes))
+        note_ref = etree.SubElement(parent, 'a', attrib={'href': '#fn' + note_num, 'class': 'footnote-ref',
+                                                         'id': 'fnref' + note_num, 'role': 'doc-noteref'})
+        etree.SubElement(note_ref, 'sup').text = note_num
+    elif inline_type == 'RawInline':
+        ast_append_raw(parent, content[0], content[1])
+    else:
+        logging.warning('Unknown pandoc inline type: ' + inline_type + ' File path: ' + current_filepath)
+
+
+# The footnotes section at the end of the body, as the html writer creates it
+def ast_append_notes(body, notes):
+    section_elem = etree.SubElement(body, 'section', attrib={'class': 'footnotes', 'role': 'doc-endnotes'})
+    section_elem.text = '\n'
+    etree.SubElement(section_elem, 'hr').tail = '\n'
+    ol_elem = etree.SubElement(section_elem, 'ol')
+    ol_elem.text = '\n'
+    # A note can have notes of its own, they are added to the end of the list
+    note_ind = 0
+    while note_ind < len(notes):
+        note_num = str(note_ind + 1)
+        li_elem = etree.SubElement(ol_elem, 'li', attrib={'id': 'fn' + note_num, 'role': 'doc-endnote'})
+        ast_append_blocks(li_elem, notes[note_ind], notes)
+        backlink_parent = li_elem[-1] if len(li_elem) and li_elem[-1].tag == 'p' else li_elem
+        etree.SubElement(backlink_parent, 'a', attrib={'href': '#fnref' + note_num, 'class': 'footnote-back',
+                                                       'role': 'doc-backlink'}).text = '↩︎'
+        li_elem.tail = '\n'
+        note_ind += 1
+    ol_elem.tail = '\n'
+    section_elem.tail = '\n'
+
+
+# A converter for convert_text_markers(): one pattern for all the marker types.
+# marker_types: [[marker start, marker end, element tag, attribute name], ...]. The value between the markers
+# goes to the attribute of the new element.
+def build_marker_converter(marker_types):
+    pattern = '|'.join('(?:' + re.escape(marker_type[0]) + '(.*?)' + re.escape(marker_type[1]) + ')'
+                       for marker_type in marker_types)
+    converter = {
+        "pattern": re.compile(pattern, re.DOTALL),
+        "marker_types": marker_types,
+        # Only the text that contains this is searched for the markers
+        "prefix": os.path.commonprefix([marker_type[0] for marker_type in marker_types])
+    }
+    return converter
+
+
+# Splits the text on the markers. Returns the text before the first marker and the new elements,
+# each with the text after it as tail.
+def split_text_markers(text, converter):
     new_elems = []
-    if (element.text is not None) and (string_start in element.text):
-        split = element.text.split(string_start)
-        element.text = split[0]
-        del split[0]
-        ind = 0
-        for text_part in split:
-            end_split = text_part.split(string_end)
-            attributes = {new_attribute_name: end_split[0]}
-            xref_elem = etree.Element(new_elem_tag, attrib=attributes)
-            xref_elem.tail = end_split[1]
-            element.insert(ind, xref_elem)
-            ind += 1
-            new_elems.append(xref_elem)
-    # Processing the tail
-    if (element.tail is not None) and (string_start in element.tail):
-        split = element.tail.split(string_start)
-        element.tail = split[0]
-        del split[0]
-        for text_part in split:
-            end_split = text_part.split(string_end)
-            attributes = {new_attribute_name: end_split[0]}
-            xref_elem = etree.Element(new_elem_tag, attrib=attributes)
-            xref_elem.tail = end_split[1]
-            ind_elem = element.getparent().index(element)
-            element.getparent().insert(ind_elem + 1, xref_elem)
-            new_elems.append(xref_elem)
+    text_before = None
+    ind_last = 0
+    for match in converter['pattern'].finditer(text):
+        if new_elems:
+            new_elems[-1].tail = text[ind_last:match.start()]
+        else:
+            text_before = text[:match.start()]
+        marker_type = converter['marker_types'][match.lastindex - 1]
+        new_elems.append(etree.Element(marker_type[2], attrib={marker_type[3]: match.group(match.lastindex)}))
+        ind_last = match.end()
+    if new_elems:
+        new_elems[-1].tail = text[ind_last:]
+    return text_before, new_elems
+
+
+# Replaces the markers in the text and the tails under element (element included) with new elements, in one walk.
+# A marker without its end marker stays in the text. Returns the new elements in document order.
+def convert_text_markers(element, converter):
+    prefix = converter['prefix']
+    elems_with_markers = [elem for elem in element.iter(tag=etree.Element)
+                          if (elem.text is not None and prefix in elem.text)
+                          or (elem.tail is not None and prefix in elem.tail)]
+    new_elems = []
+    for elem in elems_with_markers:
+        if elem.text is not None and prefix in elem.text:
+            text_before, text_elems = split_text_markers(elem.text, converter)
+            if text_elems:
+                elem.text = text_before
+                for ind, new_elem in enumerate(text_elems):
+                    elem.insert(ind, new_elem)
+                new_elems.extend(text_elems)
+        if elem.tail is not None and prefix in elem.tail and elem.getparent() is not None:
+            tail_before, tail_elems = split_text_markers(elem.tail, converter)
+            if tail_elems:
+                elem.tail = tail_before
+                ind_elem = elem.getparent().index(elem)
+                for ind, new_elem in enumerate(tail_elems):
+                    elem.getparent().insert(ind_elem + 1 + ind, new_elem)
+                new_elems.extend(tail_elems)
     return new_elems
 
 
+# The markers from the preprocessing (see preproc_command_transforms and macros_to_plaintext()).
+# The xrefs are created before the condition passes (see post_process_root()). The snippetBlock elements are created
+# in post_process_content_file(), after the conditions have been set on the elements around the TEXCOMM strings, so
+# that post_move_cond_to_parent() moves them to the paragraph. The labels are not text markers (TEXLABEL is a prefix
+# of the ids, see post_process_1()).
+xref_marker_converter = build_marker_converter([['TEXREFSTART', 'TEXREFEND', mc_xref_tag, 'href']])
+snippet_marker_converter = build_marker_converter([[repl_string_start, repl_string_end, mc_snippet_block_tag, 'src']])
+
+
 # Post-processing functions start
-def post_process_ref(element):
-    all_elements = list(element.iter())
-    for elem in all_elements:
-        # Processing references (\ref)
-        texref_start = 'TEXREFSTART'
-        texref_end = 'TEXREFEND'
-        post_convert_text_to_elem(elem, texref_start, texref_end, mc_xref_tag, 'href')
+def post_process_text_markers(element):
+    convert_text_markers(element, xref_marker_converter)
+
+
+# snippet_rel_path: the snippets directory relative to the directory of the file
+def post_process_snippet_markers(element, snippet_rel_path):
+    for elem in convert_text_markers(element, snippet_marker_converter):
+        # TODO: Check is target file exists
+        elem.attrib['src'] = snippet_rel_path + dir_sep + elem.attrib['src'].lower() + '.flsnp'
 
 
 def append_or_create_attrib(element, attrib_name, string, delimiter=',', style_from_parent=False):
@@ -746,7 +2138,7 @@ def img_in_span_strip(element):
 # Processes divs and spans that pandoc created from \textcolor (ex \ifx)
 def post_process_div_span_cond(element):
     ifxcond_string = 'color: IFXCOND_'
-    divs_with_cond = element.xpath("//div[contains(@style, '" + ifxcond_string + "')]")
+    divs_with_cond = element.xpath(".//div[contains(@style, '" + ifxcond_string + "')]")
     for div in divs_with_cond:
         mc_cond = div.attrib['style'].replace(ifxcond_string, '', 1).lstrip()
         if div.attrib.has_key(mc_cond_attrib_name):
@@ -758,7 +2150,7 @@ def post_process_div_span_cond(element):
         else:
             append_or_create_attrib(div, mc_cond_attrib_name, mc_cond, style_from_parent=False)
             del div.attrib['style']
-    spans_with_cond = element.xpath("//span[contains(@style, '" + ifxcond_string + "')]")
+    spans_with_cond = element.xpath(".//span[contains(@style, '" + ifxcond_string + "')]")
     for span in spans_with_cond:
         # Stripping extra whitespace that pandoc inserts
         img_in_span_strip(span)
@@ -778,7 +2170,7 @@ def post_process_div_span_cond(element):
 
 # Turns the span generated from \caption into p with the caption class.
 def post_captionclass(element):
-    caption_spans = element.xpath("//*[contains(@style, '" + mc_image_caption_class + "')]")
+    caption_spans = element.xpath(".//*[contains(@style, '" + mc_image_caption_class + "')]")
     for elem in caption_spans:
         caption_class = elem.attrib['style'].replace('color: ', '')
         if elem.tag == 'span':
@@ -794,7 +2186,7 @@ def post_captionclass(element):
 
 
 def post_mc_keyword(element):
-    keyword_elems = element.xpath("//*[contains(@style, '" + mc_keyword_textcolor_value + "')]")
+    keyword_elems = element.xpath(".//*[contains(@style, '" + mc_keyword_textcolor_value + "')]")
     for elem in keyword_elems:
         elem.tag = mc_keyword_tag
         elem.attrib['term'] = elem.text
@@ -804,14 +2196,13 @@ def post_mc_keyword(element):
 
 # This function moves the conditions from, for example, span to p, and then strips the span
 def post_move_cond_to_parent(element):
-    spans_with_cond = element.xpath('//span[@MadCap:conditions]', namespaces={'MadCap':madcap_namespace})
+    spans_with_cond = element.xpath('.//span[@MadCap:conditions]', namespaces={'MadCap':madcap_namespace})
     for elem in spans_with_cond:
         if (elem.getparent().tag == 'p') and (len(elem.getparent()) == 1):
             if string_is_none_or_empty(elem.getparent().text, do_strip=True) and string_is_none_or_empty(elem.tail, do_strip=True):
                 if len(elem.getparent().attrib) > 0:
-                    print('WARNING: Parent p has attributes. Look into this: ' + etree.tostring(elem.getparent()).decode())
-                    logging.warning('WARNING: Parent p has attributes. Look into this: ' + etree.tostring(elem.getparent()).decode())
-                    input()
+                    add_diagnostic('post_move_cond_to_parent', 'Parent p has attributes. Look into this:',
+                                   etree.tostring(elem.getparent()).decode())
                 else:
                     elem.getparent().attrib.update(elem.attrib)
                     elem.tag = temp_tag_to_strip
@@ -821,7 +2212,9 @@ def post_move_cond_to_parent(element):
 def post_process_root(xml_root):
     head_elem = xml_root.find('head')
     body_elem = xml_root.find('body')
-    post_process_ref(body_elem)
+    # The JSON backend creates the xref elements when it builds the tree
+    if pandoc_backend != 'json':
+        post_process_text_markers(body_elem)
     # post_strip_elems_with_cond(body_elem)
     post_process_div_span_cond(body_elem)
     post_captionclass(body_elem)
@@ -831,27 +2224,21 @@ def post_process_root(xml_root):
 # For more postprocessing, see the huge loop below (search for comment Various postprocessing)
 
 
+# Returns False if the file already had the same content
 def write_root(root, filename):
-    indent_xml(root)
-    result_str = etree.tostring(root, encoding="UTF-8")
-    xml_declaration = b"<?xml version=\"1.0\" encoding=\"utf-8\"?>\n"
-    result_str = xml_declaration + result_str
-    output_file = open(filename, "wb")
-    output_file.write(result_str)
-    output_file.close()
+    return xml_writer.write_root(root, filename, inline_tags)
 
 
-def create_combined_newcomm_list(toc_entry_list):
+# newcommand_data_list is the list of the extract_newcomm_defs() results for the preamble entries
+def create_combined_newcomm_list(newcommand_data_list):
     comms_to_replace_all = {'all_comms_to_replace': set()}
-    for entry in toc_entry_list:
-        json_path = tmp_root_dir + dir_sep + entry['path'][:-4] + '.json'
-        with open(json_path, encoding="utf-8") as file:
-            comm_data = json.load(file)
+    for comm_data in newcommand_data_list:
+        if comm_data is None:
+            continue
         for entry2 in comm_data['commands_to_replace']:
             # if entry2 in comms_to_replace_all:
             #     print('Entry already in combined list. ' + entry['path'][:-4] + ' ' + entry2)
             comms_to_replace_all['all_comms_to_replace'].add(entry2)
-        # print('Preprocessing: reading commands from: ' + json_path)
     comms_to_replace_all['all_comms_to_replace'] = sorted(list(comms_to_replace_all['all_comms_to_replace']))
     with open('./newcomm/comms_to_replace_all.json', 'w', encoding='utf-8') as file:
         json.dump(comms_to_replace_all, file, indent=4)
@@ -866,6 +2253,8 @@ def create_snippet_root():
     return root
 
 
+# The snippet elements from generate_snip_and_var() by preamble entry path: [[snippet name, element], ...].
+# Kept by entry, so that the elements of one entry can be replaced (see update_preamble_entries()).
 new_newcomm_elements = {}
 
 
@@ -873,6 +2262,7 @@ def generate_snip_and_var(toc_entry):
     source_file_path = flare_dir_content + toc_entry["path"]
     # Just to ensure that path has / as the dir separator
     source_file_path = source_file_path.replace('\\', dir_sep)[0:-4] + '.htm'
+    timer = start_timer(get_report_key(source_file_path))
     source_filename = source_file_path.split('/')[-1]
     check_create_folder(flare_dir_snippets_tex)
     root_tree = etree.parse(source_file_path, parser=parser_xml)
@@ -892,28 +2282,47 @@ def generate_snip_and_var(toc_entry):
             current_parent = current_parent.getparent()
         if len(elem_conditions) > 0:
             elem.attrib[mc_cond_attrib_name] = ','.join(elem_conditions)
-    # Writing the file with conditions applied
-    file_path_with_cond = source_file_path[:-4] + '_with_cond.htm'
-    write_root(root_element, file_path_with_cond)
-    # Writing the snippets (and variables)
-    check_create_folder(flare_dir_snippets_tex)
+    # Indenting as the file with conditions applied would be written (the snippets get copies of these elements)
+    xml_writer.indent_xml(root_element, inline_tags)
+    # Collecting the snippets (and variables). They are written once at the end by write_snippets().
+    entry_newcomm_elements = []
     for elem in newcomm_elems:
         current_elem = copy.deepcopy(elem)
         if 'conditions' in toc_entry:
             append_or_create_attrib(current_elem, mc_cond_attrib_name, toc_entry['conditions'])
         current_newcomm_name = elem.attrib['style'].replace('color: \\', '').lower()
-        item_filename = flare_dir_snippets_tex + current_newcomm_name + '.flsnp'
+        macro_deps['snippets']['{' + elem.attrib['style'].replace('color: ', '') + '}'] = \
+            flare_dir_snippets_tex + current_newcomm_name + '.flsnp'
         del current_elem.attrib['style']
-        if current_newcomm_name in new_newcomm_elements:
-            new_newcomm_elements[current_newcomm_name].find('body').append(current_elem)
-        else:
-            snip_root = create_snippet_root()
-            new_newcomm_elements[current_newcomm_name] = snip_root
-            snip_body = snip_root.find('body')
-            snip_body.append(current_elem)
-        write_root(new_newcomm_elements[current_newcomm_name], item_filename)
+        entry_newcomm_elements.append([current_newcomm_name, current_elem])
+    new_newcomm_elements[toc_entry['path']] = entry_newcomm_elements
     os.remove(source_file_path)
-    os.remove(file_path_with_cond)
+    record_lap(timer, 'generate_snip_and_var')
+    count('snippet_elements', len(newcomm_elems))
+
+
+# Writes each snippet collected by generate_snip_and_var() (or only the snippet_names) to its .flsnp file.
+# The elements of a snippet are in the order of the preamble entries. Returns the files that have changed.
+def write_snippets(snippet_names=None):
+    timer = start_timer()
+    check_create_folder(flare_dir_snippets_tex)
+    snip_roots = {}
+    for entry_newcomm_elements in new_newcomm_elements.values():
+        for current_newcomm_name, current_elem in entry_newcomm_elements:
+            if snippet_names is not None and current_newcomm_name not in snippet_names:
+                continue
+            if current_newcomm_name not in snip_roots:
+                snip_roots[current_newcomm_name] = create_snippet_root()
+            snip_roots[current_newcomm_name].find('body').append(current_elem)
+    changed_filepaths = []
+    for current_newcomm_name, snip_root in snip_roots.items():
+        item_filename = flare_dir_snippets_tex + current_newcomm_name + '.flsnp'
+        if write_root(snip_root, item_filename):
+            changed_filepaths.append(item_filename)
+    record_lap(timer, 'write_snippets')
+    count('snippets_written', len(snip_roots))
+    count('snippets_changed', len(changed_filepaths))
+    return changed_filepaths
 
 
 def tag_is_heading(tag_name):
@@ -979,8 +2388,7 @@ def post_process_1(element):
                 a_elem = etree.SubElement(elem, 'a', attrib=attributes)
             del elem.attrib['id']
         else:
-            print('WARNING. TEXLABEL neither on a span nor on h: ' + etree.tostring(elem).decode())
-            input()
+            add_diagnostic('post_process_1', 'TEXLABEL neither on a span nor on h:', etree.tostring(elem).decode())
     etree.strip_tags(element, temp_tag_to_strip)
     for i, elem in enumerate(anchors):
         anchors[i] = elem[0]
@@ -995,229 +2403,698 @@ def post_strip_empty_elems(element):
             elem.getparent().remove(elem)
 
 
-# START Graphics items config generation
-graphic_items = helper2(source_root_dir)
-graphic_items_config = dict({'graphic_items': graphic_items})
-
-with open(config_file_graphics_items, 'w', encoding='utf-8') as file:
-    json.dump(graphic_items_config, file, indent=4)
-
-# END Graphics config generation
-
-# Execution start
-check_create_folder(pandoc_logs_dir)
-# Processing the preamble entries from the config file and
-# saving results (lists of commands) in json files.
-for toc_entry in json_data['preamble']:
-    extract_newcomm_defs(toc_entry)
-# Reading preamble json files and creating a combined list of commands to replace.
-comms_to_replace_all = create_combined_newcomm_list(json_data['preamble'])
-for toc_entry in json_data['preamble']:
-    preproc(toc_entry)
-# Generate flare items from \newcommand definitions
-for toc_entry in json_data['preamble']:
-    generate_snip_and_var(toc_entry)
+# Returns the lists of elements that post_process_tags() needs, in document order.
+# h5 and h6 are also in the 'p' list, because they become p before the p step.
+def collect_elems_by_tag(element):
+    elems_by_tag = {'br': [], 'code': [], 'dd': [], 'subtopic': [], 'p': [], 'table': [], 'heading': []}
+    for elem in element.iter():
+        tag = elem.tag
+        if tag in ('br', 'code', 'dd', 'p', 'table'):
+            elems_by_tag[tag].append(elem)
+        elif tag in ('h5', 'h6'):
+            elems_by_tag['subtopic'].append(elem)
+            elems_by_tag['p'].append(elem)
+        if tag_is_heading(tag):
+            elems_by_tag['heading'].append(elem)
+    return elems_by_tag
+
+
+# The last steps of post_process_content_file() (br, code, dd, h5/h6, p, table, headings), in this order.
+def post_process_tags(elems_by_tag, current_filepath):
+    # Deleting unnecessary br tags
+    for elem in elems_by_tag['br']:
+        if string_is_none_or_empty(elem.tail, do_strip=True):
+            if not (elem.getnext() is not None and elem.getnext().tag in inline_tags):
+                elem.getparent().remove(elem)
+    # Unbinding code tags if they contain references
+    for elem in elems_by_tag['code']:
+        if elem.find(mc_xref_tag) is not None:
+            etree.strip_tags(elem.getparent(), 'code')
+    # Stripping p from dd (otherwise alignment doesn't work)
+    stripped_p_elems = set()
+    for elem in elems_by_tag['dd']:
+        if elem.find('p') is not None:
+            stripped_p_elems.update(elem.iter('p'))
+            etree.strip_tags(elem, 'p')
+    # Changing h5 and h6 (that pandoc creates from \paragraph) to p.subtopic
+    for elem in elems_by_tag['subtopic']:
+        elem.tag = 'p'
+        elem.attrib['class'] = mc_p_subtopic_class
+    # Replacing the pinching hazard placeholder
+    for elem in elems_by_tag['p']:
+        if elem in stripped_p_elems:
+            continue
+        if elem.text is not None and repl_pinching_hazard_placeholder in elem.text:
+            elem.tag = mc_snippet_block_tag
+            snippet_rel_path = os.path.relpath(os.path.dirname(flare_root_dir + repl_pinching_hazard_snippet_path),
+                                       os.path.dirname(current_filepath)).replace('\\', dir_sep) + dir_sep \
+                               + os.path.basename(flare_root_dir + repl_pinching_hazard_snippet_path)
+            elem.attrib['src'] = snippet_rel_path
+            elem.text = None
+    # Processing tables
+    for table_elem in elems_by_tag['table']:
+        table_elem.attrib['style'] = 'width: 100%'
+        table_elem.attrib['class'] = 'my-table-1'
+        thead = table_elem.find('thead')
+        if thead is not None:
+            tr_in_thead = table_elem.find('thead').find('tr')
+            del tr_in_thead.attrib['class']
+        # The following loop removes the "odd" class from td
+        # for tr in table_elem.find('tbody').findall('tr'):
+        #     if tr.attrib.has_key('class'):
+        #         if tr.attrib['class'] == 'odd':
+        #             del tr.attrib['class']
+    # Removing class="unnumbered" from headings (h5 and h6 are p already)
+    for elem in elems_by_tag['heading']:
+        if tag_is_heading(elem.tag):
+            if elem.attrib.has_key('class'):
+                if elem.attrib['class'] == 'unnumbered':
+                    del elem.attrib['class']
+
+
+# Returns the Flare conditions for a condition string from the tex conditions (category_SEP_value1_MYOR_value2,...)
+# as a tuple in the order of the string, without duplicates. The topics repeat a few hundred distinct strings,
+# so each string is translated once.
+@functools.lru_cache(maxsize=condition_cache_size)
+def translate_tex_conditions(cond_raw):
+    final_conds = []
+    for cond_part in cond_raw.split(','):
+        split_cond_part = cond_part.split('_SEP_')
+        flare_category = flare_cond_map[split_cond_part[0]]
+        for myor in split_cond_part[1].split('_MYOR_'):
+            final_cond = flare_category + '.' + flare_cond_map[myor]
+            if final_cond not in final_conds:
+                final_conds.append(final_cond)
+    return tuple(final_conds)
+
+
+@functools.lru_cache(maxsize=condition_cache_size)
+def get_flare_conditions_attrib(cond_raw):
+    return sys.intern(','.join(translate_tex_conditions(cond_raw)))
+
+
+# For the conditions with both productNumber and productType, returns the series condition (the first one)
+# and the other conditions (see the condition fix in post_process_content_file()). Returns None for the rest.
+@functools.lru_cache(maxsize=condition_cache_size)
+def split_series_condition(flare_conditions):
+    if flare_cond_map['productNumber'] not in flare_conditions or flare_cond_map['productType'] not in flare_conditions:
+        return None
+    split_conds = flare_conditions.split(',')
+    series_cond = split_conds[0]
+    split_conds.remove(series_cond)
+    return series_cond, ','.join(split_conds)
 
-# Processing of the content of the User Manual starts here
-# toc_parts are the Preface part, the HW part, and the SW part.
 
-# Various postprocessing
+# The final post-processing of one .htm or .flsnp file in the Content directory:
 # * Replacing condition values with values from the Flare project
 # * Processing img elements
-# * Adding values to glob_anchors, glob_refs
-glob_anchors = []
-glob_refs = []
-for root_dir, dirs, files in os.walk(flare_dir_content):
-    root_dir = root_dir.replace(os.path.sep, dir_sep)
-    for filename in files:
-        if filename.endswith(('.htm', '.flsnp')):
-            current_filepath = root_dir + dir_sep + filename
-            root_tree = etree.parse(current_filepath, parser=parser_xml)
-            root_element = root_tree.getroot()
-            # Replacing the TEXCOMM strings with variable/snippet elements
-            if repl_string_start in etree.tostring(root_element, encoding='utf-8').decode():
-                for elem in root_element.iter():
-                    new_elements = post_convert_text_to_elem(elem, repl_string_start, repl_string_end, mc_snippet_block_tag, 'src')
-                    for new_elem in new_elements:
-                        # TODO: Check is target file exists
-                        rel_path = os.path.relpath(flare_dir_snippets_tex, root_dir).replace('\\', dir_sep)
-                        new_elem.attrib['src'] = rel_path + dir_sep + new_elem.attrib['src'].lower() + '.flsnp'
-            # Replacing the condition placeholders with the Flare conditions
-            if 'MadCap:conditions' in etree.tostring(root_element, encoding='utf-8').decode():
-                for elem in root_element.iter():
-                    if elem.attrib.has_key(mc_cond_attrib_name):
-                        cond_raw = elem.attrib[mc_cond_attrib_name]
-                        split1 = cond_raw.split(',')
-                        final_conds = []
-                        for cond_part in split1:
-                            split_cond_part = cond_part.split('_SEP_')
-                            split_cond_part[0] = flare_cond_map[split_cond_part[0]]
-                            or_split = split_cond_part[1].split('_MYOR_')
-                            for myor in or_split:
-                                final_conds.append(split_cond_part[0] + '.' + flare_cond_map[myor])
-                        elem.attrib[mc_cond_attrib_name] = ','.join(final_conds)
-            # Doing extra processing (ref, label, and more)
-            post_move_cond_to_parent(root_element)
-            anch_ref = post_process_1(root_element)
-            post_strip_empty_elems(root_element)
-            # Extracting anchors (labels) and references
-            for anch in anch_ref['anchors']:
-                glob_anchors.append([anch, current_filepath])
-            for ref in anch_ref['references']:
-                glob_refs.append([ref, current_filepath])
-            # Processing image paths. Just for me to search: graphics, figure.
-            # Also deleting unnecessary attributes.
-            # Before processing, changing all embed tags to img tags.
-            embed_elems = root_element.xpath('//embed')
-            for embed_elem in embed_elems:
-                embed_elem.tag = 'img'
-            img_elems = root_element.xpath('//img')
-            for img_elem in img_elems:
-                if img_elem.attrib.has_key('alt'):
-                    del img_elem.attrib['alt']
-                # Processing the src attribute. Putting the correct path to an image.
-                # And getting the class attribute using the size map json file and the graphics items json file.
-                current_src = img_elem.attrib['src']
-                current_tex_filepath = current_filepath.replace(flare_dir_content, '')
-                index_of_dot = current_tex_filepath.rfind('.')
-                current_tex_filepath = current_tex_filepath[0:index_of_dot] + '.tex'
-                # Handling '.htm' and '.flsnp' separately, because flsnp are new files generated from \newcommand definitions
-                if current_filepath.endswith('.flsnp'):
-                    for key, value in graphic_items.items():
-                        if current_src in value:
-                            style_from_tex = value[current_src]
-                else:
-                    if current_tex_filepath not in graphic_items:
-                        logging.error('ERROR: the tex file path is not in the graphic items dict: ' + current_tex_filepath)
-                    else:
-                        if current_src not in graphic_items[current_tex_filepath]:
-                            logging.error('ERROR: the image src not in graphic items dict: ' + current_src)
-                        else:
-                            style_from_tex = graphic_items[current_tex_filepath][current_src]
-                # Processing case when style_from_tex is None (so that it matches the 'null' key in the image map)
-                if style_from_tex is None:
-                    style_from_tex = 'null'
-                flare_img_class = graphics_size_map['graphic_size_map'][style_from_tex]['flare_class']
-                if img_elem.attrib.has_key('class'):
-                    logging.error('ERROR: the img element has the class attrib already: ' + current_filepath + ', ' + current_src)
+# * Extracting anchors (labels) and references
+# Returns the anchors and references of the file, the images to copy, and the logged messages.
+# Runs in the worker processes of post_process_content() (or in the main process with one worker).
+def post_process_content_file(filepath):
+    global current_filepath
+    current_filepath = filepath
+    time_start = time.perf_counter()
+    root_dir = os.path.dirname(current_filepath)
+    copy_jobs = []
+    diagnostics_start = len(diagnostics)
+    get_worker_log_messages()
+    root_tree = etree.parse(current_filepath, parser=parser_xml)
+    root_element = root_tree.getroot()
+    # The snippetBlock elements from the TEXCOMM strings (see snippet_marker_converter), before the conditions
+    # are replaced with the Flare conditions and moved to the paragraphs
+    snippet_rel_path = os.path.relpath(flare_dir_snippets_tex, root_dir).replace('\\', dir_sep)
+    post_process_snippet_markers(root_element, snippet_rel_path)
+    for elem in root_element.iter():
+        if elem.attrib.has_key(mc_cond_attrib_name):
+            elem.attrib[mc_cond_attrib_name] = get_flare_conditions_attrib(elem.attrib[mc_cond_attrib_name])
+    # Doing extra processing (ref, label, and more)
+    post_move_cond_to_parent(root_element)
+    anch_ref = post_process_1(root_element)
+    post_strip_empty_elems(root_element)
+    # Processing image paths. Just for me to search: graphics, figure.
+    # Also deleting unnecessary attributes.
+    # Before processing, changing all embed tags to img tags.
+    # The images change only attributes, so the same list of elements is used for the conditions below.
+    all_elems = list(root_element.iter())
+    img_elems = []
+    for elem in all_elems:
+        if elem.tag == 'embed':
+            elem.tag = 'img'
+        if elem.tag == 'img':
+            img_elems.append(elem)
+    for img_elem in img_elems:
+        if img_elem.attrib.has_key('alt'):
+            del img_elem.attrib['alt']
+        # Processing the src attribute. Putting the correct path to an image.
+        # And getting the class attribute using the size map json file and the graphics items json file.
+        current_src = img_elem.attrib['src']
+        current_tex_filepath = current_filepath.replace(flare_dir_content, '')
+        index_of_dot = current_tex_filepath.rfind('.')
+        current_tex_filepath = current_tex_filepath[0:index_of_dot] + '.tex'
+        style_from_tex = None
+        # Handling '.htm' and '.flsnp' separately, because flsnp are new files generated from \newcommand definitions
+        if current_filepath.endswith('.flsnp'):
+            if current_src not in graphics_index['by_src']:
+                logging.error('ERROR: the image src not in graphic items dict: ' + current_src)
+            else:
+                style_from_tex = graphics_index['by_src'][current_src]['style']
+        else:
+            if current_tex_filepath not in graphic_items:
+                logging.error('ERROR: the tex file path is not in the graphic items dict: ' + current_tex_filepath)
+            else:
+                if current_src not in graphic_items[current_tex_filepath]:
+                    logging.error('ERROR: the image src not in graphic items dict: ' + current_src)
                 else:
-                    img_elem.attrib['class'] = flare_img_class
-                    # Deleting the style attrib after adding the class
-                    if img_elem.attrib.has_key('style'):
-                        del img_elem.attrib['style']
-                # Processing the src path (adding extension)
-                tex_img_full_path = source_root_dir + current_src
-                if any(current_src.endswith(extension) for extension in tex_graphics_extensions_priority):
-                    path_with_extension = tex_img_full_path
-                    target_path = path_with_extension.replace(source_root_dir, flare_graphics_from_tex_dir)
-                    pathlib.Path(os.path.dirname(target_path)).mkdir(parents=True, exist_ok=True)
-                    shutil.copy(path_with_extension, target_path)
-                    img_rel_path = os.path.relpath(os.path.dirname(target_path),
-                                                   os.path.dirname(current_filepath)).replace('\\', dir_sep)
-                    img_elem.attrib['src'] = img_rel_path + '/' + os.path.basename(target_path)
-                    pdf_extensions = ('.pdf', '.PDF')
-                    if target_path.endswith(pdf_extensions):
-                        img_elem.attrib['src'] = img_elem.attrib['src'] + '#1'
+                    style_from_tex = graphic_items[current_tex_filepath][current_src]
+        # Processing case when style_from_tex is None (so that it matches the 'null' key in the image map)
+        if style_from_tex is None:
+            style_from_tex = 'null'
+        flare_img_class = graphics_size_map['graphic_size_map'][style_from_tex]['flare_class']
+        if img_elem.attrib.has_key('class'):
+            logging.error('ERROR: the img element has the class attrib already: ' + current_filepath + ', ' + current_src)
+        else:
+            img_elem.attrib['class'] = flare_img_class
+            # Deleting the style attrib after adding the class
+            if img_elem.attrib.has_key('style'):
+                del img_elem.attrib['style']
+        # Processing the src path (adding extension)
+        tex_img_full_path = source_root_dir + current_src
+        if any(current_src.endswith(extension) for extension in tex_graphics_extensions_priority):
+            path_with_extension = tex_img_full_path
+            target_path = path_with_extension.replace(source_root_dir, flare_graphics_from_tex_dir)
+            copy_jobs.append([path_with_extension, target_path])
+            img_rel_path = os.path.relpath(os.path.dirname(target_path),
+                                           os.path.dirname(current_filepath)).replace('\\', dir_sep)
+            img_elem.attrib['src'] = img_rel_path + '/' + os.path.basename(target_path)
+            pdf_extensions = ('.pdf', '.PDF')
+            if target_path.endswith(pdf_extensions):
+                img_elem.attrib['src'] = img_elem.attrib['src'] + '#1'
+        else:
+            # The case when the graphic path does not have an extension in tex
+            path_with_extension = resolve_graphics_extension(tex_img_full_path)
+            if path_with_extension is not None:
+                target_path = path_with_extension.replace(source_root_dir, flare_graphics_from_tex_dir)
+                copy_jobs.append([path_with_extension, target_path])
+                img_rel_path = os.path.relpath(os.path.dirname(target_path), os.path.dirname(current_filepath)).replace('\\', dir_sep)
+                img_elem.attrib['src'] = img_rel_path + '/' + os.path.basename(target_path)
+                pdf_extensions = ('.pdf', '.PDF')
+                if target_path.endswith(pdf_extensions):
+                    img_elem.attrib['src'] = img_elem.attrib['src'] + '#1'
+    # Fixing the issue with conditions: In Flare, if a least one condition on an element is included
+    # in the target settings, the element is included even if other conditions on the same element are
+    # excluded on the target.
+    for elem in all_elems:
+        if mc_cond_attrib_name not in elem.attrib:
+            continue
+        series_split = split_series_condition(elem.attrib[mc_cond_attrib_name])
+        if series_split is not None:
+            series_cond, other_cond = series_split
+            if element_has_text_or_child_tail(elem):
+                if len(elem) == 0:
+                    etree.SubElement(elem, "span", {mc_cond_attrib_name: other_cond}).text = elem.text
+                    elem.text = None
+                    elem.attrib[mc_cond_attrib_name] = series_cond
                 else:
-                    # This loop is for the case when the graphic path does not have an extension in tex
-                    for extension in tex_graphics_extensions_priority:
-                        path_with_extension = tex_img_full_path + extension
-                        target_path = path_with_extension.replace(source_root_dir, flare_graphics_from_tex_dir)
-                        pathlib.Path(os.path.dirname(target_path)).mkdir(parents=True, exist_ok=True)
-                        try:
-                            shutil.copy(path_with_extension, target_path)
-                            img_rel_path = os.path.relpath(os.path.dirname(target_path), os.path.dirname(current_filepath)).replace('\\', dir_sep)
-                            img_elem.attrib['src'] = img_rel_path + '/' + os.path.basename(target_path)
-                            pdf_extensions = ('.pdf', '.PDF')
-                            if target_path.endswith(pdf_extensions):
-                                img_elem.attrib['src'] = img_elem.attrib['src'] + '#1'
-                            break
-                        except:
-                            continue
-            # Fixing the issue with conditions: In Flare, if a least one condition on an element is included
-            # in the target settings, the element is included even if other conditions on the same element are
-            # excluded on the target.
-            for elem in list(root_element.iter()):
-                if mc_cond_attrib_name in elem.attrib and flare_cond_map['productNumber'] in elem.attrib[mc_cond_attrib_name]\
-                        and flare_cond_map['productType'] in elem.attrib[mc_cond_attrib_name]:
-                    series_cond = elem.attrib[mc_cond_attrib_name].split(',')[0]
-                    other_cond = elem.attrib[mc_cond_attrib_name].split(',')
-                    other_cond.remove(series_cond)
-                    other_cond = ','.join(other_cond)
-                    if element_has_text_or_child_tail(elem):
-                        if len(elem) == 0:
-                            etree.SubElement(elem, "span", {mc_cond_attrib_name: other_cond}).text = elem.text
-                            elem.text = None
-                            elem.attrib[mc_cond_attrib_name] = series_cond
-                        else:
-                            copy_of_elem = copy.deepcopy(elem)
-                            copy_of_elem.tag = 'span'
-                            copy_of_elem.attrib[mc_cond_attrib_name] = other_cond
-                            elem.text = None
-                            for child_to_remove in list(elem.getchildren()):
-                                elem.remove(child_to_remove)
-                            elem.append(copy_of_elem)
-                            elem.attrib[mc_cond_attrib_name] = series_cond
-                    else:
-                        for child in elem:
-                            append_or_create_attrib(child, mc_cond_attrib_name, other_cond)
-                        elem.attrib[mc_cond_attrib_name] = series_cond
-            # Deleting unnecessary br tags
-            br_elems = root_element.xpath('//br')
-            for elem in br_elems:
-                if string_is_none_or_empty(elem.tail, do_strip=True):
-                    if not (elem.getnext() is not None and elem.getnext().tag in inline_tags):
-                        elem.getparent().remove(elem)
-            # Unbinding code tags if they contain references
-            code_elems = root_element.xpath('//code')
-            for elem in code_elems:
-                if elem.find(mc_xref_tag) is not None:
-                    etree.strip_tags(elem.getparent(), 'code')
-            # Stripping p from dd (otherwise alignment doesn't work)
-            dd_elems = root_element.xpath('//dd')
-            for elem in dd_elems:
-                if elem.find('p') is not None:
-                    etree.strip_tags(elem, 'p')
-            # Changing h5 and h6 (that pandoc creates from \paragraph) to p.subtopic
-            h5_elems = root_element.xpath("//h5")
-            for elem in h5_elems:
-                elem.tag = 'p'
-                elem.attrib['class'] = mc_p_subtopic_class
-            h6_elems = root_element.xpath("//h6")
-            for elem in h6_elems:
-                elem.tag = 'p'
-                elem.attrib['class'] = mc_p_subtopic_class
-            # Replacing the pinching hazard placeholder
-            p_elems = root_element.xpath("//p")
-            for elem in p_elems:
-                if elem.text is not None and repl_pinching_hazard_placeholder in elem.text:
-                    elem.tag = mc_snippet_block_tag
-                    snippet_rel_path = os.path.relpath(os.path.dirname(flare_root_dir + repl_pinching_hazard_snippet_path),
-                                               os.path.dirname(current_filepath)).replace('\\', dir_sep) + dir_sep \
-                                       + os.path.basename(flare_root_dir + repl_pinching_hazard_snippet_path)
-                    elem.attrib['src'] = snippet_rel_path
+                    copy_of_elem = copy.deepcopy(elem)
+                    copy_of_elem.tag = 'span'
+                    copy_of_elem.attrib[mc_cond_attrib_name] = other_cond
                     elem.text = None
-            # Processing tables
-            table_elems = root_element.xpath('//table')
-            for table_elem in table_elems:
-                table_elem.attrib['style'] = 'width: 100%'
-                table_elem.attrib['class'] = 'my-table-1'
-                thead = table_elem.find('thead')
-                if thead is not None:
-                    tr_in_thead = table_elem.find('thead').find('tr')
-                    del tr_in_thead.attrib['class']
-                # The following loop removes the "odd" class from td
-                # for tr in table_elem.find('tbody').findall('tr'):
-                #     if tr.attrib.has_key('class'):
-                #         if tr.attrib['class'] == 'odd':
-                #             del tr.attrib['class']
-            # Removing class="unnumbered" from headings
-            for elem in root_element.iter():
-                if tag_is_heading(elem.tag):
-                    if elem.attrib.has_key('class'):
-                        if elem.attrib['class'] == 'unnumbered':
-                            del elem.attrib['class']
-            write_root(root_element, current_filepath)
-
-
-print('Program finished.')
+                    for child_to_remove in list(elem.getchildren()):
+                        elem.remove(child_to_remove)
+                    elem.append(copy_of_elem)
+                    elem.attrib[mc_cond_attrib_name] = series_cond
+            else:
+                for child in elem:
+                    append_or_create_attrib(child, mc_cond_attrib_name, other_cond)
+                elem.attrib[mc_cond_attrib_name] = series_cond
+    # The elements for the rest of the steps are collected in one walk. The steps below don't remove or
+    # add elements that another step needs, except the p elements stripped from dd (see post_process_tags).
+    elems_by_tag = collect_elems_by_tag(root_element)
+    post_process_tags(elems_by_tag, current_filepath)
+    write_root(root_element, current_filepath)
+    post_process_result = {
+        "filepath": current_filepath,
+        "seconds": time.perf_counter() - time_start,
+        "bytes_out": os.path.getsize(current_filepath),
+        "anchors": anch_ref['anchors'],
+        "references": anch_ref['references'],
+        "copy_jobs": copy_jobs,
+        "snippet_srcs": snippet_index.get_snippet_srcs(root_element),
+        "diagnostics": diagnostics[diagnostics_start:],
+        "log_messages": get_worker_log_messages()
+    }
+    # The diagnostics go back with the result and are added in the merge, as in the worker processes
+    del diagnostics[diagnostics_start:]
+    return post_process_result
+
+
+# The two-way index of the images from helper2():
+# * by_tex_path: tex file path -> image src -> style (the graphic items themselves)
+# * by_src: image src -> {'style': style, 'tex_paths': tex files that use the image}
+# * conflicts: image src -> {style: tex files} for the images that have different styles in different tex files
+# If an image has different styles, by_src keeps the style from the last tex file (as the old lookup did).
+def build_graphics_index(graphic_items):
+    by_src = {}
+    styles_by_src = {}
+    for tex_path, items in graphic_items.items():
+        for src, style in items.items():
+            if src not in by_src:
+                by_src[src] = {'style': style, 'tex_paths': []}
+                styles_by_src[src] = {}
+            by_src[src]['style'] = style
+            by_src[src]['tex_paths'].append(tex_path)
+            styles_by_src[src].setdefault(str(style), []).append(tex_path)
+    conflicts = {}
+    for src, styles in styles_by_src.items():
+        if len(styles) > 1:
+            conflicts[src] = styles
+    graphics_index = {
+        "by_tex_path": graphic_items,
+        "by_src": by_src,
+        "conflicts": conflicts
+    }
+    return graphics_index
+
+
+def report_graphics_index_conflicts(graphics_index):
+    for src, styles in graphics_index['conflicts'].items():
+        print('WARNING: The image has different styles in different tex files: ' + src + ' ' + json.dumps(styles))
+        logging.warning('WARNING: The image has different styles in different tex files: ' + src + ' ' + json.dumps(styles))
+
+
+# Names of the files in each graphics source directory (per process), see resolve_graphics_extension()
+graphics_dir_listings = {}
+
+
+# Returns the path with the first extension from tex_graphics_extensions_priority for which the file exists,
+# or None. Each directory is listed only once, instead of trying to copy each possible file.
+def resolve_graphics_extension(path_without_extension):
+    dirpath = os.path.dirname(path_without_extension)
+    if dirpath not in graphics_dir_listings:
+        try:
+            graphics_dir_listings[dirpath] = set(os.path.normcase(filename) for filename in os.listdir(dirpath or '.'))
+        except OSError:
+            graphics_dir_listings[dirpath] = set()
+    filename = os.path.basename(path_without_extension)
+    for extension in tex_graphics_extensions_priority:
+        if os.path.normcase(filename + extension) in graphics_dir_listings[dirpath]:
+            return path_without_extension + extension
+    return None
+
+
+def file_sha256(filepath):
+    file_hash = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+# Returns True if the target is already a copy of the source: the same size, and the same mtime
+# (shutil.copy2 keeps it) or, with graphics_copy_compare_hash, the same content.
+def graphics_target_up_to_date(source_path, target_path):
+    try:
+        source_stat = os.stat(source_path)
+        target_stat = os.stat(target_path)
+    except OSError:
+        return False
+    if source_stat.st_size != target_stat.st_size:
+        return False
+    if int(source_stat.st_mtime) == int(target_stat.st_mtime):
+        return True
+    return graphics_copy_compare_hash and file_sha256(source_path) == file_sha256(target_path)
+
+
+# Returns 'copied', 'skipped', or the error message
+def copy_graphics_file(copy_job):
+    source_path, target_path = copy_job
+    try:
+        if graphics_target_up_to_date(source_path, target_path):
+            return 'skipped'
+        pathlib.Path(os.path.dirname(target_path)).mkdir(parents=True, exist_ok=True)
+        shutil.copy2(source_path, target_path)
+        return 'copied'
+    except OSError as error:
+        return str(error)
+
+
+# Copies the images that the topics use to flare_graphics_from_tex_dir. Each source is copied once,
+# even if many topics use it, and the targets that are already up to date are skipped.
+def copy_graphics(copy_jobs):
+    timer = start_timer()
+    unique_copy_jobs = []
+    copy_jobs_seen = set()
+    for copy_job in copy_jobs:
+        if tuple(copy_job) not in copy_jobs_seen:
+            copy_jobs_seen.add(tuple(copy_job))
+            unique_copy_jobs.append(copy_job)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=graphics_copy_threads) as executor:
+        copy_results = list(executor.map(copy_graphics_file, unique_copy_jobs))
+    for copy_job, copy_result in zip(unique_copy_jobs, copy_results):
+        if copy_result not in ('copied', 'skipped'):
+            print('ERROR: Could not copy the image: ' + copy_job[0] + ' ' + copy_result)
+            logging.error('ERROR: Could not copy the image: ' + copy_job[0] + ' ' + copy_result)
+    logging.info('Images copied: ' + str(copy_results.count('copied')) + ', up to date: ' + str(copy_results.count('skipped')))
+    record_lap(timer, 'copy_graphics')
+    count('images_copied', copy_results.count('copied'))
+    count('images_up_to_date', copy_results.count('skipped'))
+
+
+# Log records of the current file in a worker process (see init_post_process_worker()).
+worker_log_handler = None
+
+
+def get_worker_log_messages():
+    log_messages = []
+    if worker_log_handler is not None:
+        for record in worker_log_handler.buffer:
+            log_messages.append([record.levelno, record.getMessage()])
+        worker_log_handler.flush()
+    return log_messages
+
+
+# Worker processes don't write to the log file themselves. They keep the log records and return them
+# with the result of each file, so that the main process logs them in a fixed order.
+def init_post_process_worker(graphics_index_from_main):
+    global graphic_items, graphics_index, worker_log_handler, prompt_on_warnings
+    graphics_index = graphics_index_from_main
+    graphic_items = graphics_index['by_tex_path']
+    # Workers have no console input
+    prompt_on_warnings = False
+    worker_log_handler = logging.handlers.BufferingHandler(capacity=sys.maxsize)
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(worker_log_handler)
+    root_logger.setLevel(logging.INFO)
+
+
+# Post-processes all .htm and .flsnp files in the Content directory (or only the given files)
+# with post_process_content_workers processes.
+# The results are merged in the os.walk() order, so the output doesn't depend on the number of workers.
+def post_process_content(filepaths=None):
+    walk_content = filepaths is None
+    if walk_content:
+        filepaths = []
+        for root_dir, dirs, files in os.walk(flare_dir_content):
+            # Without the trailing separator of flare_dir_content, so that the paths match the target paths
+            root_dir = root_dir.replace(os.path.sep, dir_sep).rstrip(dir_sep)
+            for filename in files:
+                if filename.endswith(('.htm', '.flsnp')):
+                    filepaths.append(root_dir + dir_sep + filename)
+    workers = min(post_process_content_workers, len(filepaths))
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=init_post_process_worker, initargs=(graphics_index,)) as pool:
+            results = list(pool.imap(post_process_content_file, filepaths, chunksize=4))
+    else:
+        results = [post_process_content_file(filepath) for filepath in filepaths]
+    glob_anchors = []
+    glob_refs = []
+    copy_jobs = []
+    snippet_srcs = {}
+    for result in results:
+        for log_message in result['log_messages']:
+            logging.log(log_message[0], log_message[1])
+        diagnostics.extend(result['diagnostics'])
+        record_stage('post_process_content', result['seconds'], get_report_key(result['filepath']),
+                     bytes_out=result['bytes_out'])
+        for anch in result['anchors']:
+            glob_anchors.append([anch, result['filepath']])
+        for ref in result['references']:
+            glob_refs.append([ref, result['filepath']])
+        copy_jobs.extend(result['copy_jobs'])
+        snippet_srcs[result['filepath']] = result['snippet_srcs']
+    copy_graphics(copy_jobs)
+    return {'anchors': glob_anchors, 'references': glob_refs, 'snippet_srcs': snippet_srcs}
+
+
+
+# Saves the snippet srcs of the written topics (filepath -> srcs, see post_process_content() and resolve_xrefs())
+# to the snippet index of the project. Must run after the last write to the topics, so that the index has their
+# final mtime and size. The index is shared with the other scripts, so the topic paths are relative to the Content
+# directory. With all_topics, the topics under from-latex/ that are not in snippet_srcs have been removed.
+def update_snippet_index(snippet_srcs, all_topics=False):
+    topic_snippet_index = {"topics": {}}
+    for filepath, srcs in snippet_srcs.items():
+        if filepath.endswith('.htm'):
+            snippet_index.update_topic(topic_snippet_index, flare_dir_content_root,
+                                       snippet_index.get_topic_path(flare_dir_content_root, filepath), srcs)
+    if all_topics:
+        snippet_index.update_saved_index(flare_dir_content_root, topic_snippet_index['topics'],
+                                         snippet_index.get_topic_path(flare_dir_content_root, flare_dir_content) + dir_sep)
+    elif topic_snippet_index['topics']:
+        snippet_index.update_saved_index(flare_dir_content_root, topic_snippet_index['topics'])
+
+# Rewrites the href of the xrefs from the label to the file with the label, relative to the file with the xref
+# (file.htm#label). Only the files with references are parsed again. If a label is in more than one file,
+# the first file (in the os.walk() order) is used. The dangling and the duplicate labels go to xref_report.
+# The xrefs that have been resolved before (in the watch mode, see update_xrefs()) are resolved again by the label.
+# Returns the snippet srcs of the written files (see update_snippet_index()).
+def resolve_xrefs(glob_anchors, glob_refs):
+    timer = start_timer()
+    anchor_files = {}
+    for anchor, filepath in glob_anchors:
+        if anchor not in anchor_files:
+            anchor_files[anchor] = [filepath]
+        # The anchors of a file come one after another
+        elif anchor_files[anchor][-1] != filepath:
+            anchor_files[anchor].append(filepath)
+    dangling_refs = {}
+    xrefs_resolved = 0
+    snippet_srcs = {}
+    for filepath in dict.fromkeys(filepath for ref, filepath in glob_refs):
+        root_element = etree.parse(filepath, parser=parser_xml).getroot()
+        for elem in root_element.iter(mc_xref_tag):
+            label = elem.attrib.get('href')
+            if label is not None and '#' in label:
+                label = label.rsplit('#', 1)[1]
+            if label in anchor_files:
+                target_rel_path = os.path.relpath(anchor_files[label][0], os.path.dirname(filepath)).replace('\\', dir_sep)
+                elem.attrib['href'] = target_rel_path + '#' + label
+                xrefs_resolved += 1
+            elif label is None:
+                # Not from a \ref (see post_process_text_markers()): the element is kept as it is
+                logging.warning('WARNING: An xref without href in ' + filepath)
+            else:
+                elem.attrib['href'] = label
+                if label not in dangling_refs:
+                    dangling_refs[label] = []
+                dangling_refs[label].append(filepath)
+        write_root(root_element, filepath)
+        snippet_srcs[filepath] = snippet_index.get_snippet_srcs(root_element)
+    duplicate_anchors = {anchor: filepaths for anchor, filepaths in anchor_files.items() if len(filepaths) > 1}
+    for label, filepaths in dangling_refs.items():
+        logging.warning('WARNING: Reference to a missing label: ' + str(label) + ' in ' + ', '.join(filepaths))
+    for anchor, filepaths in duplicate_anchors.items():
+        logging.warning('WARNING: The label is in more than one file: ' + anchor + ' in ' + ', '.join(filepaths)
+                        + '. The references go to the first one.')
+    with open(xref_report, 'w', encoding='utf-8') as file:
+        json.dump({'dangling': dangling_refs, 'duplicates': duplicate_anchors}, file, indent=4)
+    print('References resolved: ' + str(xrefs_resolved) + ', missing labels: ' + str(len(dangling_refs))
+          + ', duplicate labels: ' + str(len(duplicate_anchors)) + ' (see ' + xref_report + ')')
+    record_lap(timer, 'resolve_xrefs')
+    count('xrefs_resolved', xrefs_resolved)
+    return snippet_srcs
+
+
+# The modification time and size of each file (None if the file is missing)
+def get_source_state(filepaths):
+    source_state = {}
+    for filepath in filepaths:
+        try:
+            file_stat = os.stat(filepath)
+            source_state[filepath] = (file_stat.st_mtime_ns, file_stat.st_size)
+        except FileNotFoundError:
+            source_state[filepath] = None
+    return source_state
+
+
+# The toc entries and their children in config order
+def flatten_toc_entries(toc_entries, flat_entries):
+    for toc_entry in toc_entries:
+        flat_entries.append(toc_entry)
+        if 'children' in toc_entry and toc_entry['children'] is not None:
+            flatten_toc_entries(toc_entry['children'], flat_entries)
+    return flat_entries
+
+
+# Replaces the anchors and references of the post-processed files in glob_anch_ref, and resolves the references
+# in these files and in the other files that reference a label that was or is in them. xref_report then has
+# only the references of these files. Returns the snippet srcs of the files written by resolve_xrefs().
+def update_xrefs(glob_anch_ref, anch_ref, filepaths):
+    filepaths = set(filepaths)
+    labels_changed = set(anchor for anchor, filepath in glob_anch_ref['anchors'] if filepath in filepaths)
+    labels_changed.update(anchor for anchor, filepath in anch_ref['anchors'])
+    glob_anch_ref['anchors'] = [anchor for anchor in glob_anch_ref['anchors'] if anchor[1] not in filepaths] \
+        + anch_ref['anchors']
+    glob_anch_ref['references'] = [ref for ref in glob_anch_ref['references'] if ref[1] not in filepaths] \
+        + anch_ref['references']
+    refs_to_resolve = [ref for ref in glob_anch_ref['references'] if ref[1] in filepaths or ref[0] in labels_changed]
+    return resolve_xrefs(glob_anch_ref['anchors'], refs_to_resolve)
+
+
+# Converts the changed entries again with the state of the full run (the graphics index, the commands to replace,
+# and the snippet elements of the other preamble entries):
+# * The changed preamble entries, and the snippet files of the changed commands (see update_macro_definitions())
+#   and of the entries. If commands to replace have been added or removed, the preamble entries and the topics
+#   that use them (see get_topics_using_macros()) are converted too. A topic only has the src of a snippet,
+#   so a changed definition doesn't change the topics that use it.
+# * The changed topics, through the build cache and convert_topics() as in the full run.
+# The written snippet files and topics are post-processed, and their xrefs are resolved (see update_xrefs()).
+# The TOC comes from the config, which is not read again, so the .fltoc file is only written again if it has been
+# changed or removed since the full run.
+def update_source_entries(changed_entries, glob_anch_ref, flare_toc_root):
+    global comms_to_replace_all
+    preamble_entries = [toc_entry for toc_entry in changed_entries if toc_entry in json_data['preamble']]
+    topic_entries = [toc_entry for toc_entry in changed_entries if toc_entry not in json_data['preamble']]
+    changed_filepaths = []
+    if preamble_entries:
+        for ind, toc_entry in enumerate(json_data['preamble']):
+            if toc_entry in preamble_entries:
+                newcommand_data_list[ind] = extract_newcomm_defs(toc_entry)
+        new_comms_to_replace_all = create_combined_newcomm_list(newcommand_data_list)
+        changed_macros = update_macro_definitions(newcommand_data_list)
+        comms_to_replace_before = set(comms_to_replace_all['all_comms_to_replace'])
+        comms_to_replace_now = set(new_comms_to_replace_all['all_comms_to_replace'])
+        comms_added_removed = [comm for comm in changed_macros
+                               if (comm in comms_to_replace_before) != (comm in comms_to_replace_now)]
+        comms_to_replace_all = new_comms_to_replace_all
+        if comms_added_removed:
+            entries_by_report_key = {}
+            for toc_entry in json_data['preamble'] + flatten_toc_entries(json_data.get('toc', []), []):
+                entries_by_report_key[get_topic_paths(toc_entry)['report_key']] = toc_entry
+            report_keys_to_convert = get_topics_using_macros(entries_by_report_key, comms_added_removed)
+            entries_to_convert = [toc_entry for report_key, toc_entry in entries_by_report_key.items()
+                                  if toc_entry in changed_entries or report_key in report_keys_to_convert]
+            preamble_entries = [toc_entry for toc_entry in entries_to_convert if toc_entry in json_data['preamble']]
+            topic_entries = [toc_entry for toc_entry in entries_to_convert if toc_entry not in json_data['preamble']]
+            print('Commands to replace added or removed: ' + str(len(comms_added_removed)) + ', converting '
+                  + str(len(preamble_entries)) + ' preamble entries and ' + str(len(topic_entries)) + ' topics.')
+        # The snippets of the changed commands, and the snippets that the entries had before and have now
+        snippet_names = get_macro_snippet_names(changed_macros)
+        for toc_entry in preamble_entries:
+            snippet_names.update(name for name, elem in new_newcomm_elements.get(toc_entry['path'], []))
+        for topic in restore_or_convert_topics([get_topic_paths(toc_entry) for toc_entry in preamble_entries]):
+            generate_snip_and_var(topic['toc_entry'])
+            snippet_names.update(name for name, elem in new_newcomm_elements[topic['toc_entry']['path']])
+        snippet_names.update(get_macro_snippet_names(changed_macros))
+        changed_filepaths.extend(write_snippets(snippet_names))
+    for topic in restore_or_convert_topics([get_topic_paths(toc_entry) for toc_entry in topic_entries]):
+        changed_filepaths.append(topic['target_topic_filepath'])
+    if changed_filepaths:
+        anch_ref = post_process_content(changed_filepaths)
+        snippet_srcs = anch_ref['snippet_srcs']
+        snippet_srcs.update(update_xrefs(glob_anch_ref, anch_ref, changed_filepaths))
+        update_snippet_index(snippet_srcs)
+    if len(flare_toc_root) and write_toc(flare_toc_root):
+        print('TOC written again: ' + flare_toc_filepath)
+    save_macro_deps()
+    prune_build_cache()
+    print('Files updated: ' + str(len(changed_filepaths)))
+
+
+# The watch mode (--watch). Polls the source files of the preamble and toc entries until Ctrl+C. When files
+# change, waits until they stop changing (an editor can save a file with more than one write), and converts
+# the changed entries with update_source_entries(). The run report and the diagnostics are written for each update.
+# The config is not read again: a change of the config (new entries, other options) needs a new run.
+def watch_source_files(glob_anch_ref, flare_toc_root):
+    entries_by_filepath = {}
+    for toc_entry in json_data['preamble'] + flatten_toc_entries(json_data.get('toc', []), []):
+        entries_by_filepath.setdefault(get_topic_paths(toc_entry)['source_file_path'], []).append(toc_entry)
+    source_state = get_source_state(entries_by_filepath)
+    print('Watching ' + str(len(entries_by_filepath)) + ' source files for changes (Ctrl+C to stop).')
+    try:
+        while True:
+            time.sleep(watch_poll_interval)
+            new_source_state = get_source_state(entries_by_filepath)
+            if new_source_state == source_state:
+                continue
+            stable_source_state = None
+            while stable_source_state != new_source_state:
+                stable_source_state = new_source_state
+                time.sleep(watch_poll_interval)
+                new_source_state = get_source_state(entries_by_filepath)
+            changed_entries = []
+            for filepath, file_state in new_source_state.items():
+                if file_state != source_state[filepath] and file_state is not None:
+                    changed_entries.extend(entries_by_filepath[filepath])
+            source_state = new_source_state
+            if not changed_entries:
+                continue
+            time_start = time.perf_counter()
+            for stats in run_stats.values():
+                stats.clear()
+            del diagnostics[:]
+            try:
+                update_source_entries(changed_entries, glob_anch_ref, flare_toc_root)
+            except Exception as e:
+                # A file that is being edited can break pandoc, the next change is converted again
+                print('ERROR: The update failed, waiting for the next change: ' + str(e))
+                logging.exception('The update failed')
+                continue
+            write_run_report()
+            write_diagnostics_report()
+            print('Updated ' + str(len(changed_entries)) + ' entries in %.1f s.' % (time.perf_counter() - time_start))
+    except KeyboardInterrupt:
+        print('Watch stopped.')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, filename='latex_to_flare.log', filemode='w')
+    # START Graphics items config generation
+    if reuse_graphics_index and os.path.isfile(config_file_graphics_index):
+        with open(config_file_graphics_index, encoding='utf-8') as file:
+            graphics_index = json.load(file)
+        graphic_items = graphics_index['by_tex_path']
+    else:
+        graphic_items = helper2(source_root_dir)
+        graphic_items_config = dict({'graphic_items': graphic_items})
+
+        with open(config_file_graphics_items, 'w', encoding='utf-8') as file:
+            json.dump(graphic_items_config, file, indent=4)
+        graphics_index = build_graphics_index(graphic_items)
+        with open(config_file_graphics_index, 'w', encoding='utf-8') as file:
+            json.dump(graphics_index, file, indent=4)
+    report_graphics_index_conflicts(graphics_index)
+
+    # END Graphics config generation
+
+    # Execution start
+    check_create_folder(pandoc_logs_dir)
+    load_macro_deps()
+    # Processing the preamble entries from the config file (lists of commands).
+    newcommand_data_list = []
+    for toc_entry in json_data['preamble']:
+        timer = start_timer(get_topic_paths(toc_entry)['report_key'])
+        newcommand_data_list.append(extract_newcomm_defs(toc_entry))
+        record_lap(timer, 'extract_newcomm_defs')
+    # Creating a combined list of commands to replace.
+    comms_to_replace_all = create_combined_newcomm_list(newcommand_data_list)
+    update_macro_definitions(newcommand_data_list)
+    convert_toc_entries(json_data['preamble'])
+    # Generate flare items from \newcommand definitions
+    for toc_entry in json_data['preamble']:
+        generate_snip_and_var(toc_entry)
+    write_snippets()
+
+    # Processing of the content of the User Manual starts here
+    # toc_parts are the Preface part, the HW part, and the SW part.
+    flare_toc_root = create_toc_root()
+    convert_toc_entries(json_data.get('toc', []), flare_toc_root)
+
+    # Various postprocessing (see post_process_content_file())
+    glob_anch_ref = post_process_content()
+    snippet_srcs = glob_anch_ref.pop('snippet_srcs')
+    snippet_srcs.update(resolve_xrefs(glob_anch_ref['anchors'], glob_anch_ref['references']))
+    update_snippet_index(snippet_srcs, all_topics=True)
+    save_macro_deps()
+    prune_build_cache()
+    if len(flare_toc_root):
+        write_toc(flare_toc_root)
+
+    write_run_report()
+    write_diagnostics_report()
+    if watch_mode:
+        watch_source_files(glob_anch_ref, flare_toc_root)
+    print('Program finished.')
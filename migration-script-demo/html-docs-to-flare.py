@@ -6,6 +6,9 @@ from lxml import etree
 from collections import Counter
 import pyperclip
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import xml_writer
+
 
 parser_xml = etree.XMLParser(strip_cdata=False)
 parser_html = etree.HTMLParser()
@@ -45,34 +48,6 @@ def check_create_folder(directory):
     pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
 
 
-def indent_xml(elem, level=0, more_sibs=False):
-    i = "\n"
-    empty_spaces = "    "
-    if level:
-        i += (level - 1) * empty_spaces
-    num_children = len(elem)
-    if num_children:
-        if not elem.text or not elem.text.strip():
-            if elem.getchildren()[0].tag not in inline_tags:
-                elem.text = i + empty_spaces
-                if level:
-                    elem.text += empty_spaces
-        count = 0
-        for child in elem:
-            if child.tag not in inline_tags:
-                indent_xml(child, level + 1, count < num_children - 1)
-            count += 1
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-            if more_sibs:
-                elem.tail += empty_spaces
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
-            if more_sibs:
-                elem.tail += empty_spaces
-
-
 def xml_create_flare_root(div_section_from_product):
     root = etree.Element("html", nsmap=madcap_nsmap)
     root.text = '\n'
@@ -84,15 +59,9 @@ def xml_create_flare_root(div_section_from_product):
 
 
 def write_root(root, filename):
-    indent_xml(root)
-    result_str = etree.tostring(root, encoding="UTF-8")
-    xml_declaration = b"<?xml version=\"1.0\" encoding=\"utf-8\"?>\n"
-    result_str = xml_declaration + result_str
     # Making sure that the target dir exists
     check_create_folder(pathlib.Path(filename).parent)
-    output_file = open(filename, "wb")
-    output_file.write(result_str)
-    output_file.close()
+    xml_writer.write_root(root, filename, inline_tags)
 
 toc_attributes = {'Version': '1'}
 flare_toc_root = etree.Element("CatapultToc", attrib=toc_attributes)
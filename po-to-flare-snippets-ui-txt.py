@@ -8,6 +8,8 @@ import pathlib
 import html
 import lxml.html
 import sys
+import xml_writer
+import snippet_index
 
 
 parser_xml = etree.XMLParser(strip_cdata=False)
@@ -39,71 +41,25 @@ inline_tags = ["a", "abbr", "acronym", "b", "bdo", "big", "br", "button", "cite"
                "{" + madcap_namespace + "}conditionalText"]
 
 
-def indent(elem, level=0, more_sibs=False):
-    i = "\n"
-    empty_spaces = "    "
-    if level:
-        i += (level - 1) * empty_spaces
-    num_children = len(elem)
-    if num_children:
-        if not elem.text or not elem.text.strip():
-            if elem.getchildren()[0].tag not in inline_tags:
-                elem.text = i + empty_spaces
-                if level:
-                    elem.text += empty_spaces
-        count = 0
-        for child in elem:
-            if child.tag not in inline_tags:
-                indent(child, level + 1, count < num_children - 1)
-            count += 1
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-            if more_sibs:
-                elem.tail += empty_spaces
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
-            if more_sibs:
-                elem.tail += empty_spaces
-
-
 # This function scans all files and returns a list of links to all used snippets
+# The snippet links of the topics come from the snippet index (only the changed topics are parsed).
 def scan_files(path):
-    global_snippet_list = []
     filenames = set()
     for root_dir, dirs, files in os.walk(path):
         root_dir = root_dir.replace(os.path.sep, dir_sep)
         for filename_tmp in files:
-            if filename_tmp.endswith('.htm'):
-                current_filepath = root_dir + dir_sep + filename_tmp
-                root_tree = etree.parse(current_filepath, parser=parser_xml)
-                root = root_tree.getroot()
-                nsmap = root.nsmap
-                nsmap_value = nsmap["MadCap"]
-                snippetText_list = root.findall(".//{" + nsmap_value + "}snippetText")
-                snippetBlock_list = root.findall(".//{" + nsmap_value + "}snippetBlock")
-                file_snippet_list = snippetText_list + snippetBlock_list
-                global_snippet_list += file_snippet_list
             if filename_tmp.endswith('.flsnp') and (ui_snippet_dir in root_dir):
                 filenames.add(filename_tmp.split(dir_sep)[-1][0:-6])
     # Extracting only unique links
-    for elem in global_snippet_list:
-        filenames.add(elem.attrib["src"].split(ui_snippet_dir)[-1].split(dir_sep)[-1][0:-6])
+    index = snippet_index.load_snippet_index(path)
+    for src in index["snippets"]:
+        filenames.add(src.split(ui_snippet_dir)[-1].split(dir_sep)[-1][0:-6])
     return filenames
 
 
 def write_root(root, filename):
-    indent(root)
-    result_str = etree.tostring(root, encoding="UTF-8")
     # TODO: unescaping &lt; and &gt; because method="html" does not unescape them
-    # result_str_decoded = result_str.decode("UTF-8")
-    # result_str = html.unescape(result_str_decoded)
-    # result_str = result_str.encode()
-    xml_declaration = b"<?xml version=\"1.0\" encoding=\"utf-8\"?>\n"
-    result_str = xml_declaration + result_str
-    output_file = open(filename, "wb")
-    output_file.write(result_str)
-    output_file.close()
+    xml_writer.write_root(root, filename, inline_tags)
 
 
 def check_create_folder(directory):
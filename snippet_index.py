@@ -0,0 +1,113 @@
+# The snippet references (MadCap:snippetText and MadCap:snippetBlock) of the topics in the Content directory
+# of a Flare project. All scripts pass the Content directory itself, so that they share one index. The index is
+# kept on disk in the project directory (outside Content, so that Flare doesn't see it), and only the topics
+# with another mtime or size are parsed again.
+# * topics: topic path (relative to the Content directory) -> {'mtime': ..., 'size': ..., 'snippets': [src, ...]}
+# * snippets: snippet src -> topic paths that reference it
+import os
+import json
+from lxml import etree
+
+
+parser_xml = etree.XMLParser(strip_cdata=False)
+dir_sep = "/"
+madcap_namespace = "http://www.madcapsoftware.com/Schemas/MadCap.xsd"
+snippet_tags = ["{" + madcap_namespace + "}snippetText", "{" + madcap_namespace + "}snippetBlock"]
+index_filename = "snippet_index.json"
+
+
+def get_index_filepath(content_dir):
+    return os.path.join(os.path.dirname(os.path.abspath(content_dir)), index_filename)
+
+
+def get_topic_filepath(content_dir, topic_path):
+    return content_dir.rstrip(dir_sep) + dir_sep + topic_path
+
+
+def get_topic_path(content_dir, topic_filepath):
+    return os.path.relpath(topic_filepath, content_dir).replace(os.path.sep, dir_sep)
+
+
+# The srcs of the snippet elements of a parsed topic (the snippetText elements first, as in the scripts)
+def get_snippet_srcs(root):
+    snippet_srcs = []
+    for tag in snippet_tags:
+        for elem in root.iter(tag):
+            if "src" in elem.attrib:
+                snippet_srcs.append(elem.attrib["src"])
+    return snippet_srcs
+
+
+def get_topic_entry(topic_filepath, snippet_srcs):
+    topic_stat = os.stat(topic_filepath)
+    return {"mtime": topic_stat.st_mtime_ns, "size": topic_stat.st_size, "snippets": snippet_srcs}
+
+
+def build_snippet_users(topics):
+    snippet_users = {}
+    for topic_path, topic_entry in topics.items():
+        for src in topic_entry["snippets"]:
+            if src not in snippet_users:
+                snippet_users[src] = [topic_path]
+            # A topic can reference a snippet more than once (the topics come one after another)
+            elif snippet_users[src][-1] != topic_path:
+                snippet_users[src].append(topic_path)
+    return snippet_users
+
+
+def load_saved_topics(content_dir):
+    index_filepath = get_index_filepath(content_dir)
+    if not os.path.isfile(index_filepath):
+        return {}
+    with open(index_filepath, encoding="utf-8") as index_file:
+        return json.load(index_file)["topics"]
+
+
+# Returns the index of all .htm topics in content_dir (in the os.walk() order). The unchanged topics come
+# from the saved index, the new and changed ones are parsed. The index is saved if anything has changed.
+def load_snippet_index(content_dir):
+    saved_topics = load_saved_topics(content_dir)
+    topics = {}
+    topics_parsed = 0
+    for root_dir, dirs, files in os.walk(content_dir):
+        root_dir = root_dir.replace(os.path.sep, dir_sep)
+        for filename in files:
+            if filename.endswith('.htm'):
+                topic_filepath = root_dir + dir_sep + filename
+                topic_path = get_topic_path(content_dir, topic_filepath)
+                topic_stat = os.stat(topic_filepath)
+                saved_entry = saved_topics.get(topic_path)
+                if saved_entry is not None and saved_entry["mtime"] == topic_stat.st_mtime_ns \
+                        and saved_entry["size"] == topic_stat.st_size:
+                    topics[topic_path] = saved_entry
+                else:
+                    root = etree.parse(topic_filepath, parser=parser_xml).getroot()
+                    topics[topic_path] = get_topic_entry(topic_filepath, get_snippet_srcs(root))
+                    topics_parsed += 1
+    index = {"topics": topics, "snippets": build_snippet_users(topics)}
+    if topics_parsed or len(topics) != len(saved_topics):
+        save_snippet_index(index, content_dir)
+    return index
+
+
+# After a script has written a topic, so that the next run doesn't parse it again
+def update_topic(index, content_dir, topic_path, snippet_srcs):
+    index["topics"][topic_path] = get_topic_entry(get_topic_filepath(content_dir, topic_path), snippet_srcs)
+
+
+def save_snippet_index(index, content_dir):
+    index["snippets"] = build_snippet_users(index["topics"])
+    with open(get_index_filepath(content_dir), "w", encoding="utf-8") as index_file:
+        json.dump(index, index_file, indent=4)
+
+
+# Saves the topics that a script has written (see update_topic()) to the index without walking the Content
+# directory. With path_prefix, the script has written all topics under the prefix, and the other saved topics
+# under it are removed.
+def update_saved_index(content_dir, topics, path_prefix=None):
+    saved_topics = load_saved_topics(content_dir)
+    if path_prefix is not None:
+        saved_topics = {topic_path: topic_entry for topic_path, topic_entry in saved_topics.items()
+                        if not topic_path.startswith(path_prefix)}
+    saved_topics.update(topics)
+    save_snippet_index({"topics": saved_topics}, content_dir)
@@ -0,0 +1,101 @@
+# Writing Flare xml files (topics, snippets, Lingo files). Shared by all scripts.
+import os
+from lxml import etree
+
+
+xml_declaration_utf8 = b"<?xml version=\"1.0\" encoding=\"utf-8\"?>\n"
+empty_spaces = "    "
+
+
+# Just beautifies xml. The children of the inline_tags elements are not indented, and an element whose
+# first child is inline keeps its text. Iterative, so deep nesting doesn't hit the recursion limit.
+def indent_xml(root, inline_tags=()):
+    inline_tags = frozenset(inline_tags)
+    stack = [(root, 0, False)]
+    while stack:
+        elem, level, more_sibs = stack.pop()
+        i = "\n"
+        if level:
+            i += (level - 1) * empty_spaces
+        num_children = len(elem)
+        if num_children:
+            if not elem.text or not elem.text.strip():
+                if elem[0].tag not in inline_tags:
+                    elem.text = i + empty_spaces
+                    if level:
+                        elem.text += empty_spaces
+            for count, child in enumerate(elem):
+                if child.tag not in inline_tags:
+                    stack.append((child, level + 1, count < num_children - 1))
+            if not elem.tail or not elem.tail.strip():
+                elem.tail = i
+                if more_sibs:
+                    elem.tail += empty_spaces
+        else:
+            if level and (not elem.tail or not elem.tail.strip()):
+                elem.tail = i
+                if more_sibs:
+                    elem.tail += empty_spaces
+
+
+# A file-like object for the serializer. As long as the output is the same as the existing file, it only
+# compares. At the first difference, it copies the matching part to a temporary file and writes from there on.
+class UnchangedFileWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.tmp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+        self.existing_file = open(filename, 'rb') if os.path.isfile(filename) else None
+        self.tmp_file = None
+        self.bytes_matched = 0
+
+    def write(self, data):
+        if self.tmp_file is None and self.existing_file is not None:
+            existing_data = self.existing_file.read(len(data))
+            if existing_data == data:
+                self.bytes_matched += len(data)
+                return
+        if self.tmp_file is None:
+            self.tmp_file = open(self.tmp_filename, 'wb')
+            if self.existing_file is not None:
+                self.existing_file.seek(0)
+                self.tmp_file.write(self.existing_file.read(self.bytes_matched))
+        self.tmp_file.write(data)
+
+    # Returns True if the file has been written, and False if it was the same already
+    def close(self):
+        if self.tmp_file is None and self.existing_file is not None and not self.existing_file.read(1):
+            self.existing_file.close()
+            return False
+        if self.existing_file is not None:
+            self.existing_file.close()
+        if self.tmp_file is None:
+            # The output is a prefix of the existing file, or there is no existing file
+            self.tmp_file = open(self.tmp_filename, 'wb')
+            if self.existing_file is not None:
+                with open(self.filename, 'rb') as existing_file:
+                    self.tmp_file.write(existing_file.read(self.bytes_matched))
+        self.tmp_file.close()
+        os.replace(self.tmp_filename, self.filename)
+        return True
+
+    def discard(self):
+        if self.existing_file is not None:
+            self.existing_file.close()
+        if self.tmp_file is not None:
+            self.tmp_file.close()
+            os.remove(self.tmp_filename)
+
+
+# Serializes root to filename in chunks. Returns False if the file already had the same content and was not touched.
+def write_root(root, filename, inline_tags=(), xml_declaration=xml_declaration_utf8, indent=True):
+    if indent:
+        indent_xml(root, inline_tags)
+    output_file = UnchangedFileWriter(filename)
+    try:
+        output_file.write(xml_declaration)
+        with etree.xmlfile(output_file, encoding="UTF-8", close=False) as xml_file:
+            xml_file.write(root)
+    except BaseException:
+        output_file.discard()
+        raise
+    return output_file.close()